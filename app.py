@@ -11,7 +11,7 @@ import logging
 import requests
 from datetime import datetime, timedelta
 from functools import wraps
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, abort
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, abort, g
 from translations import get_t, get_supported_langs, is_rtl
 
 # Logging Configuration
@@ -24,7 +24,7 @@ logger = logging.getLogger(__name__)
 
 # Import Database Operations
 from database import (
-    get_user, create_user, update_user, get_users_count,
+    get_user, create_user, update_user, invalidate_user, get_users_count,
     update_balance, get_balance_history,
     get_checkin_status, claim_daily_checkin, get_checkin_history,
     add_referral, validate_referral, get_referrals, get_referral_stats,
@@ -33,10 +33,11 @@ from database import (
     is_task_completed, complete_task, get_user_tasks_status,
     create_withdrawal, get_user_withdrawals, get_pending_withdrawals, update_withdrawal,
     get_all_promo_codes, get_promo_code, create_promo_code, redeem_promo_code,
-    get_config, set_config, get_all_config,
+    get_config, set_config, set_configs, get_all_config,
     get_stat, get_all_stats, increment_stat,
     record_user_ip, is_ip_banned, ban_user, unban_user,
     get_top_earners, get_top_referrers, get_top_streakers,
+    get_leaderboards, get_user_rank,
     get_all_users, ban_ip, unban_ip,
     # Mining functions
     get_all_mining_plans, get_mining_plan, purchase_mining_machine,
@@ -55,10 +56,12 @@ from database import (
     get_wallet_owner, get_duplicate_wallets,
     delete_user_completely,
     # Anti-fraud
-    is_withdrawal_blocked, check_and_flag_multi_account, unflag_user_fraud,
+    is_withdrawal_blocked, recheck_multi_account, unflag_user_fraud,
     flag_user_fraud, set_fraud_exempt, is_fraud_exempt,
     get_shared_ip_accounts, are_accounts_related,
     get_shared_ip_groups, search_multiaccounts,
+    # Conexion por peticion
+    begin_request_scope, end_request_scope, read_only_tolerant, load_request_context,
 )
 
 # ── NOTIFICATION HELPERS ──────────────────────────────────────────
@@ -129,6 +132,56 @@ app.config['SESSION_COOKIE_SAMESITE'] = 'None'   # requerido dentro del iframe d
 app.config['SESSION_COOKIE_SECURE'] = True
 app.permanent_session_lifetime = timedelta(days=7)
 
+# ── Conexion a BD por peticion ──────────────────────────────────
+# Todos los helpers de database.py reutilizan UNA conexion del pool durante
+# la peticion (se saca en la primera consulta y se devuelve al terminar).
+@app.before_request
+def _db_begin_request():
+    begin_request_scope()
+
+
+@app.teardown_request
+def _db_end_request(exc=None):
+    end_request_scope()
+
+
+# ── Escrituras diferidas ────────────────────────────────────────
+# require_user registraba la IP y pasaba el escaneo multicuenta ANTES de la
+# vista, en el camino critico de cada peticion. Ahora se encolan con
+# defer_after_request() y se ejecutan cuando la respuesta ya salio
+# (call_on_close), con su propia conexion del pool.
+def defer_after_request(fn, *args, **kwargs):
+    g.setdefault('_deferred_writes', []).append((fn, args, kwargs))
+
+
+def cancel_deferred(fn, *args):
+    """Quita de la cola de la peticion una escritura que ya se hizo en linea."""
+    cola = g.get('_deferred_writes')
+    if cola:
+        clave = tuple(str(a) for a in args)   # user_id puede venir como int o str
+        cola[:] = [d for d in cola
+                   if not (d[0] is fn and tuple(str(a) for a in d[1]) == clave)]
+
+
+def _run_deferred_writes(pendientes):
+    begin_request_scope()
+    try:
+        for fn, args, kwargs in pendientes:
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                logger.warning(f"[deferred] {getattr(fn, '__name__', fn)}: {e}")
+    finally:
+        end_request_scope()
+
+
+@app.after_request
+def _schedule_deferred_writes(response):
+    pendientes = g.pop('_deferred_writes', None)
+    if pendientes:
+        response.call_on_close(lambda: _run_deferred_writes(pendientes))
+    return response
+
 # (El panel admin usa login con usuario/contraseña + dominio autorizado.)
 
 # ── reCAPTCHA v2 (checkbox al inicio) ───────────────────────────
@@ -492,48 +545,210 @@ except Exception as _cr_err:
 # TELEGRAM VERIFICATION
 # ============================================
 
-_channel_cache = {}
-_CACHE_DURATION = 60  # seconds
-
-def verify_channel_membership(user_id, channel_username):
-    """Verify if user is member of Telegram channel"""
-    if not BOT_TOKEN or not channel_username:
-        return False, "Configuration error"
-    
-    channel = channel_username.strip()
-    if not channel.startswith('@'):
+# Una sola cache para la web (verify_channel_membership) y el bot
+# (_check_all_channels): LRU acotado por worker delante de la tabla
+# channel_membership, que comparten todos los workers. Los "si" duran
+# CHANNEL_CACHE_TTL y, pasado eso, se siguen sirviendo hasta
+# CHANNEL_CACHE_STALE segundos mas mientras se revalidan en segundo plano.
+# Los "no" duran poco (el usuario suele unirse justo despues) y no se
+# sirven caducados. Los errores de Telegram no se cachean.
+import threading as _ch_threading
+import time as _ch_time
+from collections import OrderedDict as _ChOrderedDict
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+from database import get_channel_memberships, save_channel_membership, clear_channel_memberships
+
+CHANNEL_CACHE_TTL = int(os.environ.get('CHANNEL_CACHE_TTL', '300') or 300)
+CHANNEL_CACHE_NEG_TTL = int(os.environ.get('CHANNEL_CACHE_NEG_TTL', '20') or 20)
+CHANNEL_CACHE_STALE = int(os.environ.get('CHANNEL_CACHE_STALE', '3600') or 3600)
+CHANNEL_CACHE_MAX = int(os.environ.get('CHANNEL_CACHE_MAX', '20000') or 20000)
+CHANNEL_CHECK_TIMEOUT = float(os.environ.get('CHANNEL_CHECK_TIMEOUT', '5') or 5)
+
+_channel_cache = _ChOrderedDict()   # (user_id, canal) -> (checked_at, is_member)
+_channel_lock = _ch_threading.Lock()
+_channel_refreshing = set()
+_channel_pool = {'pid': None, 'executor': None}
+
+
+def _normalize_channel(channel_username):
+    channel = (channel_username or '').strip()
+    if channel and not channel.startswith('@'):
         channel = f"@{channel}"
-    
-    # Check cache
-    cache_key = f"{user_id}:{channel}"
-    if cache_key in _channel_cache:
-        cached = _channel_cache[cache_key]
-        if (datetime.now() - cached['time']).seconds < _CACHE_DURATION:
-            return cached['result']
-    
+    return channel
+
+
+def _channel_executor():
+    """Pool de hilos por proceso (se crea tras el fork de gunicorn)."""
+    pid = os.getpid()
+    if _channel_pool['pid'] != pid:
+        with _channel_lock:
+            if _channel_pool['pid'] != pid:
+                _channel_pool['executor'] = _ThreadPoolExecutor(
+                    max_workers=8, thread_name_prefix='channel-check')
+                _channel_pool['pid'] = pid
+    return _channel_pool['executor']
+
+
+def _fetch_membership(user_id, channel):
+    """getChatMember en vivo -> (is_member | None si fallo, mensaje)."""
     try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/getChatMember"
-        response = requests.get(url, params={
-            'chat_id': channel,
-            'user_id': user_id
-        }, timeout=10)
-        
+        response = requests.get(f"https://api.telegram.org/bot{BOT_TOKEN}/getChatMember",
+                                params={'chat_id': channel, 'user_id': user_id},
+                                timeout=CHANNEL_CHECK_TIMEOUT)
         data = response.json()
-        if data.get('ok'):
-            status = data.get('result', {}).get('status', '')
-            # 'member', 'administrator', 'creator', 'restricted' = está dentro del canal
-            is_member = status in ['member', 'administrator', 'creator', 'restricted']
-            result = (is_member, "Member" if is_member else "Not a member")
+    except Exception as e:
+        logger.warning(f"getChatMember error ({channel}): {e}")
+        return None, str(e)
+    if not data.get('ok'):
+        # "chat not found", bot sin permisos...: es un fallo de configuracion,
+        # no un "no es miembro" (ni se cachea ni bloquea en el bot)
+        logger.warning(f"getChatMember {channel}: {data.get('description')}")
+        return None, data.get('description', 'Verification failed')
+    res = data.get('result', {}) or {}
+    status = res.get('status', '')
+    # 'restricted' sigue dentro del canal salvo que Telegram diga is_member=false
+    is_member = (status in ('member', 'administrator', 'creator')
+                 or (status == 'restricted' and res.get('is_member', True)))
+    return is_member, "Member" if is_member else "Not a member"
+
+
+def _remember_membership(user_id, channel, is_member, checked_at, shared=True):
+    with _channel_lock:
+        _channel_cache[(str(user_id), channel)] = (checked_at, is_member)
+        _channel_cache.move_to_end((str(user_id), channel))
+        while len(_channel_cache) > CHANNEL_CACHE_MAX:
+            _channel_cache.popitem(last=False)
+    if shared:
+        try:
+            save_channel_membership(user_id, channel, is_member, checked_at,
+                                    max_age=CHANNEL_CACHE_TTL + CHANNEL_CACHE_STALE)
+        except Exception as e:
+            logger.warning(f"[channel-cache] no se pudo guardar {user_id}:{channel}: {e}")
+
+
+def _check_live(user_id, channel):
+    is_member, msg = _fetch_membership(user_id, channel)
+    if is_member is not None:
+        _remember_membership(user_id, channel, is_member, _ch_time.time())
+    return is_member, msg
+
+
+def _refresh_in_background(user_id, channel):
+    clave = (str(user_id), channel)
+    with _channel_lock:
+        if clave in _channel_refreshing:
+            return
+        _channel_refreshing.add(clave)
+
+    def _tarea():
+        try:
+            _check_live(user_id, channel)
+        finally:
+            with _channel_lock:
+                _channel_refreshing.discard(clave)
+    try:
+        _channel_executor().submit(_tarea)
+    except Exception:
+        with _channel_lock:
+            _channel_refreshing.discard(clave)
+
+
+def _cached_membership(entry, now, recheck_negative):
+    """True/False si la entrada sirve, None si hay que preguntar a Telegram.
+    Devuelve tambien si hay que revalidarla en segundo plano."""
+    if entry is None:
+        return None, False
+    checked_at, is_member = entry
+    age = now - checked_at
+    if is_member:
+        if age < CHANNEL_CACHE_TTL:
+            return True, False
+        if age < CHANNEL_CACHE_TTL + CHANNEL_CACHE_STALE:
+            return True, True
+        return None, False
+    if recheck_negative or age >= CHANNEL_CACHE_NEG_TTL:
+        return None, False
+    return False, False
+
+
+def check_channels(user_id, channels, recheck_negative=False):
+    """Pertenencia de un usuario a varios canales: {canal: (is_member|None, msg)}.
+
+    Orden: LRU del worker -> tabla compartida (una consulta para todos) ->
+    getChatMember en paralelo para lo que falte. recheck_negative=True
+    ignora los "no" cacheados (el usuario pulso "Ya me uni").
+    """
+    canales = [c for c in dict.fromkeys(_normalize_channel(ch) for ch in channels) if c]
+    out = {}
+    now = _ch_time.time()
+    pendientes = []
+    with _channel_lock:
+        locales = {ch: _channel_cache.get((str(user_id), ch)) for ch in canales}
+    for ch in canales:
+        valor, revalidar = _cached_membership(locales[ch], now, recheck_negative)
+        if valor is None:
+            pendientes.append(ch)
+            continue
+        out[ch] = (valor, "Member" if valor else "Not a member")
+        if revalidar:
+            _refresh_in_background(user_id, ch)
+
+    if pendientes:
+        try:
+            compartidas = get_channel_memberships(user_id, pendientes)
+        except Exception as e:
+            logger.warning(f"[channel-cache] lectura compartida fallida: {e}")
+            compartidas = {}
+        faltan = []
+        for ch in pendientes:
+            valor, revalidar = _cached_membership(compartidas.get(ch), now, recheck_negative)
+            if valor is None:
+                faltan.append(ch)
+                continue
+            _remember_membership(user_id, ch, valor, compartidas[ch][0], shared=False)
+            out[ch] = (valor, "Member" if valor else "Not a member")
+            if revalidar:
+                _refresh_in_background(user_id, ch)
+
+        if len(faltan) == 1:
+            out[faltan[0]] = _check_live(user_id, faltan[0])
+        elif faltan:
+            futuros = {ch: _channel_executor().submit(_check_live, user_id, ch) for ch in faltan}
+            for ch, fut in futuros.items():
+                try:
+                    out[ch] = fut.result()
+                except Exception as e:
+                    out[ch] = (None, str(e))
+    return out
+
+
+def forget_channel_membership(user_id=None, channel=None):
+    """Olvida entradas de la cache (local de este worker y compartida)."""
+    channel = _normalize_channel(channel) if channel else None
+    with _channel_lock:
+        if user_id is None and channel is None:
+            _channel_cache.clear()
         else:
-            result = (False, data.get('description', 'Verification failed'))
-        
-        # Cache result
-        _channel_cache[cache_key] = {'result': result, 'time': datetime.now()}
-        return result
-        
+            for k in [k for k in _channel_cache
+                      if (user_id is None or k[0] == str(user_id))
+                      and (channel is None or k[1] == channel)]:
+                del _channel_cache[k]
+    try:
+        clear_channel_memberships(user_id, channel)
     except Exception as e:
-        logger.error(f"Channel verification error: {e}")
-        return False, str(e)
+        logger.warning(f"[channel-cache] no se pudo limpiar la tabla: {e}")
+
+
+def verify_channel_membership(user_id, channel_username, recheck_negative=False):
+    """Verify if user is member of Telegram channel"""
+    if not BOT_TOKEN or not channel_username:
+        return False, "Configuration error"
+    channel = _normalize_channel(channel_username)
+    is_member, msg = check_channels(user_id, [channel], recheck_negative)[channel]
+    if is_member is None:
+        logger.error(f"Channel verification error: {msg}")
+        return False, msg
+    return is_member, msg
 
 # ============================================
 # HELPER FUNCTIONS
@@ -569,6 +784,22 @@ def get_client_ip():
 
     return request.remote_addr or '127.0.0.1'
 
+# La clave secreta depende solo de BOT_TOKEN: se deriva una vez, no en cada
+# validacion. Y como la mini-app reenvia el MISMO initData en cada /auth,
+# recarga y fallback de get_user_id(), los ya verificados se recuerdan
+# (LRU acotado, clave = sha256 del blob completo) hasta que caducan.
+import hmac as _ia_hmac
+import hashlib as _ia_hashlib
+import threading as _ia_threading
+from collections import OrderedDict as _OrderedDict
+
+_INIT_DATA_SECRET = (_ia_hmac.new(b'WebAppData', BOT_TOKEN.encode(), _ia_hashlib.sha256).digest()
+                     if BOT_TOKEN else None)
+INIT_DATA_CACHE_MAX = int(os.environ.get('INIT_DATA_CACHE_MAX', '4096') or 4096)
+_init_data_cache = _OrderedDict()   # sha256(initData) -> (auth_date, params)
+_init_data_lock = _ia_threading.Lock()
+
+
 def _validate_init_data(init_data_raw, max_age_seconds=86400):
     """Valida CRIPTOGRAFICAMENTE el initData de Telegram.
 
@@ -583,11 +814,23 @@ def _validate_init_data(init_data_raw, max_age_seconds=86400):
     """
     if not init_data_raw:
         return None
-    if not BOT_TOKEN:
+    if not _INIT_DATA_SECRET:
         logger.error("[AUTH] BOT_TOKEN no configurado: no se puede validar initData.")
         return None
     try:
-        import hmac as _hmac, hashlib as _hashlib, urllib.parse as _up, time as _time
+        import urllib.parse as _up, time as _time
+
+        clave = _ia_hashlib.sha256(init_data_raw.encode()).digest()
+        with _init_data_lock:
+            hit = _init_data_cache.get(clave)
+            if hit is not None:
+                _init_data_cache.move_to_end(clave)
+        if hit is not None:
+            auth_date, params = hit
+            if max_age_seconds and auth_date and (_time.time() - auth_date) > max_age_seconds:
+                logger.info("[AUTH] initData caducado")
+                return None
+            return dict(params)
 
         params = dict(_up.parse_qsl(init_data_raw, keep_blank_values=True))
         recibido = params.pop('hash', '')
@@ -597,10 +840,9 @@ def _validate_init_data(init_data_raw, max_age_seconds=86400):
         # data_check_string = pares "k=v" ordenados alfabeticamente, unidos por \n
         check_string = '\n'.join(f'{k}={v}' for k, v in sorted(params.items()))
 
-        secret     = _hmac.new(b'WebAppData', BOT_TOKEN.encode(), _hashlib.sha256).digest()
-        calculado  = _hmac.new(secret, check_string.encode(), _hashlib.sha256).hexdigest()
+        calculado = _ia_hmac.new(_INIT_DATA_SECRET, check_string.encode(), _ia_hashlib.sha256).hexdigest()
 
-        if not _hmac.compare_digest(calculado, recibido):
+        if not _ia_hmac.compare_digest(calculado, recibido):
             return None
 
         # Anti-replay: un initData viejo no sirve para siempre
@@ -609,6 +851,10 @@ def _validate_init_data(init_data_raw, max_age_seconds=86400):
             logger.info("[AUTH] initData caducado")
             return None
 
+        with _init_data_lock:
+            _init_data_cache[clave] = (auth_date, dict(params))
+            while len(_init_data_cache) > INIT_DATA_CACHE_MAX:
+                _init_data_cache.popitem(last=False)
         return params
     except Exception as e:
         logger.warning(f"[AUTH] initData ilegible: {e}")
@@ -681,6 +927,7 @@ def ensure_user(user_id):
                 "UPDATE users SET referred_by = %s WHERE user_id = %s AND (referred_by IS NULL OR referred_by = '')",
                 (str(ref), str(user_id))
             )
+            invalidate_user(user_id)
             referrer = get_user(ref)
             if referrer:
                 # Check not already in referrals table
@@ -825,32 +1072,25 @@ def require_user(f):
                 return jsonify({'error': 'Account suspended'}), 403
             return render_template('banned.html', reason=user.get('ban_reason'))
         
-        # Check IP ban
+        # Baneo de IP + límite de cuentas por IP en una sola consulta
         client_ip = get_client_ip()
-        if is_ip_banned(client_ip):
+        ctx = load_request_context(user_id, client_ip)
+        if ctx['ip_banned']:
             if request.is_json:
                 return jsonify({'error': 'Access denied'}), 403
             return render_template('banned.html', reason='IP address blocked')
 
         # ── Límite de cuentas por IP (NO banea, solo niega el acceso) ──
-        try:
-            from database import ip_gate
-            if not ip_gate(user_id, client_ip):
-                if request.is_json:
-                    return jsonify({'error': 'ip_in_use', 'redirect': '/'}), 403
-                _l = session.get('lang', 'en')
-                return render_template('ip_in_use.html', t=get_t(_l), lang=_l), 403
-        except Exception as _ige:
-            logger.warning(f"[ip_gate] error (deja pasar): {_ige}")
-        
-        # Record activity
-        record_user_ip(user_id, client_ip)
+        if not ctx['ip_allowed']:
+            if request.is_json:
+                return jsonify({'error': 'ip_in_use', 'redirect': '/'}), 403
+            _l = session.get('lang', 'en')
+            return render_template('ip_in_use.html', t=get_t(_l), lang=_l), 403
 
-        # Passive multi-account scan (silent — only flags, doesn't block browsing)
-        try:
-            check_and_flag_multi_account(user_id)
-        except Exception as _fraud_err:
-            logger.warning(f"[ANTI-FRAUD] scan error: {_fraud_err}")
+        # Record activity (después de enviar la respuesta). El escaneo
+        # multicuenta lo hace el job de fondo _background_multiaccount_scanner
+        # cuando cambia el número de cuentas de una IP.
+        defer_after_request(record_user_ip, user_id, client_ip)
 
         return f(user, *args, **kwargs)
     return decorated
@@ -859,22 +1099,19 @@ def require_user(f):
 # ============================================
 # RATE LIMITING
 # ============================================
-import threading as _rl_threading
-import time as _rl_time
-
-_rl_lock = _rl_threading.Lock()
-_rl_hits = {}
+from database import rate_limit_hit
 
 
 def rate_limit(max_calls, window_seconds, por='user'):
-    """Limita peticiones en una ventana deslizante.
+    """Limita peticiones: rafagas de max_calls por ventana (GCRA).
 
     por='user' -> por usuario logueado (cae a IP si no hay sesion)
     por='ip'   -> siempre por IP (para endpoints sin autenticar como /auth)
 
-    Es en memoria y por worker de gunicorn: no es un limite global exacto,
-    pero corta los bucles automatizados y baja la carga del servidor. El
-    limite duro de verdad vive en la base de datos (cooldown del claim).
+    El contador vive en la tabla rate_limits (una fila por clave, un UPDATE
+    por peticion), asi que el limite es el mismo en todos los workers de
+    gunicorn. Con RATE_LIMIT_BACKEND=local es por worker. El limite duro
+    de verdad sigue en la base de datos (cooldown del claim).
     """
     def decorador(f):
         @wraps(f)
@@ -884,35 +1121,21 @@ def rate_limit(max_calls, window_seconds, por='user'):
                     ident = get_client_ip()
                 else:
                     ident = session.get('user_id') or get_client_ip()
-                ahora = _rl_time.time()
                 clave = f"{f.__name__}:{ident}"
 
-                with _rl_lock:
-                    cola = _rl_hits.setdefault(clave, [])
-                    while cola and cola[0] <= ahora - window_seconds:
-                        cola.pop(0)
-
-                    if len(cola) >= max_calls:
-                        espera = int(window_seconds - (ahora - cola[0])) + 1
-                        logger.warning(
-                            f"[RATE-LIMIT] {clave} bloqueado "
-                            f"({len(cola)} peticiones en {window_seconds}s)"
-                        )
-                        return jsonify({
-                            'success': False,
-                            'error': 'rate_limited',
-                            'message': f'Demasiadas peticiones. Espera {espera}s.',
-                            'retry_after': espera,
-                        }), 429
-
-                    cola.append(ahora)
-
-                    # Limpieza para que el dict no crezca sin limite
-                    if len(_rl_hits) > 5000:
-                        muertas = [k for k, v in _rl_hits.items()
-                                   if not v or v[-1] <= ahora - 3600]
-                        for k in muertas:
-                            _rl_hits.pop(k, None)
+                permitido, espera = rate_limit_hit(clave, max_calls, window_seconds)
+                if not permitido:
+                    espera = int(espera) + 1
+                    logger.warning(
+                        f"[RATE-LIMIT] {clave} bloqueado "
+                        f"(mas de {max_calls} peticiones en {window_seconds}s)"
+                    )
+                    return jsonify({
+                        'success': False,
+                        'error': 'rate_limited',
+                        'message': f'Demasiadas peticiones. Espera {espera}s.',
+                        'retry_after': espera,
+                    }), 429
             except Exception as e:
                 logger.warning(f"[RATE-LIMIT] error (deja pasar): {e}")
 
@@ -1069,10 +1292,9 @@ def index():
 
     # ── Canal obligatorio: el usuario debe estar unido para usar la app ──
     if REQUIRED_CHANNEL:
-        # Si viene de tocar "Ya me uní", limpiar el cache para verificar en vivo
-        if request.args.get('rejoin') == '1':
-            _channel_cache.pop(f"{user_id}:{REQUIRED_CHANNEL if REQUIRED_CHANNEL.startswith('@') else '@'+REQUIRED_CHANNEL}", None)
-        is_member, _ = verify_channel_membership(user_id, REQUIRED_CHANNEL)
+        # Si viene de tocar "Ya me uní", un "no" cacheado no vale: verificar en vivo
+        is_member, _ = verify_channel_membership(
+            user_id, REQUIRED_CHANNEL, recheck_negative=request.args.get('rejoin') == '1')
         if not is_member:
             lang = session.get('lang', 'en')
             channel_clean = REQUIRED_CHANNEL.lstrip('@')
@@ -1246,8 +1468,11 @@ def api_ton_withdraw_init(user):
     if not ton_wallet:
         return jsonify({'success': False, 'message': _t('api_no_wallet_profile')})
 
-    # ── Anti-fraud: run multi-account check before anything else ──
-    check_and_flag_multi_account(user['user_id'])
+    # ── Anti-fraud: re-evaluación forzada antes de nada ──
+    # La IP de esta peticion cuenta YA (require_user la dejo en diferido)
+    client_ip = get_client_ip()
+    cancel_deferred(record_user_ip, user['user_id'], client_ip)
+    recheck_multi_account(user['user_id'], client_ip)
     blocked, fraud_reason = is_withdrawal_blocked(user['user_id'])
     if blocked:
         lang = session.get('lang', 'en')
@@ -1894,25 +2119,20 @@ def referrals(user):
 @require_user
 def explore(user):
     """Explore page - Leaderboards and discovery"""
-    top_earners = get_top_earners(10)
-    top_referrers = get_top_referrers(10)
-    top_streakers = get_top_streakers(10)
-    
-    stats = get_all_stats()
-    
-    # Calculate user rank
-    user_rank = None
-    for i, earner in enumerate(top_earners, 1):
-        if str(earner.get('user_id')) == str(user['user_id']):
-            user_rank = i
-            break
-    
-    # If not in top 10, calculate approximate rank
-    if user_rank is None:
-        total_users = int(stats.get('total_users', 0))
-        if total_users > 0:
-            user_rank = f"{total_users}+"
-    
+    boards = get_leaderboards()
+    top_earners = boards['earners']
+    top_referrers = boards['referrers']
+    top_streakers = boards['streakers']
+    stats = boards['stats']
+
+    # Puesto exacto del usuario (aunque no este en el top)
+    try:
+        user_rank = get_user_rank(user['user_id'], user.get('total_earned') or 0)
+    except Exception as e:
+        logger.warning(f"[explore] no se pudo calcular el puesto: {e}")
+        user_rank = next((i for i, fila in enumerate(top_earners, 1)
+                          if str(fila.get('user_id')) == str(user['user_id'])), None)
+
     # Community stats
     total_users = int(stats.get('total_users', 0))
     total_distributed = float(stats.get('total_doge_distributed', 0)) / 100000000  # Convert from satoshis
@@ -2071,7 +2291,8 @@ def api_complete_task(user):
     
     # Check channel requirement
     if task.get('requires_channel') and task.get('channel_username'):
-        is_member, msg = verify_channel_membership(user['user_id'], task['channel_username'])
+        is_member, msg = verify_channel_membership(user['user_id'], task['channel_username'],
+                                                   recheck_negative=True)
         if not is_member:
             return jsonify({
                 'success': False, 
@@ -2165,7 +2386,7 @@ def api_verify_channel(user):
     data = request.get_json() or {}
     channel = data.get('channel', OFFICIAL_CHANNEL)
     
-    is_member, msg = verify_channel_membership(user['user_id'], channel)
+    is_member, msg = verify_channel_membership(user['user_id'], channel, recheck_negative=True)
     
     return jsonify({
         'success': is_member,
@@ -2532,6 +2753,7 @@ def admin_auth():
 
 @app.route('/admin/dashboard')
 @require_admin
+@read_only_tolerant
 def admin_dashboard():
     """Admin dashboard"""
     from datetime import datetime
@@ -2614,51 +2836,32 @@ def admin_dashboard():
 
 @app.route('/admin/users')
 @require_admin
+@read_only_tolerant
 def admin_users():
-    """Admin users management"""
-    from database import execute_query
-    page        = int(request.args.get('page', 1))
+    """Admin users management (paginacion por cursor: ?cursor=<next/prev>)"""
+    from database import execute_query, get_users_page
     filter_type = request.args.get('filter', 'all')
     search      = request.args.get('search', '').strip()
+    cursor      = request.args.get('cursor', '') or None
     per_page    = 50
-    offset      = (page - 1) * per_page
 
+    pg = get_users_page(cursor=cursor, limit=per_page, filter_type=filter_type, search=search)
+    users = pg['items']
     if search:
-        users = execute_query(
-            """SELECT * FROM users
-               WHERE username LIKE %s OR first_name LIKE %s OR user_id LIKE %s
-               ORDER BY created_at DESC LIMIT %s OFFSET %s""",
-            (f'%{search}%', f'%{search}%', f'%{search}%', per_page, offset),
-            fetch_all=True
-        ) or []
         res = execute_query(
             "SELECT COUNT(*) as c FROM users WHERE username LIKE %s OR first_name LIKE %s OR user_id LIKE %s",
             (f'%{search}%', f'%{search}%', f'%{search}%'), fetch_one=True
         )
         total_users = res['c'] if res else 0
     elif filter_type == 'banned':
-        users = execute_query(
-            "SELECT * FROM users WHERE banned=1 ORDER BY created_at DESC LIMIT %s OFFSET %s",
-            (per_page, offset), fetch_all=True) or []
         res = execute_query("SELECT COUNT(*) as c FROM users WHERE banned=1", fetch_one=True)
         total_users = res['c'] if res else 0
     elif filter_type == 'active':
-        users = execute_query(
-            "SELECT * FROM users WHERE last_active >= NOW() - INTERVAL 1 DAY ORDER BY last_active DESC LIMIT %s OFFSET %s",
-            (per_page, offset), fetch_all=True) or []
         res = execute_query("SELECT COUNT(*) as c FROM users WHERE last_active >= NOW() - INTERVAL 1 DAY", fetch_one=True)
         total_users = res['c'] if res else 0
-    elif filter_type == 'top':
-        users = execute_query(
-            "SELECT * FROM users ORDER BY total_earned DESC LIMIT %s OFFSET %s",
-            (per_page, offset), fetch_all=True) or []
-        total_users = get_users_count()
     else:
-        users = get_all_users(limit=per_page, offset=offset)
         total_users = get_users_count()
 
-    total_pages = max(1, (total_users + per_page - 1) // per_page)
-
     # Normalise field names so template finds them
     for u in users:
         u.setdefault('longest_streak',     u.get('longest_streak', u.get('checkin_streak', 0)))
@@ -2680,8 +2883,8 @@ def admin_users():
     return render_template('admin_users.html',
         users=users,
         planes=planes,
-        page=page,
-        total_pages=total_pages,
+        next_cursor=pg['next_cursor'],
+        prev_cursor=pg['prev_cursor'],
         total_users=total_users,
         filter=filter_type,
         search=search,
@@ -2756,10 +2959,12 @@ def admin_api_user_history(user_id):
     from database import get_user_history_paginated
     category = request.args.get('category', 'all')
     page = max(1, int(request.args.get('page', 1)))
+    cursor = request.args.get('cursor', '') or None
     if category not in ('all', 'movements', 'withdrawals', 'deposits', 'referrals'):
         category = 'all'
     try:
-        data = get_user_history_paginated(user_id, category=category, page=page, per_page=100)
+        data = get_user_history_paginated(user_id, category=category, page=page,
+                                          per_page=100, cursor=cursor)
         # Info resumida del usuario
         u = get_user(user_id) or {}
         summary = {
@@ -2781,13 +2986,17 @@ def admin_api_user_history(user_id):
                 return int(r['c']) if r and r.get('c') is not None else 0
             except Exception as _e:
                 return f'ERR: {_e}'
-        debug = {
-            'balance_history': _c("SELECT COUNT(*) c FROM balance_history WHERE user_id=%s", (uid,)),
-            'withdrawals': _c("SELECT COUNT(*) c FROM withdrawals WHERE user_id=%s", (uid,)),
-            'ton_deposits': _c("SELECT COUNT(*) c FROM ton_deposits WHERE user_id=%s", (uid,)),
-            'referrals': _c("SELECT COUNT(*) c FROM referrals WHERE referrer_id=%s", (uid,)),
-        }
-        logger.info(f"[history-debug] user={uid} counts={debug} items={len(data.get('items', []))}")
+        # Solo al abrir el historial: en las paginas siguientes serian 4 COUNT
+        # por clic, que en una ballena cuestan mas que la propia pagina.
+        debug = None
+        if not cursor and page == 1:
+            debug = {
+                'balance_history': _c("SELECT COUNT(*) c FROM balance_history WHERE user_id=%s", (uid,)),
+                'withdrawals': _c("SELECT COUNT(*) c FROM withdrawals WHERE user_id=%s", (uid,)),
+                'ton_deposits': _c("SELECT COUNT(*) c FROM ton_deposits WHERE user_id=%s", (uid,)),
+                'referrals': _c("SELECT COUNT(*) c FROM referrals WHERE referrer_id=%s", (uid,)),
+            }
+            logger.info(f"[history-debug] user={uid} counts={debug} items={len(data.get('items', []))}")
         # 'history' es un alias de 'items' para compatibilidad con admin_users.html
         return jsonify({'success': True, 'summary': summary, 'history': data.get('items', []), 'debug': debug, **data})
     except Exception as e:
@@ -2859,6 +3068,7 @@ def admin_withdrawals():
 
 @app.route('/admin/spending')
 @require_admin
+@read_only_tolerant
 def admin_spending():
     """Panel de gastos en TON (retiros pagados): hoy, ayer, semana, mes, total."""
     from database import get_spending_stats, get_spending_history
@@ -2972,8 +3182,7 @@ def admin_delete_promo(code):
 def admin_config():
     """Admin configuration"""
     if request.method == 'POST':
-        for key, value in request.form.items():
-            set_config(key, value)
+        set_configs(dict(request.form.items()))
         return redirect(url_for('admin_config'))
     
     config = get_all_config()
@@ -3107,8 +3316,7 @@ def admin_config_save():
     if not data:
         return jsonify({'success': False, 'error': 'No data provided'})
     
-    for key, value in data.items():
-        set_config(key, value)
+    set_configs(data)
     
     return jsonify({'success': True})
 
@@ -3124,8 +3332,7 @@ def admin_reset_tasks():
 @require_admin
 def admin_clear_cache():
     """Clear verification cache"""
-    global _channel_cache
-    _channel_cache = {}
+    forget_channel_membership()
     return jsonify({'success': True})
 
 @app.route('/admin/user/<user_id>/ban', methods=['POST'])
@@ -3489,6 +3696,7 @@ def admin_api_reject_withdrawal():
 
 @app.route('/admin/multiaccounts')
 @require_admin
+@read_only_tolerant
 def admin_multiaccounts():
     """Panel de investigación de multicuentas por IP con buscador."""
     query = request.args.get('q', '').strip()
@@ -3598,6 +3806,46 @@ def admin_version():
     })
 
 
+@app.route('/admin/api/db/pool')
+@require_admin
+def admin_db_pool():
+    """Metricas del pool de conexiones de ESTE worker (espera, en uso, agotamientos),
+    de los reintentos por deadlock / lock wait timeout, de la cache de users y
+    del registro de IPs en diferido y del rate limiting."""
+    from database import (get_pool_stats, get_replica_stats, get_tx_retry_stats,
+                          get_user_cache_stats, get_ip_record_stats,
+                          get_multiaccount_scan_stats, get_rate_limit_stats)
+    try:
+        return jsonify({'pid': os.getpid(), 'pool': get_pool_stats(),
+                        'replica': get_replica_stats(),
+                        'tx_retries': get_tx_retry_stats(),
+                        'user_cache': get_user_cache_stats(),
+                        'ip_record': get_ip_record_stats(),
+                        'multiaccount_scan': get_multiaccount_scan_stats(),
+                        'rate_limit': get_rate_limit_stats()})
+    except Exception as e:
+        return jsonify({'error': str(e)})
+
+
+@app.route('/admin/api/db/queries')
+@require_admin
+def admin_db_queries():
+    """Top de sentencias SQL de ESTE worker por huella: llamadas, filas, p50/p99.
+    ?order=total_ms|count|p99_ms|max_ms|rows|errors  ?limit=N  ?reset=1"""
+    from database import get_query_stats, reset_query_stats
+    try:
+        limit = min(200, max(1, int(request.args.get('limit', 25))))
+    except ValueError:
+        limit = 25
+    try:
+        data = get_query_stats(limit=limit, order=request.args.get('order', 'total_ms'))
+        if request.args.get('reset') == '1':
+            reset_query_stats()
+        return jsonify({'pid': os.getpid(), 'queries': data})
+    except Exception as e:
+        return jsonify({'error': str(e)})
+
+
 @app.route('/admin/api/device-debug')
 @require_admin
 def admin_device_debug():
@@ -3912,9 +4160,14 @@ def admin_api_ban_ip_group():
             except Exception as _be:
                 logger.warning(f"[ban-ip-group] error baneando {uid}: {_be}")
 
-        # También bloquear la IP para futuros accesos
+        # También bloquear la IP para futuros accesos. Con "range": true se
+        # banea la red entera (/24 IPv4, /64 IPv6): rangos CGNAT, proxies...
         try:
-            ban_ip(ip, 'Multicuenta - baneo masivo')
+            objetivo = ip
+            if data.get('range'):
+                from database import ip_prefix_network
+                objetivo = ip_prefix_network(ip)
+            ban_ip(objetivo, 'Multicuenta - baneo masivo')
         except Exception:
             pass
 
@@ -4373,26 +4626,12 @@ def _bot_answer(callback_query_id, text="", alert=False):
     })
 
 
-def _check_member(user_id, channel):
-    ch = channel.strip()
-    if not ch.startswith('@'):
-        ch = f"@{ch}"
-    try:
-        r = requests.post(
-            f"https://api.telegram.org/bot{BOT_TOKEN}/getChatMember",
-            json={"chat_id": ch, "user_id": int(user_id)}, timeout=8
-        )
-        data = r.json()
-        if data.get('ok'):
-            status = data['result']['status']
-            return status in ('member','administrator','creator')
-    except Exception as e:
-        logger.warning(f"getChatMember error: {e}")
-    return True   # en caso de error, no bloqueamos
-
-
-def _check_all_channels(user_id):
-    missing = [ch for ch in _OFFICIAL_CHANNELS if ch and not _check_member(user_id, ch)]
+def _check_all_channels(user_id, recheck_negative=False):
+    """Canales oficiales que le faltan al usuario, consultados en paralelo.
+    Si Telegram falla para un canal, no se bloquea por ese canal."""
+    estado = check_channels(user_id, _OFFICIAL_CHANNELS, recheck_negative)
+    missing = [ch for ch in _OFFICIAL_CHANNELS if ch
+               and estado.get(_normalize_channel(ch), (None,))[0] is False]
     return len(missing) == 0, missing
 
 
@@ -4570,6 +4809,7 @@ def _handle_start(msg):
                         "UPDATE users SET referred_by=%s WHERE user_id=%s "
                         "AND (referred_by IS NULL OR referred_by='')",
                         (str(referrer_id), str(user_id)))
+                    invalidate_user(user_id)
                 add_referral(referrer_id, user_id, username, first_name)
                 logger.info(f"[ref] {user_id} registrado como referido de {referrer_id}")
             elif str(_actual) == str(referrer_id):
@@ -4645,7 +4885,7 @@ def _handle_callback(cq):
 
     if data == 'verify_channels':
         if _OFFICIAL_CHANNELS:
-            ok, missing = _check_all_channels(user_id)
+            ok, missing = _check_all_channels(user_id, recheck_negative=True)
         else:
             ok, missing = True, []
 
@@ -5151,14 +5391,9 @@ def _background_deposit_scanner():
         try:
             receiver = (get_config('ton_wallet_address', '') or os.getenv('TON_BOT_WALLET_ADDRESS', ''))
             if receiver and 'AQUI' not in receiver and get_config('ton_deposits_enabled', '1') == '1':
-                from database import execute_query as _eq
+                from database import execute_query as _eq, PENDING_DEPOSITS_SQL
                 # Depósitos pendientes de las últimas 24h
-                pendings = _eq(
-                    "SELECT deposit_id, user_id FROM ton_deposits "
-                    "WHERE status='pending' AND created_at >= NOW() - INTERVAL 1 DAY "
-                    "ORDER BY created_at DESC LIMIT 50",
-                    fetch_all=True
-                ) or []
+                pendings = _eq(PENDING_DEPOSITS_SQL, fetch_all=True) or []
                 for p in pendings:
                     try:
                         _scan_and_credit_deposit(p['user_id'], p['deposit_id'])
@@ -5211,6 +5446,146 @@ def _background_expired_plans_settler():
 _threading.Thread(target=_background_expired_plans_settler, daemon=True).start()
 
 
+def _background_stats_compactor():
+    """
+    Compacta los contadores repartidos (stats_shards) en la fila base de
+    `stats` cada 10 minutos, para que get_all_stats() sume pocas filas.
+    Solo un worker lo ejecuta (file lock), igual que los otros barridos.
+    """
+    import time, tempfile
+    time.sleep(40)
+
+    lock_path = os.path.join(tempfile.gettempdir(), f'{APP_NAME}_stats_compactor.lock')
+    try:
+        import fcntl
+        lock_file = open(lock_path, 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        logger.info("[STATS] otro worker compacta los contadores, saltando.")
+        return
+
+    from database import compact_stat_shards, STATS_SHARDS
+    if STATS_SHARDS <= 1:
+        return
+    logger.info("[STATS] compactacion de contadores activa (cada 10 min).")
+    while True:
+        try:
+            movido = compact_stat_shards()
+            if movido:
+                logger.info(f"[STATS] compactados: {movido}")
+        except Exception as e:
+            logger.warning(f"[STATS] error compactando: {e}")
+        time.sleep(600)
+
+_threading.Thread(target=_background_stats_compactor, daemon=True).start()
+
+
+def _background_multiaccount_scanner():
+    """
+    Escaneo multicuenta incremental (antes se hacía en cada petición de
+    require_user). Cada MULTIACCOUNT_SCAN_SECONDS mira solo las IPs con
+    actividad nueva y re-evalúa a los usuarios de las que cambiaron de
+    número de cuentas. Solo un worker lo ejecuta (file lock).
+    """
+    import time, tempfile
+    time.sleep(50)
+
+    lock_path = os.path.join(tempfile.gettempdir(), f'{APP_NAME}_multiaccount_scanner.lock')
+    try:
+        import fcntl
+        lock_file = open(lock_path, 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        logger.info("[ANTI-FRAUD] otro worker corre el escaneo multicuenta, saltando.")
+        return
+
+    from database import scan_multiaccount_changes, MULTIACCOUNT_SCAN_SECONDS
+    logger.info(f"[ANTI-FRAUD] escaneo multicuenta incremental activo (cada {MULTIACCOUNT_SCAN_SECONDS:.0f}s).")
+    while True:
+        try:
+            begin_request_scope()
+            try:
+                scan_multiaccount_changes()
+            finally:
+                end_request_scope()
+        except Exception as e:
+            logger.warning(f"[ANTI-FRAUD] error en el escaneo multicuenta: {e}")
+        time.sleep(MULTIACCOUNT_SCAN_SECONDS)
+
+_threading.Thread(target=_background_multiaccount_scanner, daemon=True).start()
+
+
+def _background_backfills():
+    """
+    Rellenos de datos largos (backfill() por tramos de PK) fuera del import:
+    en _run_migrations() tendrian tomado el lock de migraciones y a los demas
+    workers esperando. Cada vuelta avanza como mucho 60s y se retoma por
+    backfill_progress hasta terminar. Solo un worker lo ejecuta (file lock).
+    """
+    import time, tempfile
+    time.sleep(40)
+
+    lock_path = os.path.join(tempfile.gettempdir(), f'{APP_NAME}_backfills.lock')
+    try:
+        import fcntl
+        lock_file = open(lock_path, 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        logger.info("[BACKFILL] otro worker ejecuta los rellenos, saltando.")
+        return
+
+    from database import _migrate_existing_fraud_referrals
+    pendientes = [_migrate_existing_fraud_referrals]
+    while pendientes:
+        for paso in list(pendientes):
+            try:
+                if paso():
+                    pendientes.remove(paso)
+            except Exception as e:
+                logger.warning(f"[BACKFILL] error en {paso.__name__}: {e}")
+        if pendientes:
+            time.sleep(30)
+    logger.info("[BACKFILL] rellenos terminados.")
+
+
+_threading.Thread(target=_background_backfills, daemon=True).start()
+
+
+def _background_leaderboard_refresher():
+    """
+    Recalcula las clasificaciones de /explore cada LEADERBOARD_REFRESH_SECONDS
+    y las deja en la tabla leaderboards para todos los workers. Solo un
+    worker lo ejecuta (file lock).
+    """
+    import time, tempfile
+    time.sleep(20)
+
+    lock_path = os.path.join(tempfile.gettempdir(), f'{APP_NAME}_leaderboard_refresher.lock')
+    try:
+        import fcntl
+        lock_file = open(lock_path, 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        logger.info("[LEADERBOARD] otro worker refresca las clasificaciones, saltando.")
+        return
+
+    from database import refresh_leaderboards, LEADERBOARD_REFRESH_SECONDS
+    logger.info(f"[LEADERBOARD] refresco de clasificaciones activo (cada {LEADERBOARD_REFRESH_SECONDS:.0f}s).")
+    while True:
+        try:
+            begin_request_scope()
+            try:
+                refresh_leaderboards()
+            finally:
+                end_request_scope()
+        except Exception as e:
+            logger.warning(f"[LEADERBOARD] error refrescando clasificaciones: {e}")
+        time.sleep(LEADERBOARD_REFRESH_SECONDS)
+
+
+_threading.Thread(target=_background_leaderboard_refresher, daemon=True).start()
+
+
 
 # ============================================
 # RUN
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+check_indexes.py — EXPLAIN de las consultas calientes (database.HOT_QUERIES).
+
+Falla (exit 1) si alguna hace un full table scan: o falta el indice en
+_run_migrations() o la consulta dejo de ser sargable (DATE(col) = ...,
+funciones sobre la columna, LIKE '%x', etc.).
+
+Uso:  cd /var/www/aeroflex && ./venv/bin/python check_indexes.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from dotenv import load_dotenv
+load_dotenv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '.env'))
+
+from database import explain_hot_queries
+
+print("=" * 60)
+print(" EXPLAIN DE CONSULTAS CALIENTES")
+print("=" * 60)
+
+fallos = 0
+for r in explain_hot_queries():
+    marca = "OK " if r['ok'] else "MAL"
+    print(f"\n[{marca}] {r['name']}")
+    if r.get('error'):
+        print(f"      error: {r['error']}")
+    for p in r['plan']:
+        print(f"      {p['table']}: type={p['type']} key={p['key']} rows={p['rows']} {p['Extra'] or ''}")
+    if not r['ok']:
+        fallos += 1
+        if r['full_scans']:
+            print(f"      full scan en: {', '.join(str(t) for t in r['full_scans'])}")
+
+print("\n" + "=" * 60)
+if fallos:
+    print(f" {fallos} consulta(s) sin indice")
+    sys.exit(1)
+print(" Todas las consultas calientes usan indice")
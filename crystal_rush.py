@@ -28,17 +28,19 @@ import random
 import secrets
 import hashlib
 import logging
-import contextlib
 from functools import wraps
 from datetime import datetime, timezone
-from decimal import Decimal
 
 from flask import (
     Blueprint, render_template, request, jsonify,
     session, redirect, url_for
 )
 
-from database import get_connection, execute_query, get_user, get_config, set_config
+from database import (
+    execute_query, execute_update_rowcount, unit_of_work, update_balance, get_user,
+    get_config, set_configs, config_defaults_seeded, read_only_tolerant, retry_transaction,
+    rate_limit_hit,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -268,41 +270,28 @@ def init_crystal_rush():
     for a in _alts:
         _safe_exec(a)
 
+    inserted = 0
     for k, v in CONFIG_DEFAULTS.items():
-        _safe_exec(
-            "INSERT IGNORE INTO config (config_key, config_value) VALUES (%s, %s)",
-            (k, v)
-        )
+        try:
+            inserted += execute_update_rowcount(
+                "INSERT IGNORE INTO config (config_key, config_value) VALUES (%s, %s)",
+                (k, v)
+            ) or 0
+        except Exception:
+            pass
+    config_defaults_seeded(inserted)
     logger.info("[crystal_rush] v2 tablas + columnas + config listas")
 
 
-@contextlib.contextmanager
 def _tx():
-    """Transacción explícita con cursor dict. Hace rollback ante error."""
-    conn = get_connection()
-    cur = None
-    try:
-        conn.autocommit = False
-        cur = conn.cursor(dictionary=True)
-        yield conn, cur
-        conn.commit()
-    except Exception:
-        try:
-            conn.rollback()
-        except Exception:
-            pass
-        raise
-    finally:
-        if cur:
-            try:
-                cur.close()
-            except Exception:
-                pass
-        try:
-            conn.autocommit = True
-        except Exception:
-            pass
-        conn.close()
+    """Transacción explícita con cursor dict. Hace rollback ante error.
+
+    Usa la unit_of_work de database.py: dentro de una petición comparte la
+    conexión con los demás helpers (get_config, execute_query) en vez de
+    sacar otra del pool mientras esta sigue retenida. Las vistas que la usan
+    van con @retry_transaction: un deadlock repite la vista entera.
+    """
+    return unit_of_work()
 
 
 def _loads(v, default):
@@ -708,6 +697,28 @@ def _require_user(f):
     return wrap
 
 
+def _rate_limit(max_calls, window_seconds):
+    """Limite global por usuario (tabla rate_limits, comun a todos los workers).
+    Va debajo de _require_user y encima de retry_transaction: un reintento
+    por deadlock no cuenta como otra peticion."""
+    def deco(f):
+        @wraps(f)
+        def wrap(user, *a, **k):
+            try:
+                ok, espera = rate_limit_hit(f"mine:{f.__name__}:{user['user_id']}",
+                                            max_calls, window_seconds)
+            except Exception as e:
+                logger.warning(f"[RATE-LIMIT] error (deja pasar): {e}")
+                ok = True
+            if not ok:
+                espera = int(espera) + 1
+                return jsonify({'success': False, 'error': 'rate_limited',
+                                'retry_after': espera}), 429
+            return f(user, *a, **k)
+        return wrap
+    return deco
+
+
 def _require_admin(f):
     @wraps(f)
     def wrap(*a, **k):
@@ -792,6 +803,8 @@ def _apply_xp(upg, gain):
 
 @crystal_rush_bp.route('/api/mine/start', methods=['POST'])
 @_require_user
+@_rate_limit(10, 60)
+@retry_transaction
 def api_start(user):
     if not _enabled():
         return jsonify({'success': False, 'error': 'disabled'})
@@ -830,6 +843,8 @@ def api_start(user):
 
 @crystal_rush_bp.route('/api/mine/tap', methods=['POST'])
 @_require_user
+@_rate_limit(20, 2)
+@retry_transaction
 def api_tap(user):
     if not _enabled():
         return jsonify({'success': False, 'error': 'disabled'})
@@ -1110,6 +1125,8 @@ def _write_upg_progress(cur, uid, upg, energy, eu, d_min, d_dia, d_tre,
 
 @crystal_rush_bp.route('/api/mine/dynamite', methods=['POST'])
 @_require_user
+@_rate_limit(10, 10)
+@retry_transaction
 def api_dynamite(user):
     if not _enabled():
         return jsonify({'success': False, 'error': 'disabled'})
@@ -1213,6 +1230,8 @@ def api_dynamite(user):
 
 @crystal_rush_bp.route('/api/mine/sell', methods=['POST'])
 @_require_user
+@_rate_limit(20, 60)
+@retry_transaction
 def api_sell(user):
     uid = str(user['user_id'])
     with _tx() as (conn, cur):
@@ -1271,6 +1290,8 @@ def api_sell(user):
 
 @crystal_rush_bp.route('/api/mine/upgrade', methods=['POST'])
 @_require_user
+@_rate_limit(20, 60)
+@retry_transaction
 def api_upgrade(user):
     uid = str(user['user_id'])
     data = request.get_json(silent=True) or {}
@@ -1314,6 +1335,8 @@ def api_upgrade(user):
 
 @crystal_rush_bp.route('/api/mine/repair', methods=['POST'])
 @_require_user
+@_rate_limit(20, 60)
+@retry_transaction
 def api_repair(user):
     uid = str(user['user_id'])
     cost = int(float(get_config('mine_pickaxe_repair_cost', '50')))
@@ -1344,6 +1367,8 @@ def api_repair(user):
 
 @crystal_rush_bp.route('/api/mine/buy-dynamite', methods=['POST'])
 @_require_user
+@_rate_limit(20, 60)
+@retry_transaction
 def api_buy_dynamite(user):
     uid = str(user['user_id'])
     cost = int(float(get_config('mine_dynamite_cost', '300')))
@@ -1379,6 +1404,8 @@ def api_buy_dynamite(user):
 
 @crystal_rush_bp.route('/api/mine/prestige', methods=['POST'])
 @_require_user
+@_rate_limit(20, 60)
+@retry_transaction
 def api_prestige(user):
     uid = str(user['user_id'])
     with _tx() as (conn, cur):
@@ -1411,6 +1438,8 @@ def api_prestige(user):
 
 @crystal_rush_bp.route('/api/mine/claim-mission', methods=['POST'])
 @_require_user
+@_rate_limit(20, 60)
+@retry_transaction
 def api_claim_mission(user):
     uid = str(user['user_id'])
     data = request.get_json(silent=True) or {}
@@ -1446,6 +1475,8 @@ def api_claim_mission(user):
 
 @crystal_rush_bp.route('/api/mine/claim-ach', methods=['POST'])
 @_require_user
+@_rate_limit(20, 60)
+@retry_transaction
 def api_claim_ach(user):
     uid = str(user['user_id'])
     data = request.get_json(silent=True) or {}
@@ -1507,6 +1538,7 @@ def api_stats(user):
 
 @crystal_rush_bp.route('/api/mine/leaderboard')
 @_require_user
+@read_only_tolerant
 def api_leaderboard(user):
     uid = str(user['user_id'])
     rich = execute_query(
@@ -1544,6 +1576,8 @@ def api_leaderboard(user):
 
 @crystal_rush_bp.route('/api/mine/convert', methods=['POST'])
 @_require_user
+@_rate_limit(20, 60)
+@retry_transaction
 def api_convert(user):
     uid = str(user['user_id'])
     data = request.get_json(silent=True) or {}
@@ -1576,21 +1610,9 @@ def api_convert(user):
         if cur.rowcount == 0:
             return jsonify({'success': False, 'error': 'insufficient'})
 
-        cur.execute("SELECT doge_balance FROM users WHERE user_id=%s FOR UPDATE", (uid,))
-        urow = cur.fetchone()
-        before = Decimal(str(urow['doge_balance'] or 0))
-        after = before + Decimal(str(ton))
-        cur.execute("UPDATE users SET doge_balance=%s, total_earned=total_earned+%s WHERE user_id=%s",
-                    (float(after), float(ton), uid))
-        try:
-            cur.execute(
-                "INSERT INTO balance_history (user_id, action, amount, balance_before, "
-                "balance_after, description) VALUES (%s,'mine_convert',%s,%s,%s,%s)",
-                (uid, float(ton), float(before), float(after),
-                 'Crystal Rush: %s GEM -> %s TON' % (amount, ton))
-            )
-        except Exception:
-            pass
+        # Abono + historial en el mismo round trip, dentro de esta transacción
+        update_balance(uid, ton, 'mine_convert',
+                       'Crystal Rush: %s GEM -> %s TON' % (amount, ton))
         cur.execute("INSERT INTO mine_conversions (user_id, gem_amount, ton_amount, rate) "
                     "VALUES (%s,%s,%s,%s)", (uid, amount, ton, rate))
         cur.execute("SELECT * FROM mine_upgrades WHERE user_id=%s", (uid,))
@@ -1618,6 +1640,7 @@ def grant_dynamite(user_id, n=1):
 
 @crystal_rush_bp.route('/admin/mine')
 @_require_admin
+@read_only_tolerant
 def admin_mine():
     stats = execute_query(
         "SELECT COUNT(*) AS players, COALESCE(SUM(gem_total_earned),0) AS gem_earned, "
@@ -1663,9 +1686,11 @@ def admin_mine_config():
               'mine_pickaxe_repair_cost', 'mine_dynamite_cost',
               'mine_energy_regen_sec', 'mine_treasure_min',
               'mine_treasure_max', 'mine_prestige_req']
+    cambios = {}
     for f in fields:
         v = request.form.get(f)
         if v is not None and v != '':
-            set_config(f, v)
-    set_config('mine_enabled', '1' if request.form.get('mine_enabled') == 'on' else '0')
+            cambios[f] = v
+    cambios['mine_enabled'] = '1' if request.form.get('mine_enabled') == 'on' else '0'
+    set_configs(cambios)
     return redirect(url_for('crystal_rush.admin_mine'))
@@ -4,12 +4,25 @@ Clean, optimized DOGE-only database layer
 """
 
 import os
+import re
+import array
+import atexit
+import bisect
 import json
+import base64
+import random
 import logging
+import time
+import threading
+import contextlib
+import functools
+import collections
+import heapq
+import itertools
+import ipaddress
 from datetime import datetime, date, timedelta
 from decimal import Decimal
 import mysql.connector
-from mysql.connector import pooling
 
 logger = logging.getLogger(__name__)
 
@@ -30,8 +43,6 @@ def _build_db_config():
             'charset':   'utf8mb4',
             'collation': 'utf8mb4_unicode_ci',
             'autocommit': True,
-            'pool_name': 'dogepixel_pool',
-            'pool_size': 5,
         }
     # Fallback: individual env vars (PythonAnywhere / manual)
     return {
@@ -43,57 +54,989 @@ def _build_db_config():
         'charset':   'utf8mb4',
         'collation': 'utf8mb4_unicode_ci',
         'autocommit': True,
-        'pool_name': 'dogepixel_pool',
-        'pool_size': 5,
     }
 
-DB_CONFIG = _build_db_config()
+# DB_BACKEND=sqlite usa el backend embebido de db_sqlite.py (benchmarks/CI
+# locales sin MySQL). En produccion siempre 'mysql'.
+DB_BACKEND = os.environ.get('DB_BACKEND', 'mysql').strip().lower()
+SQLITE_PATH = os.environ.get('SQLITE_PATH', 'dogepixel.sqlite3')
+
+if DB_BACKEND == 'sqlite':
+    import db_sqlite
+    DB_CONFIG = {'database': SQLITE_PATH, 'autocommit': True}
+else:
+    DB_CONFIG = _build_db_config()
+
+def _build_replica_config():
+    """Replica de lectura opcional (MYSQL_REPLICA_URL o DB_REPLICA_HOST).
+    Lo que no venga en la URL se hereda del primario."""
+    import urllib.parse
+    if DB_BACKEND == 'sqlite':
+        return None
+    url = os.environ.get('MYSQL_REPLICA_URL') or os.environ.get('DB_REPLICA_URL', '')
+    cfg = dict(DB_CONFIG)
+    if url and url.startswith('mysql'):
+        parsed = urllib.parse.urlparse(url)
+        cfg.update({
+            'host':     parsed.hostname,
+            'port':     parsed.port or 3306,
+            'user':     parsed.username or cfg['user'],
+            'password': parsed.password if parsed.password is not None else cfg['password'],
+            'database': parsed.path.lstrip('/') or cfg['database'],
+        })
+        return cfg
+    if os.environ.get('DB_REPLICA_HOST'):
+        cfg['host'] = os.environ['DB_REPLICA_HOST']
+        cfg['port'] = int(os.environ.get('DB_REPLICA_PORT', cfg['port']))
+        return cfg
+    return None
+
+REPLICA_CONFIG = _build_replica_config()
+
+def _env_num(name, default, cast=int):
+    try:
+        return cast(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return cast(default)
+
+
+# Pool configurable por entorno (por worker de gunicorn):
+#   DB_POOL_SIZE          conexiones que se mantienen abiertas
+#   DB_POOL_MAX_OVERFLOW  extra temporales en picos (se cierran al devolverlas)
+#   DB_POOL_TIMEOUT       segundos que espera un checkout antes de fallar
+#   DB_POOL_RECYCLE       edad maxima de una conexion (segundos, 0 = nunca)
+#   DB_POOL_PING_AFTER    si lleva mas de N seg ociosa, ping antes de usarla
+POOL_CONFIG = {
+    'size':         max(1, _env_num('DB_POOL_SIZE', 5)),
+    'max_overflow': max(0, _env_num('DB_POOL_MAX_OVERFLOW', 5)),
+    'timeout':      max(0.0, _env_num('DB_POOL_TIMEOUT', 10, float)),
+    'recycle':      max(0, _env_num('DB_POOL_RECYCLE', 1800)),
+    'ping_after':   max(0, _env_num('DB_POOL_PING_AFTER', 30)),
+}
+
+
+class PoolTimeout(mysql.connector.errors.PoolError):
+    """No se libero ninguna conexion dentro de DB_POOL_TIMEOUT."""
+
+
+class _PooledConnection:
+    """Envuelve una conexion de mysql-connector: close() la devuelve al pool."""
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+        self._created = time.monotonic()
+        self._last_used = self._created
+        self._checked_out = False
+        self._lock_wait = None    # innodb_lock_wait_timeout de sesion (None = global)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def close(self):
+        if self._checked_out:
+            self._checked_out = False
+            self._pool._checkin(self)
+
+    def _really_close(self):
+        try:
+            self._raw.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """Pool con checkout bloqueante, overflow, reciclado y metricas.
+
+    El pool de mysql-connector lanzaba PoolError en cuanto se agotaba: un
+    pico en /api/mine/tap (que retiene la conexion todo el _tx()) tumbaba
+    al resto de endpoints del worker. Aqui el checkout espera hasta
+    `timeout` segundos a que alguien devuelva una conexion.
+    """
+
+    def __init__(self, conn_args, size=5, max_overflow=5, timeout=10.0,
+                 recycle=1800, ping_after=30, name='primary'):
+        self.name = name
+        self._args = dict(conn_args)
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self._idle = collections.deque()
+        self._open = 0
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            'checkouts': 0, 'waits': 0, 'wait_time_total': 0.0,
+            'wait_time_max': 0.0, 'exhausted': 0, 'created': 0,
+            'recycled': 0, 'ping_failures': 0, 'overflow_closed': 0,
+            'max_in_use': 0,
+        }
+
+    def _connect(self):
+        if DB_BACKEND == 'sqlite':
+            raw = db_sqlite.connect(**self._args)
+        else:
+            raw = mysql.connector.connect(**self._args)
+        self._stats['created'] += 1
+        return _PooledConnection(self, raw)
+
+    def _usable(self, pc, now):
+        """Descarta conexiones viejas o muertas antes de entregarlas."""
+        if self.recycle and now - pc._created > self.recycle:
+            self._stats['recycled'] += 1
+            return False
+        if self.ping_after and now - pc._last_used > self.ping_after:
+            try:
+                pc._raw.ping(reconnect=False)
+            except Exception:
+                self._stats['ping_failures'] += 1
+                return False
+        return True
+
+    def get_connection(self):
+        t0 = time.monotonic()
+        deadline = t0 + self.timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._idle:
+                    pc = self._idle.pop()
+                    break
+                if self._open < self.size + self.max_overflow:
+                    self._open += 1
+                    pc = None
+                    break
+                restante = deadline - time.monotonic()
+                if restante <= 0:
+                    self._stats['exhausted'] += 1
+                    logger.warning(
+                        f"[DB-POOL] {self.name} agotado: {self._in_use} en uso, "
+                        f"espera > {self.timeout}s"
+                    )
+                    raise PoolTimeout(
+                        f"Pool '{self.name}' exhausted after {self.timeout}s "
+                        f"({self._in_use} in use)"
+                    )
+                waited = True
+                self._cond.wait(restante)
+            self._in_use += 1
+            self._stats['checkouts'] += 1
+            if self._in_use > self._stats['max_in_use']:
+                self._stats['max_in_use'] = self._in_use
+            if waited:
+                espera = time.monotonic() - t0
+                self._stats['waits'] += 1
+                self._stats['wait_time_total'] += espera
+                if espera > self._stats['wait_time_max']:
+                    self._stats['wait_time_max'] = espera
+
+        # Conectar / validar FUERA del lock (son round trips a la red)
+        try:
+            if pc is not None and not self._usable(pc, time.monotonic()):
+                pc._really_close()
+                pc = None
+            if pc is None:
+                pc = self._connect()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        pc._checked_out = True
+        return pc
+
+    def _checkin(self, pc):
+        keep = True
+        try:
+            # Nunca devolver una transaccion a medias al pool
+            if pc._raw.in_transaction:
+                pc._raw.rollback()
+            # Un reintento de retry_transaction deja el lock wait corto en la
+            # sesion: el siguiente que use la conexion debe ver el global
+            if pc._lock_wait is not None:
+                _apply_lock_wait(pc, None)
+        except Exception:
+            keep = False
+        pc._last_used = time.monotonic()
+        with self._cond:
+            self._in_use -= 1
+            if keep and len(self._idle) < self.size:
+                self._idle.append(pc)
+                pc = None
+            else:
+                self._open -= 1
+                if keep:
+                    self._stats['overflow_closed'] += 1
+            self._cond.notify()
+        if pc is not None:
+            pc._really_close()
+
+    def stats(self):
+        with self._cond:
+            out = dict(self._stats)
+            out.update({
+                'name': self.name,
+                'size': self.size,
+                'max_overflow': self.max_overflow,
+                'timeout': self.timeout,
+                'open': self._open,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+            })
+        out['wait_time_avg'] = (out['wait_time_total'] / out['waits']) if out['waits'] else 0.0
+        return out
+
 
 # Connection Pool
 _pool = None
+_pool_lock = threading.Lock()
 
 def get_pool():
     """Get or create connection pool"""
     global _pool
     if _pool is None:
-        try:
-            _pool = pooling.MySQLConnectionPool(**DB_CONFIG)
-            logger.info("Database pool created successfully")
-        except Exception as e:
-            logger.error(f"Failed to create pool: {e}")
-            raise
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    DB_CONFIG,
+                    size=POOL_CONFIG['size'],
+                    max_overflow=POOL_CONFIG['max_overflow'],
+                    timeout=POOL_CONFIG['timeout'],
+                    recycle=POOL_CONFIG['recycle'],
+                    ping_after=POOL_CONFIG['ping_after'],
+                )
+                logger.info(
+                    f"Database pool created (size={POOL_CONFIG['size']}, "
+                    f"overflow={POOL_CONFIG['max_overflow']}, timeout={POOL_CONFIG['timeout']}s)"
+                )
     return _pool
 
+
+def get_pool_stats():
+    """Metricas del pool de este worker (para /admin/api/db/pool)."""
+    return get_pool().stats()
+
 def get_connection():
     """Get connection from pool"""
     return get_pool().get_connection()
 
+
+# ============================================
+# REPLICA DE LECTURA
+# ============================================
+# Los paneles de admin y los rankings hacen escaneos y GROUP BY enteros sobre
+# users/ip_logs; en el primario competian con las escrituras de saldo. Si hay
+# replica configurada, las LECTURAS (fetch_one/fetch_all) hechas dentro de
+# read_only() o de una funcion @read_only_tolerant van a ella, siempre que
+# su retraso sea <= DB_REPLICA_MAX_LAG segundos. Si no hay replica, va con
+# retraso, no responde o estamos dentro de una unit_of_work: primario.
+# Las escrituras nunca se enrutan a la replica.
+
+REPLICA_MAX_LAG = max(0.0, _env_num('DB_REPLICA_MAX_LAG', 5, float))
+REPLICA_LAG_CHECK = max(0.5, _env_num('DB_REPLICA_LAG_CHECK', 5, float))
+REPLICA_RETRY_AFTER = max(1.0, _env_num('DB_REPLICA_RETRY_AFTER', 30, float))
+
+_replica_pool = None
+_replica_state = {
+    'healthy': True, 'lag': None, 'checked_at': 0.0, 'down_until': 0.0,
+    'reads': 0, 'fallbacks': 0, 'lag_rejections': 0, 'errors': 0,
+}
+_replica_check_lock = threading.Lock()
+
+
+def get_replica_pool():
+    """Pool de la replica, o None si no hay ninguna configurada."""
+    global _replica_pool
+    if REPLICA_CONFIG is None:
+        return None
+    if _replica_pool is None:
+        with _pool_lock:
+            if _replica_pool is None:
+                _replica_pool = ConnectionPool(
+                    REPLICA_CONFIG,
+                    size=POOL_CONFIG['size'],
+                    max_overflow=POOL_CONFIG['max_overflow'],
+                    # Mejor caer al primario que esperar a la replica
+                    timeout=min(POOL_CONFIG['timeout'], 2.0),
+                    recycle=POOL_CONFIG['recycle'],
+                    ping_after=POOL_CONFIG['ping_after'],
+                    name='replica',
+                )
+                logger.info(f"Replica pool created (host={REPLICA_CONFIG['host']}, "
+                            f"max_lag={REPLICA_MAX_LAG}s)")
+    return _replica_pool
+
+
+def _mark_replica_down(err):
+    _replica_state['healthy'] = False
+    _replica_state['errors'] += 1
+    _replica_state['down_until'] = time.monotonic() + REPLICA_RETRY_AFTER
+    logger.warning(f"[DB-REPLICA] sin servicio {REPLICA_RETRY_AFTER:.0f}s, lecturas al primario: {err}")
+
+
+def _replica_lag(pool):
+    """Segundos de retraso de la replica (None = replicacion parada)."""
+    conn = pool.get_connection()
+    cur = None
+    try:
+        cur = conn.cursor(dictionary=True)
+        try:
+            cur.execute("SHOW REPLICA STATUS")
+        except mysql.connector.Error:
+            cur.execute("SHOW SLAVE STATUS")   # MySQL < 8.0.22
+        row = cur.fetchone()
+        if not row:
+            # No es una replica clasica (proxy de lectura, etc.): sin dato de lag
+            return 0.0
+        lag = row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))
+        return None if lag is None else float(lag)
+    finally:
+        if cur:
+            try:
+                cur.close()
+            except Exception:
+                pass
+        conn.close()
+
+
+def _replica_available():
+    pool = get_replica_pool()
+    if pool is None:
+        return False
+    st = _replica_state
+    now = time.monotonic()
+    if now < st['down_until']:
+        return False
+    # Solo un hilo mide el lag; el resto usa el ultimo resultado
+    if now - st['checked_at'] >= REPLICA_LAG_CHECK and _replica_check_lock.acquire(False):
+        try:
+            st['checked_at'] = now
+            try:
+                st['lag'] = _replica_lag(pool) if REPLICA_MAX_LAG else 0.0
+                st['healthy'] = True
+            except Exception as e:
+                _mark_replica_down(e)
+                return False
+        finally:
+            _replica_check_lock.release()
+    if not st['healthy']:
+        return False
+    if REPLICA_MAX_LAG and (st['lag'] is None or st['lag'] > REPLICA_MAX_LAG):
+        st['lag_rejections'] += 1
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def read_only():
+    """Las lecturas de este bloque toleran datos con hasta DB_REPLICA_MAX_LAG s
+    de retraso y pueden ir a la replica."""
+    _local.read_only = getattr(_local, 'read_only', 0) + 1
+    try:
+        yield
+    finally:
+        _local.read_only -= 1
+
+
+def read_only_tolerant(fn):
+    """Decorador: ejecuta `fn` dentro de read_only()."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with read_only():
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def get_replica_stats():
+    """Estado del enrutado a la replica de este worker (None si no hay replica)."""
+    pool = get_replica_pool()
+    if pool is None:
+        return None
+    st = dict(_replica_state)
+    st.pop('checked_at', None)
+    st['down'] = time.monotonic() < st.pop('down_until')
+    st['max_lag'] = REPLICA_MAX_LAG
+    st['pool'] = pool.stats()
+    return st
+
+
+# ============================================
+# INSTRUMENTACION DE CONSULTAS
+# ============================================
+# Cada sentencia se normaliza a una huella (literales -> ?, listas IN y
+# VALUES colapsadas) y se acumulan por huella: llamadas, errores, filas y
+# una ventana de las ultimas latencias para p50/p99. Lo que tarde mas de
+# DB_SLOW_QUERY_MS va al logger 'database.slow' (huella y tiempo, nunca los
+# parametros). Es por worker: /admin/api/db/queries enseña el del proceso.
+
+SLOW_QUERY_MS = max(0.0, _env_num('DB_SLOW_QUERY_MS', 250, float))
+QUERY_SAMPLE_WINDOW = max(16, _env_num('DB_QUERY_SAMPLES', 256))
+_MAX_FINGERPRINTS = 2000
+
+slow_logger = logging.getLogger('database.slow')
+
+_FP_RULES = [
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'"), '?'),
+    (re.compile(r'"(?:[^"\\]|\\.)*"'), '?'),
+    (re.compile(r'\b0x[0-9a-fA-F]+\b'), '?'),
+    (re.compile(r'(?<![\w.@])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b'), '?'),
+    (re.compile(r'%s'), '?'),
+    (re.compile(r'\s+'), ' '),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?+)'),
+    (re.compile(r'(?:\(\?\+\)\s*,\s*)+\(\?\+\)'), '(?+)'),
+    (re.compile(r'(?:\bWHEN \? THEN \? ?)+', re.IGNORECASE), 'WHEN ? THEN ? '),
+]
+
+_fp_cache = {}
+_query_stats = {}
+_query_lock = threading.Lock()
+
+
+def fingerprint_query(query):
+    """Huella estable de una sentencia: mismas consultas con distintos literales
+    o distinto numero de elementos en IN/VALUES comparten huella."""
+    fp = _fp_cache.get(query)
+    if fp is None:
+        fp = query
+        for rx, repl in _FP_RULES:
+            fp = rx.sub(repl, fp)
+        fp = fp.strip()
+        if len(_fp_cache) >= _MAX_FINGERPRINTS * 4:
+            _fp_cache.clear()
+        _fp_cache[query] = fp
+    return fp
+
+
+class _QueryStat:
+    __slots__ = ('count', 'errors', 'rows', 'total_ms', 'max_ms', 'slow', 'samples')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.slow = 0
+        self.samples = collections.deque(maxlen=QUERY_SAMPLE_WINDOW)
+
+
+def _record_query(query, started, rows=0, error=False):
+    """Registra una ejecucion. `started` viene de time.perf_counter()."""
+    ms = (time.perf_counter() - started) * 1000.0
+    fp = fingerprint_query(query)
+    with _query_lock:
+        st = _query_stats.get(fp)
+        if st is None:
+            if len(_query_stats) >= _MAX_FINGERPRINTS:
+                fp = '<otras>'
+                st = _query_stats.setdefault(fp, _QueryStat())
+            else:
+                st = _query_stats[fp] = _QueryStat()
+        st.count += 1
+        st.total_ms += ms
+        st.samples.append(ms)
+        if ms > st.max_ms:
+            st.max_ms = ms
+        if rows and rows > 0:
+            st.rows += rows
+        if error:
+            st.errors += 1
+        slow = SLOW_QUERY_MS and ms >= SLOW_QUERY_MS
+        if slow:
+            st.slow += 1
+    if slow:
+        slow_logger.warning(f"[slow-query] {ms:.1f} ms rows={rows} :: {fp[:500]}")
+    return fp
+
+
+def _add_rows(fp, rows):
+    """Suma filas leidas despues de registrar la ejecucion (fetch diferido)."""
+    if not rows:
+        return
+    with _query_lock:
+        st = _query_stats.get(fp)
+        if st is not None:
+            st.rows += rows
+
+
+def _percentile(sorted_vals, pct):
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, int(round(pct / 100.0 * (len(sorted_vals) - 1)))))
+    return sorted_vals[k]
+
+
+def get_query_stats(limit=25, order='total_ms'):
+    """Top huellas de este worker ordenadas por `order`
+    (total_ms, count, p99_ms, max_ms, rows, errors)."""
+    with _query_lock:
+        snap = [
+            (fp, st.count, st.errors, st.rows, st.total_ms, st.max_ms, st.slow, list(st.samples))
+            for fp, st in _query_stats.items()
+        ]
+    out = []
+    total_ms = 0.0
+    for fp, count, errors, rows, tot, mx, slow, samples in snap:
+        samples.sort()
+        total_ms += tot
+        out.append({
+            'fingerprint': fp,
+            'count': count,
+            'errors': errors,
+            'rows': rows,
+            'rows_avg': round(rows / count, 2) if count else 0,
+            'total_ms': round(tot, 2),
+            'avg_ms': round(tot / count, 3) if count else 0,
+            'p50_ms': round(_percentile(samples, 50), 3),
+            'p99_ms': round(_percentile(samples, 99), 3),
+            'max_ms': round(mx, 3),
+            'slow': slow,
+        })
+    if order not in ('total_ms', 'count', 'p99_ms', 'max_ms', 'rows', 'errors', 'slow'):
+        order = 'total_ms'
+    out.sort(key=lambda r: r[order], reverse=True)
+    for r in out:
+        r['share'] = round(r['total_ms'] / total_ms, 4) if total_ms else 0
+    return {
+        'fingerprints': len(out),
+        'total_ms': round(total_ms, 2),
+        'slow_query_ms': SLOW_QUERY_MS,
+        'sample_window': QUERY_SAMPLE_WINDOW,
+        'top': out[:max(1, int(limit))],
+    }
+
+
+def reset_query_stats():
+    with _query_lock:
+        _query_stats.clear()
+
+
+class _TimedCursor:
+    """Cursor de unit_of_work(): mide execute/executemany y cuenta las filas
+    que se leen con fetch*. El resto se delega al cursor real."""
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._fp = None
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def execute(self, query, params=None, multi=False):
+        t0 = time.perf_counter()
+        try:
+            res = self._raw.execute(query, params or (), multi=multi) if multi \
+                else self._raw.execute(query, params or ())
+        except Exception:
+            _record_query(query, t0, error=True)
+            raise
+        self._fp = _record_query(query, t0, max(0, self._raw.rowcount or 0))
+        return res
+
+    def executemany(self, query, seq_params):
+        t0 = time.perf_counter()
+        try:
+            res = self._raw.executemany(query, seq_params)
+        except Exception:
+            _record_query(query, t0, error=True)
+            raise
+        self._fp = _record_query(query, t0, max(0, self._raw.rowcount or 0))
+        return res
+
+    def fetchone(self):
+        row = self._raw.fetchone()
+        if row is not None and self._fp:
+            _add_rows(self._fp, 1)
+        return row
+
+    def fetchall(self):
+        rows = self._raw.fetchall()
+        if self._fp:
+            _add_rows(self._fp, len(rows))
+        return rows
+
+    def fetchmany(self, size=1):
+        rows = self._raw.fetchmany(size)
+        if self._fp:
+            _add_rows(self._fp, len(rows))
+        return rows
+
+
+# ============================================
+# CONEXION POR PETICION + UNIT OF WORK
+# ============================================
+# Cada helper hacia checkout/close contra el pool: 10-15 veces por peticion
+# en require_user, cada una con su COM_RESET_CONNECTION al devolverla. Con
+# pool_size=5 por worker eso acababa en "pool exhausted" bajo carga.
+#
+# Ahora app.py abre un scope por peticion (begin_request_scope) y la primera
+# consulta saca UNA conexion que reutilizan todos los helpers del mismo hilo
+# hasta end_request_scope(). unit_of_work() agrupa varios helpers en una sola
+# transaccion sobre esa misma conexion. Fuera de un scope (hilos en segundo
+# plano, scripts) todo se comporta como antes: una conexion por consulta.
+
+_local = threading.local()
+
+
+def begin_request_scope():
+    """Marca el hilo actual para reutilizar una conexion (se saca en la 1a consulta)."""
+    _local.scoped = True
+    _local.conn = None
+    _local.rconn = None
+    _local.tx_depth = 0
+    _local.read_only = 0
+    _local.users = None
+    _local.tx_dirty_users = None
+
+
+def end_request_scope():
+    """Devuelve al pool la conexion de la peticion. Hace rollback si quedo una
+    transaccion abierta (nunca deberia pasar: unit_of_work cierra la suya)."""
+    conn = getattr(_local, 'conn', None)
+    rconn = getattr(_local, 'rconn', None)
+    tx_open = getattr(_local, 'tx_depth', 0) > 0
+    _local.scoped = False
+    _local.conn = None
+    _local.rconn = None
+    _local.tx_depth = 0
+    _local.read_only = 0
+    _local.users = None
+    if rconn is not None:
+        try:
+            rconn.close()
+        except Exception:
+            pass
+    if conn is None:
+        return
+    try:
+        if tx_open:
+            conn.rollback()
+    except Exception:
+        pass
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+def _in_transaction():
+    return getattr(_local, 'tx_depth', 0) > 0
+
+
+def _acquire_replica():
+    """Conexion de replica para una lectura, o (None, False) si hay que ir al primario."""
+    conn = getattr(_local, 'rconn', None)
+    if conn is not None and time.monotonic() >= _replica_state['down_until']:
+        return conn, False
+    if not _replica_available():
+        _replica_state['fallbacks'] += 1
+        return None, False
+    try:
+        conn = get_replica_pool().get_connection()
+    except Exception as e:
+        _mark_replica_down(e)
+        _replica_state['fallbacks'] += 1
+        return None, False
+    if getattr(_local, 'scoped', False):
+        _local.rconn = conn
+        return conn, False
+    return conn, True
+
+
+def _is_replica(conn):
+    return getattr(getattr(conn, '_pool', None), 'name', None) == 'replica'
+
+
+def _acquire(read=False):
+    """(conn, propia). propia=True -> el llamador debe cerrarla al terminar.
+    read=True: la sentencia solo lee y puede ir a la replica si el hilo esta
+    en read_only() y no hay transaccion abierta."""
+    if read and getattr(_local, 'read_only', 0) and not _in_transaction() \
+            and REPLICA_CONFIG is not None:
+        conn, owned = _acquire_replica()
+        if conn is not None:
+            _replica_state['reads'] += 1
+            return conn, owned
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        return conn, False
+    if getattr(_local, 'scoped', False):
+        _local.conn = get_connection()
+        return _local.conn, False
+    return get_connection(), True
+
+
+def _release(conn, owned, failed=False):
+    if owned:
+        conn.close()
+        return
+    # Conexion compartida: si se cayo, soltarla para que la siguiente
+    # consulta de la peticion saque una nueva del pool.
+    if failed and (_is_replica(conn) or not _in_transaction()):
+        try:
+            alive = conn.is_connected()
+        except Exception:
+            alive = False
+        if not alive:
+            if _is_replica(conn):
+                _local.rconn = None
+            else:
+                _local.conn = None
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+@contextlib.contextmanager
+def unit_of_work():
+    """Transaccion explicita que comparten todos los helpers del hilo.
+
+        with unit_of_work() as (conn, cur):
+            update_balance(...)
+            increment_stat(...)
+
+    Commit al salir, rollback ante cualquier excepcion. Si ya hay una
+    unit_of_work abierta, la interior se une a la exterior (el commit lo
+    hace la mas externa). Devuelve un cursor dict para SQL propio.
+    """
+    conn, owned = _acquire()
+    outer = not _in_transaction()
+    if owned:
+        # Fuera de un scope de peticion: fijar la conexion mientras dure.
+        _local.conn = conn
+    cur = None
+    try:
+        if outer:
+            _apply_lock_wait(conn, getattr(_local, 'lock_wait', None))
+            conn.start_transaction()
+        _local.tx_depth = getattr(_local, 'tx_depth', 0) + 1
+        cur = _TimedCursor(conn.cursor(dictionary=True))
+        try:
+            yield conn, cur
+        finally:
+            _local.tx_depth -= 1
+        if outer:
+            conn.commit()
+    except Exception:
+        if outer:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+        raise
+    finally:
+        if outer:
+            _flush_tx_dirty_users()
+        if cur:
+            try:
+                cur.close()
+            except Exception:
+                pass
+        if owned:
+            _local.conn = None
+            conn.close()
+
+
+# ============================================
+# REINTENTO ANTE DEADLOCK / LOCK WAIT TIMEOUT
+# ============================================
+# Con rafagas de /api/mine/tap dos transacciones se cruzan en mine_upgrades /
+# mine_sessions / users y InnoDB mata a una (1213) o la deja esperando hasta
+# innodb_lock_wait_timeout (1205, 50 s por defecto). El usuario veia un error
+# cuando repetir la unidad de trabajo entera al momento habria funcionado.
+#
+# @retry_transaction repite la funcion completa (la transaccion ya se deshizo
+# en unit_of_work) con backoff exponencial con jitter, hasta
+# DB_TX_RETRIES reintentos. Si se define DB_LOCK_WAIT_TIMEOUT baja
+# innodb_lock_wait_timeout a esos segundos en sus transacciones (fallar
+# pronto y reintentar). Sin definir se usa el global del servidor: fijarlo
+# por sesion cuesta dos round trips por peticion (SET y reset al devolver
+# la conexion), mejor bajarlo en el servidor si hace falta.
+# Si ya hay una transaccion abierta no reintenta: la decide la externa.
+
+TX_RETRIES = max(0, _env_num('DB_TX_RETRIES', 3))
+TX_RETRY_BASE_MS = max(1.0, _env_num('DB_TX_RETRY_BASE_MS', 15, float))
+TX_RETRY_MAX_MS = max(TX_RETRY_BASE_MS, _env_num('DB_TX_RETRY_MAX_MS', 250, float))
+LOCK_WAIT_TIMEOUT = (max(1, _env_num('DB_LOCK_WAIT_TIMEOUT', 5))
+                     if os.environ.get('DB_LOCK_WAIT_TIMEOUT') else None)
+
+_RETRYABLE_ERRNOS = {1213: 'deadlock', 1205: 'lock_wait_timeout'}
+
+_tx_retry_stats = {
+    'deadlock': 0, 'lock_wait_timeout': 0, 'retries': 0,
+    'recovered': 0, 'exhausted': 0, 'backoff_ms_total': 0.0,
+}
+_tx_retry_lock = threading.Lock()
+
+
+def lock_error_kind(e):
+    """'deadlock' / 'lock_wait_timeout' si el error merece reintento, si no None."""
+    kind = _RETRYABLE_ERRNOS.get(getattr(e, 'errno', None))
+    if kind is None and DB_BACKEND == 'sqlite' and 'database is locked' in str(e):
+        kind = 'lock_wait_timeout'
+    return kind
+
+
+def _apply_lock_wait(conn, seconds):
+    """Fija innodb_lock_wait_timeout en la conexion solo si cambia: la mayoria
+    de transacciones no pagan ningun round trip extra. seconds=None vuelve al
+    valor global del servidor."""
+    if DB_BACKEND == 'sqlite' or getattr(conn, '_lock_wait', None) == seconds:
+        return
+    cur = conn.cursor()
+    try:
+        if seconds is None:
+            cur.execute("SET SESSION innodb_lock_wait_timeout = DEFAULT")
+        else:
+            cur.execute("SET SESSION innodb_lock_wait_timeout = %s", (int(seconds),))
+        conn._lock_wait = seconds
+    finally:
+        cur.close()
+
+
+def _tx_backoff(intento):
+    """Espera con jitter entre base/2 y base*2^intento (con tope), en segundos."""
+    techo = min(TX_RETRY_MAX_MS, TX_RETRY_BASE_MS * (2 ** intento))
+    return random.uniform(TX_RETRY_BASE_MS / 2, techo) / 1000.0
+
+
+def retry_transaction(fn=None, *, retries=None, lock_wait=None):
+    """Repite fn si falla por deadlock o lock wait timeout.
+
+        @retry_transaction
+        def api_tap(user):
+            with _tx() as (conn, cur):
+                ...
+
+    fn debe ser repetible: todo lo que escribe tiene que ir dentro de su(s)
+    unit_of_work, nada de efectos externos (Telegram, HTTP) antes del fallo.
+    Ninguna escritura despues de la ultima unit_of_work: si falla por lock
+    tras el commit, el reintento repetiria lo que ya se confirmo. Lo que
+    quede fuera no debe poder lanzar (try/except que solo registra).
+    """
+    def deco(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if _in_transaction():
+                return f(*args, **kwargs)
+            max_retries = TX_RETRIES if retries is None else retries
+            prev = getattr(_local, 'lock_wait', None)
+            _local.lock_wait = LOCK_WAIT_TIMEOUT if lock_wait is None else lock_wait
+            try:
+                intento = 0
+                while True:
+                    try:
+                        res = f(*args, **kwargs)
+                    except Exception as e:
+                        kind = lock_error_kind(e)
+                        if kind is None:
+                            raise
+                        with _tx_retry_lock:
+                            _tx_retry_stats[kind] += 1
+                            if intento >= max_retries:
+                                _tx_retry_stats['exhausted'] += 1
+                        if intento >= max_retries:
+                            logger.error(f"[tx-retry] {f.__name__}: {kind} tras {intento} reintentos")
+                            raise
+                        espera = _tx_backoff(intento)
+                        with _tx_retry_lock:
+                            _tx_retry_stats['retries'] += 1
+                            _tx_retry_stats['backoff_ms_total'] += espera * 1000
+                        logger.warning(f"[tx-retry] {f.__name__}: {kind}, reintento "
+                                       f"{intento + 1}/{max_retries} en {espera * 1000:.0f} ms")
+                        time.sleep(espera)
+                        intento += 1
+                        continue
+                    if intento:
+                        with _tx_retry_lock:
+                            _tx_retry_stats['recovered'] += 1
+                    return res
+            finally:
+                _local.lock_wait = prev
+        return wrapper
+    return deco(fn) if fn is not None else deco
+
+
+def get_tx_retry_stats():
+    """Contadores de reintentos de este worker (para /admin/api/db/pool)."""
+    with _tx_retry_lock:
+        out = dict(_tx_retry_stats)
+    out['backoff_ms_total'] = round(out['backoff_ms_total'], 1)
+    out.update({'max_retries': TX_RETRIES, 'lock_wait_timeout': LOCK_WAIT_TIMEOUT})
+    return out
+
+
 def execute_query(query, params=None, fetch_one=False, fetch_all=False):
     """Execute a database query"""
     conn = None
     cursor = None
+    owned = True
+    failed = False
+    t0 = None
     try:
-        conn = get_connection()
+        conn, owned = _acquire(read=fetch_one or fetch_all)
         cursor = conn.cursor(dictionary=True)
-        cursor.execute(query, params or ())
+        t0 = time.perf_counter()
+        try:
+            cursor.execute(query, params or ())
+        except (mysql.connector.errors.InterfaceError,
+                mysql.connector.errors.OperationalError) as e:
+            if not _is_replica(conn):
+                raise
+            # La replica se cayo a mitad: repetir la lectura en el primario
+            _record_query(query, t0, error=True)
+            _mark_replica_down(e)
+            try:
+                cursor.close()
+            except Exception:
+                pass
+            _release(conn, owned, failed=True)
+            conn, owned = _acquire()
+            cursor = conn.cursor(dictionary=True)
+            t0 = time.perf_counter()
+            cursor.execute(query, params or ())
 
         if fetch_one:
-            return cursor.fetchone()
+            row = cursor.fetchone()
+            _record_query(query, t0, 1 if row else 0)
+            return row
         elif fetch_all:
-            return cursor.fetchall()
+            rows = cursor.fetchall()
+            _record_query(query, t0, len(rows))
+            return rows
         else:
-            conn.commit()
+            # Con autocommit el COMMIT es un round trip inutil; dentro de
+            # unit_of_work el commit lo hace quien abrio la transaccion.
+            if not _in_transaction() and not DB_CONFIG.get('autocommit'):
+                conn.commit()
+            _record_query(query, t0, cursor.rowcount)
             return cursor.lastrowid
     except Exception as e:
+        failed = True
+        if t0 is not None:
+            _record_query(query, t0, error=True)
         logger.error(f"Query error: {e}\nQuery: {query}\nParams: {params}")
-        if conn:
-            conn.rollback()
+        if conn and not _in_transaction():
+            try:
+                conn.rollback()
+            except Exception:
+                pass
         raise
     finally:
         if cursor:
-            cursor.close()
+            try:
+                cursor.close()
+            except Exception:
+                pass
         if conn:
-            conn.close()
+            _release(conn, owned, failed)
 
 def execute_update_rowcount(query, params=None):
     """Ejecuta un UPDATE/DELETE y devuelve el numero de filas afectadas.
@@ -101,39 +1044,295 @@ def execute_update_rowcount(query, params=None):
     UPDATE condicional gano una carrera entre workers de gunicorn."""
     conn = None
     cursor = None
+    owned = True
+    failed = False
+    t0 = None
     try:
-        conn = get_connection()
+        conn, owned = _acquire()
         cursor = conn.cursor(dictionary=True)
+        t0 = time.perf_counter()
         cursor.execute(query, params or ())
-        conn.commit()
+        if not _in_transaction() and not DB_CONFIG.get('autocommit'):
+            conn.commit()
+        _record_query(query, t0, cursor.rowcount)
         return cursor.rowcount
     except Exception as e:
+        failed = True
+        if t0 is not None:
+            _record_query(query, t0, error=True)
         logger.error(f"Query error: {e}\nQuery: {query}\nParams: {params}")
-        if conn:
-            conn.rollback()
+        if conn and not _in_transaction():
+            try:
+                conn.rollback()
+            except Exception:
+                pass
         raise
     finally:
         if cursor:
-            cursor.close()
+            try:
+                cursor.close()
+            except Exception:
+                pass
         if conn:
-            conn.close()
+            _release(conn, owned, failed)
+
+
+# ============================================
+# PAGINACION POR CURSOR (KEYSET)
+# ============================================
+# LIMIT/OFFSET obliga a MySQL a leer y descartar todas las filas anteriores:
+# la pagina 2.000 del historial de una ballena leia 200k filas. Con keyset se
+# sigue desde la ultima fila vista ("sort_col, id" < ultimo par) y cada
+# pagina cuesta lo mismo. El cursor es opaco para el cliente (base64 de JSON)
+# y lleva la direccion: 'next' = mas antiguos, 'prev' = mas recientes.
+# Las filas con sort_col NULL no se paginan (created_at nunca lo es).
+
+def _cursor_value(v):
+    if isinstance(v, datetime):
+        return {'dt': v.isoformat()}
+    if isinstance(v, date):
+        return {'d': v.isoformat()}
+    if isinstance(v, Decimal):
+        return {'dec': str(v)}
+    return v
+
+
+def _cursor_parse(v):
+    if isinstance(v, dict):
+        if 'dt' in v:
+            return datetime.fromisoformat(v['dt'])
+        if 'd' in v:
+            return date.fromisoformat(v['d'])
+        if 'dec' in v:
+            return Decimal(v['dec'])
+    return v
+
+
+def encode_cursor(sort_value, row_id, direction='next'):
+    raw = json.dumps([direction, _cursor_value(sort_value), row_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """(direction, sort_value, row_id) o None si el cursor no es valido."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        direction, value, row_id = json.loads(raw)
+        if direction not in ('next', 'prev'):
+            return None
+        return direction, _cursor_parse(value), row_id
+    except Exception:
+        return None
+
+
+def keyset_sql(select_sql, where_sql='', params=(), sort_col='created_at',
+               id_col='id', dec=None, limit=51):
+    """(sql, args) de una pagina keyset; dec = decode_cursor(...) o None.
+    Es la sentencia que ejecuta keyset_page() (y la que EXPLAINa HOT_QUERIES)."""
+    direction = dec[0] if dec else 'next'
+    conds = [f"({where_sql})"] if where_sql else []
+    args = list(params or ())
+    if dec:
+        op = '<' if direction == 'next' else '>'
+        # Forma expandida en vez de (a, b) < (x, y): MySQL la resuelve como rango
+        conds.append(f"({sort_col} {op} %s OR ({sort_col} = %s AND {id_col} {op} %s))")
+        args += [dec[1], dec[1], dec[2]]
+    order = 'DESC' if direction == 'next' else 'ASC'
+    sql = select_sql
+    if conds:
+        sql += " WHERE " + " AND ".join(conds)
+    sql += f" ORDER BY {sort_col} {order}, {id_col} {order} LIMIT %s"
+    args.append(limit)
+    return sql, tuple(args)
+
+
+def keyset_page(select_sql, where_sql='', params=(), sort_col='created_at',
+                id_col='id', cursor=None, limit=50, sort_key=None, id_key=None):
+    """Una pagina ordenada por (sort_col DESC, id_col DESC) a partir de `cursor`.
+
+    select_sql: 'SELECT ... FROM ... [JOIN ...]' sin WHERE/ORDER/LIMIT.
+    where_sql:  condiciones del filtro (sin 'WHERE'), con sus `params`.
+    Devuelve {items, next_cursor, prev_cursor, limit}. Las claves del cursor
+    se leen de cada fila como sort_key/id_key (por defecto, el nombre de
+    columna sin el alias de tabla)."""
+    sort_key = sort_key or sort_col.split('.')[-1]
+    id_key = id_key or id_col.split('.')[-1]
+    limit = max(1, int(limit))
+    dec = decode_cursor(cursor)
+    direction = dec[0] if dec else 'next'
+
+    sql, args = keyset_sql(select_sql, where_sql, params, sort_col, id_col, dec, limit + 1)
+    rows = execute_query(sql, args, fetch_all=True) or []
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == 'prev':
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        first, last = rows[0], rows[-1]
+        if direction == 'prev' or more:
+            next_cursor = encode_cursor(last.get(sort_key), last.get(id_key), 'next')
+        if dec and (direction == 'next' or more):
+            prev_cursor = encode_cursor(first.get(sort_key), first.get(id_key), 'prev')
+    elif dec:
+        # Pagina vacia (se borraron filas entre medias): ofrecer la vuelta
+        if direction == 'next':
+            prev_cursor = encode_cursor(dec[1], dec[2], 'prev')
+        else:
+            next_cursor = encode_cursor(dec[1], dec[2], 'next')
+    return {'items': rows, 'next_cursor': next_cursor, 'prev_cursor': prev_cursor, 'limit': limit}
 
 
 # ============================================
 # USER OPERATIONS
 # ============================================
 
-def get_user(user_id):
-    """Get user by Telegram ID"""
+# Cache de filas de users. Una peticion llamaba a get_user() 4-6 veces
+# (ensure_user, checkin, tareas, referidos, retiros...) y cada vez repetia el
+# SELECT * y el json.loads de completed_tasks. Dos niveles:
+#   • por peticion (_local.users): dentro de una peticion, una sola lectura;
+#   • por worker, con TTL corto (USER_CACHE_SECONDS) y LRU (USER_CACHE_MAX).
+# Los escritores de este modulo llaman a invalidate_user(). Lo que escriba
+# OTRO worker se ve como mucho USER_CACHE_SECONDS tarde: para decisiones de
+# saldo usar get_user(uid, fresh=True). Dentro de una transaccion get_user
+# siempre va a la base de datos y no cachea (podria ser un dato sin commit).
+USER_CACHE_SECONDS = max(0.0, _env_num('USER_CACHE_SECONDS', 2.0, float))
+USER_CACHE_MAX = max(0, _env_num('USER_CACHE_MAX', 5000))
+
+_user_cache = collections.OrderedDict()   # uid -> (expira, fila)
+_user_cache_lock = threading.Lock()
+_user_cache_stats = {'hits': 0, 'request_hits': 0, 'misses': 0, 'invalidations': 0}
+
+
+def _copy_user(row):
+    """Copia para el llamador: complete_task() modifica completed_tasks in situ."""
+    if row is None:
+        return None
+    row = dict(row)
+    if isinstance(row.get('completed_tasks'), list):
+        row['completed_tasks'] = list(row['completed_tasks'])
+    return row
+
+
+def _request_users():
+    """Cache de la peticion en curso, o None fuera de un request scope."""
+    if not getattr(_local, 'scoped', False):
+        return None
+    users = getattr(_local, 'users', None)
+    if users is None:
+        users = _local.users = {}
+    return users
+
+
+def invalidate_user(user_id=None):
+    """Olvida la fila cacheada de un usuario (o de todos con user_id=None).
+    Dentro de una transaccion se repite al terminarla, para que ninguna
+    lectura concurrente deje cacheado el valor previo al commit."""
+    req = _request_users()
+    with _user_cache_lock:
+        _user_cache_stats['invalidations'] += 1
+        if user_id is None:
+            _user_cache.clear()
+        else:
+            _user_cache.pop(str(user_id), None)
+    if req is not None:
+        if user_id is None:
+            req.clear()
+        else:
+            req.pop(str(user_id), None)
+    if _in_transaction():
+        dirty = getattr(_local, 'tx_dirty_users', None)
+        if dirty is None:
+            dirty = _local.tx_dirty_users = set()
+        dirty.add(None if user_id is None else str(user_id))
+
+
+def _patch_user(user_id, fields):
+    """Aplica a la fila cacheada lo que update_user() acaba de escribir, en vez
+    de tirarla (record_user_ip toca last_active en cada peticion). Dentro de
+    una transaccion no se sabe si habra commit: se invalida."""
+    if _in_transaction():
+        invalidate_user(user_id)
+        return
+    uid = str(user_id)
+    req = _request_users()
+    if req is not None and uid in req:
+        req[uid] = dict(req[uid], **fields)
+    with _user_cache_lock:
+        hit = _user_cache.get(uid)
+        if hit is not None:
+            _user_cache[uid] = (hit[0], dict(hit[1], **fields))
+
+
+def _flush_tx_dirty_users():
+    dirty = getattr(_local, 'tx_dirty_users', None)
+    if not dirty:
+        return
+    _local.tx_dirty_users = None
+    if None in dirty:
+        invalidate_user()
+    else:
+        for uid in dirty:
+            invalidate_user(uid)
+
+
+def get_user_cache_stats():
+    with _user_cache_lock:
+        out = dict(_user_cache_stats)
+        out['size'] = len(_user_cache)
+    out.update({'ttl': USER_CACHE_SECONDS, 'max': USER_CACHE_MAX})
+    return out
+
+
+def get_user(user_id, fresh=False):
+    """Get user by Telegram ID.
+    fresh=True salta la cache (comprobaciones de saldo, paneles de admin)."""
+    uid = str(user_id)
+    in_tx = _in_transaction()
+    req = None if in_tx else _request_users()
+    if not fresh and not in_tx:
+        if req is not None and uid in req:
+            _user_cache_stats['request_hits'] += 1
+            return _copy_user(req[uid])
+        if USER_CACHE_SECONDS:
+            with _user_cache_lock:
+                hit = _user_cache.get(uid)
+                if hit is not None and hit[0] > time.monotonic():
+                    _user_cache.move_to_end(uid)
+                    _user_cache_stats['hits'] += 1
+                    if req is not None:
+                        req[uid] = hit[1]
+                    return _copy_user(hit[1])
+
     query = "SELECT * FROM users WHERE user_id = %s"
-    user = execute_query(query, (str(user_id),), fetch_one=True)
+    user = execute_query(query, (uid,), fetch_one=True)
     if user and user.get('completed_tasks'):
         if isinstance(user['completed_tasks'], str):
             try:
                 user['completed_tasks'] = json.loads(user['completed_tasks'])
             except:
                 user['completed_tasks'] = []
-    return user
+    if in_tx:
+        return user
+
+    _user_cache_stats['misses'] += 1
+    # Dentro de read_only() la fila puede venir de la replica (con retraso):
+    # no se guarda, o el resto de peticiones del worker verian un saldo o un
+    # withdrawal_blocked viejo durante todo el TTL.
+    desde_replica = getattr(_local, 'read_only', 0) and REPLICA_CONFIG is not None
+    if user is not None and not desde_replica:
+        if req is not None:
+            req[uid] = user
+        if USER_CACHE_SECONDS and USER_CACHE_MAX:
+            with _user_cache_lock:
+                _user_cache[uid] = (time.monotonic() + USER_CACHE_SECONDS, user)
+                _user_cache.move_to_end(uid)
+                while len(_user_cache) > USER_CACHE_MAX:
+                    _user_cache.popitem(last=False)
+    return _copy_user(user)
 
 def create_user(user_id, username=None, first_name='Player', referred_by=None):
     """Create a new user"""
@@ -145,6 +1344,7 @@ def create_user(user_id, username=None, first_name='Player', referred_by=None):
             first_name = COALESCE(VALUES(first_name), first_name)
     """
     execute_query(query, (str(user_id), username, first_name, referred_by))
+    invalidate_user(user_id)
 
     # Update stats
     increment_stat('total_users')
@@ -158,8 +1358,10 @@ def update_user(user_id, **kwargs):
 
     set_clauses = []
     values = []
+    patch = {}
 
     for key, value in kwargs.items():
+        patch[key] = list(value) if isinstance(value, list) else value
         if key == 'completed_tasks' and isinstance(value, list):
             value = json.dumps(value)
         set_clauses.append(f"{key} = %s")
@@ -168,11 +1370,32 @@ def update_user(user_id, **kwargs):
     values.append(str(user_id))
     query = f"UPDATE users SET {', '.join(set_clauses)} WHERE user_id = %s"
     execute_query(query, tuple(values))
+    _patch_user(user_id, patch)
 
 def get_all_users(limit=100, offset=0):
-    """Get paginated users"""
-    query = "SELECT * FROM users ORDER BY created_at DESC LIMIT %s OFFSET %s"
-    return execute_query(query, (limit, offset), fetch_all=True) or []
+    """Get paginated users (offset se mantiene por compatibilidad; para
+    paginar usar get_users_page, que no degrada en paginas profundas)."""
+    if offset:
+        query = "SELECT * FROM users ORDER BY created_at DESC, id DESC LIMIT %s OFFSET %s"
+        return execute_query(query, (limit, offset), fetch_all=True) or []
+    return get_users_page(limit=limit)['items']
+
+
+def get_users_page(cursor=None, limit=50, filter_type='all', search=''):
+    """Listado de usuarios del panel admin con paginacion keyset.
+    filter_type: 'all' | 'banned' | 'active' | 'top'. Devuelve lo mismo que keyset_page()."""
+    where, params, sort_col = '', (), 'created_at'
+    if search:
+        like = f'%{search}%'
+        where, params = "username LIKE %s OR first_name LIKE %s OR user_id LIKE %s", (like, like, like)
+    elif filter_type == 'banned':
+        where = "banned = 1"
+    elif filter_type == 'active':
+        where, sort_col = "last_active >= NOW() - INTERVAL 1 DAY", 'last_active'
+    elif filter_type == 'top':
+        sort_col = 'total_earned'
+    return keyset_page("SELECT * FROM users", where, params, sort_col=sort_col,
+                       cursor=cursor, limit=limit)
 
 def get_users_count():
     """Get total user count"""
@@ -197,50 +1420,182 @@ def update_balance(user_id, amount, action, description=None):
     ATOMICO: usa `doge_balance = doge_balance + %s` en vez de leer-modificar-escribir.
     Con read-modify-write dos peticiones simultaneas leian el mismo saldo y la
     ultima escritura pisaba a la otra (saldo perdido / descuadre con el historial).
+
+    UN SOLO ROUND TRIP: el UPDATE deja el saldo nuevo en @bal y el INSERT del
+    historial lo reutiliza, todo en el mismo paquete multi-statement y dentro
+    de una transaccion (la propia, o la unit_of_work que ya este abierta).
+    Antes eran 3 consultas autocommit (UPDATE, SELECT del saldo, INSERT) y un
+    fallo entre medias dejaba el saldo movido sin su fila de historial.
+    Si el UPDATE no toca ninguna fila (usuario inexistente o saldo
+    insuficiente en un debito) @bal queda NULL, no se inserta nada y devuelve False.
     """
     amount = float(amount)
+    uid = str(user_id)
 
-    if amount == 0:
-        # MySQL devuelve rowcount=0 si el valor no cambia: se registra y ya.
-        if not get_user(user_id):
-            return False
-        row = execute_query("SELECT doge_balance FROM users WHERE user_id = %s",
-                            (str(user_id),), fetch_one=True)
-        saldo = float(row['doge_balance']) if row else 0.0
-        execute_query("""
-            INSERT INTO balance_history (user_id, action, amount, balance_before, balance_after, description)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """, (str(user_id), action, 0.0, saldo, saldo, description))
-        return True
+    if DB_BACKEND == 'sqlite':
+        return _update_balance_sqlite(uid, amount, action, description)
 
     if amount < 0:
         # Debito con guard atomico: nunca deja el saldo en negativo.
-        filas = execute_update_rowcount(
-            "UPDATE users SET doge_balance = doge_balance + %s "
-            "WHERE user_id = %s AND doge_balance >= %s",
-            (amount, str(user_id), -amount)
-        )
+        upd_sql = ("UPDATE users SET doge_balance = (@bal := doge_balance + %s) "
+                   "WHERE user_id = %s AND doge_balance >= %s")
+        upd_params = (amount, uid, -amount)
+    else:
+        # amount == 0 tambien pasa por aqui: MySQL evalua la asignacion de @bal
+        # aunque el valor no cambie, asi que el historial se registra igual.
+        upd_sql = ("UPDATE users SET doge_balance = (@bal := doge_balance + %s), "
+                   "total_earned = total_earned + %s WHERE user_id = %s")
+        upd_params = (amount, amount, uid)
+
+    ins_sql = ("INSERT INTO balance_history "
+               "(user_id, action, amount, balance_before, balance_after, description) "
+               "SELECT %s, %s, %s, @bal - %s, @bal, %s FROM DUAL WHERE @bal IS NOT NULL")
+    ins_params = (uid, action, amount, amount, description)
+
+    propia_tx = not _in_transaction()
+    sentencias = ["SET @bal := NULL", upd_sql, ins_sql, "SELECT @bal"]
+    if propia_tx:
+        sentencias = ["START TRANSACTION"] + sentencias + ["COMMIT"]
+    sql = ";\n".join(sentencias)
+
+    conn, owned = _acquire()
+    cursor = None
+    failed = False
+    saldo = None
+    t0 = time.perf_counter()
+    try:
+        cursor = conn.cursor()
+        for res in cursor.execute(sql, upd_params + ins_params, multi=True):
+            if res.with_rows:
+                row = res.fetchone()
+                saldo = row[0] if row else None
+        _record_query(sql, t0, 1 if saldo is not None else 0)
+    except Exception as e:
+        failed = True
+        _record_query(sql, t0, error=True)
+        logger.error(f"[ledger] update_balance user={uid} amount={amount} action={action}: {e}")
+        if propia_tx:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+        raise
+    finally:
+        if cursor:
+            try:
+                cursor.close()
+            except Exception:
+                pass
+        _release(conn, owned, failed)
+
+    if saldo is not None:
+        invalidate_user(uid)
+    return saldo is not None
+
+def _update_balance_sqlite(uid, amount, action, description):
+    """update_balance para DB_BACKEND=sqlite: sin variables de sesion ni
+    multi-statement, el saldo nuevo sale del UPDATE ... RETURNING."""
+    if amount < 0:
+        upd_sql = ("UPDATE users SET doge_balance = doge_balance + %s "
+                   "WHERE user_id = %s AND doge_balance >= %s RETURNING doge_balance")
+        upd_params = (amount, uid, -amount)
     else:
-        filas = execute_update_rowcount(
-            "UPDATE users SET doge_balance = doge_balance + %s, total_earned = total_earned + %s "
-            "WHERE user_id = %s",
-            (amount, amount, str(user_id))
+        upd_sql = ("UPDATE users SET doge_balance = doge_balance + %s, "
+                   "total_earned = total_earned + %s WHERE user_id = %s RETURNING doge_balance")
+        upd_params = (amount, amount, uid)
+    with unit_of_work() as (conn, cur):
+        cur.execute(upd_sql, upd_params)
+        row = cur.fetchone()
+        if not row:
+            return False
+        saldo = float(row['doge_balance'])
+        cur.execute(
+            "INSERT INTO balance_history "
+            "(user_id, action, amount, balance_before, balance_after, description) "
+            "VALUES (%s, %s, %s, %s, %s, %s)",
+            (uid, action, amount, saldo - amount, saldo, description)
         )
+        invalidate_user(uid)
+    return True
+
+# Tamaño maximo de cada sentencia set-based en las operaciones en lote.
+BULK_CHUNK = 500
+
+
+def update_balances_bulk(credits):
+    """Acredita muchos saldos en UNA transaccion con SQL set-based.
+
+    credits: [(user_id, amount, action, description), ...]  (amount >= 0)
 
+    Por cada bloque de BULK_CHUNK usuarios: un SELECT ... FOR UPDATE de los
+    saldos, un UPDATE con CASE para todos y un INSERT multi-fila en
+    balance_history con balance_before/after calculados en orden. Pensado
+    para barridos (liquidacion de planes, comisiones de referidos), donde
+    antes cada credito eran 3 consultas sueltas.
+
+    Los usuarios que no existen se saltan. Los debitos (amount < 0) no se
+    aceptan aqui: necesitan el guard de saldo de update_balance().
+    Devuelve {user_id: total_acreditado}.
+    """
+    por_usuario = {}
+    filas = []
+    for user_id, amount, action, description in credits or []:
+        amount = Decimal(str(amount or 0))
+        if amount < 0:
+            raise ValueError("update_balances_bulk solo acepta creditos (amount >= 0)")
+        uid = str(user_id)
+        filas.append((uid, amount, action, description))
+        por_usuario[uid] = por_usuario.get(uid, Decimal('0')) + amount
     if not filas:
-        return False
+        return {}
 
-    row = execute_query("SELECT doge_balance FROM users WHERE user_id = %s",
-                        (str(user_id),), fetch_one=True)
-    balance_after  = float(row['doge_balance']) if row else 0.0
-    balance_before = balance_after - amount
+    acreditado = {}
+    # Orden fijo: dos barridos a la vez bloquean las filas en el mismo orden
+    uids = sorted(por_usuario)
+    with unit_of_work() as (conn, cur):
+        for i in range(0, len(uids), BULK_CHUNK):
+            bloque = uids[i:i + BULK_CHUNK]
+            marcas = ','.join(['%s'] * len(bloque))
+            cur.execute(
+                f"SELECT user_id, doge_balance FROM users WHERE user_id IN ({marcas}) FOR UPDATE",
+                tuple(bloque)
+            )
+            saldos = {str(r['user_id']): Decimal(str(r['doge_balance'] or 0))
+                      for r in cur.fetchall() or []}
+            existentes = [u for u in bloque if u in saldos]
+            en_bloque = set(existentes)
+            if not existentes:
+                continue
 
-    execute_query("""
-        INSERT INTO balance_history (user_id, action, amount, balance_before, balance_after, description)
-        VALUES (%s, %s, %s, %s, %s, %s)
-    """, (str(user_id), action, amount, balance_before, balance_after, description))
+            casos = ' '.join(['WHEN %s THEN %s'] * len(existentes))
+            pares = tuple(x for u in existentes for x in (u, por_usuario[u]))
+            marcas = ','.join(['%s'] * len(existentes))
+            cur.execute(
+                f"UPDATE users SET doge_balance = doge_balance + CASE user_id {casos} END, "
+                f"total_earned = total_earned + CASE user_id {casos} END "
+                f"WHERE user_id IN ({marcas})",
+                pares + pares + tuple(existentes)
+            )
 
-    return True
+            historial = []
+            for uid, amount, action, description in filas:
+                if uid not in en_bloque:
+                    continue
+                antes = saldos[uid]
+                saldos[uid] = antes + amount
+                historial.append((uid, action, amount, antes, saldos[uid], description))
+                acreditado[uid] = acreditado.get(uid, 0.0) + float(amount)
+            for uid in existentes:
+                invalidate_user(uid)
+            for j in range(0, len(historial), BULK_CHUNK):
+                trozo = historial[j:j + BULK_CHUNK]
+                cur.execute(
+                    "INSERT INTO balance_history (user_id, action, amount, balance_before, "
+                    "balance_after, description) VALUES "
+                    + ', '.join(['(%s, %s, %s, %s, %s, %s)'] * len(trozo)),
+                    tuple(x for h in trozo for x in h)
+                )
+    return acreditado
 
 def get_balance_history(user_id, limit=20):
     """Get user balance history"""
@@ -253,14 +1608,17 @@ def get_balance_history(user_id, limit=20):
     return execute_query(query, (str(user_id), limit), fetch_all=True) or []
 
 
-def get_user_history_paginated(user_id, category='all', page=1, per_page=100):
+def get_user_history_paginated(user_id, category='all', page=1, per_page=100, cursor=None):
     """
     Historial completo de un usuario para el panel admin, con paginación y filtros.
     category: 'all' | 'movements' | 'withdrawals' | 'deposits' | 'referrals'
-    Devuelve dict: {items, total, page, per_page, total_pages}
+    Devuelve dict: {items, total, page, per_page, total_pages, next_cursor, prev_cursor}
+
+    Pagina por cursor: pasar el next_cursor/prev_cursor recibido en `cursor`
+    (`page` solo se devuelve para mostrarlo). El COUNT solo se hace en la
+    primera pagina (sin cursor); en las demas total es None.
     """
     uid = str(user_id)
-    offset = (page - 1) * per_page
 
     def _count(sql, params):
         r = execute_query(sql, params, fetch_one=True)
@@ -268,12 +1626,22 @@ def get_user_history_paginated(user_id, category='all', page=1, per_page=100):
 
     items = []
     total = 0
+    next_cursor = prev_cursor = None
+
+    tablas = {
+        'withdrawals': ('withdrawals', 'user_id'),
+        'deposits':    ('ton_deposits', 'user_id'),
+        'referrals':   ('referrals', 'referrer_id'),
+        'movements':   ('balance_history', 'user_id'),
+    }
+    if category in tablas:
+        tabla, col = tablas[category]
+        total = None if cursor else _count(f"SELECT COUNT(*) as c FROM {tabla} WHERE {col}=%s", (uid,))
+        pg = keyset_page(f"SELECT * FROM {tabla}", f"{col}=%s", (uid,),
+                         cursor=cursor, limit=per_page)
+        rows, next_cursor, prev_cursor = pg['items'], pg['next_cursor'], pg['prev_cursor']
 
     if category == 'withdrawals':
-        total = _count("SELECT COUNT(*) as c FROM withdrawals WHERE user_id=%s", (uid,))
-        rows = execute_query(
-            "SELECT * FROM withdrawals WHERE user_id=%s ORDER BY created_at DESC LIMIT %s OFFSET %s",
-            (uid, per_page, offset), fetch_all=True) or []
         for r in rows:
             items.append({
                 'type': 'withdrawal',
@@ -287,10 +1655,6 @@ def get_user_history_paginated(user_id, category='all', page=1, per_page=100):
             })
 
     elif category == 'deposits':
-        total = _count("SELECT COUNT(*) as c FROM ton_deposits WHERE user_id=%s", (uid,))
-        rows = execute_query(
-            "SELECT * FROM ton_deposits WHERE user_id=%s ORDER BY created_at DESC LIMIT %s OFFSET %s",
-            (uid, per_page, offset), fetch_all=True) or []
         for r in rows:
             items.append({
                 'type': 'deposit',
@@ -303,10 +1667,6 @@ def get_user_history_paginated(user_id, category='all', page=1, per_page=100):
             })
 
     elif category == 'referrals':
-        total = _count("SELECT COUNT(*) as c FROM referrals WHERE referrer_id=%s", (uid,))
-        rows = execute_query(
-            "SELECT * FROM referrals WHERE referrer_id=%s ORDER BY created_at DESC LIMIT %s OFFSET %s",
-            (uid, per_page, offset), fetch_all=True) or []
         for r in rows:
             items.append({
                 'type': 'referral',
@@ -317,10 +1677,6 @@ def get_user_history_paginated(user_id, category='all', page=1, per_page=100):
             })
 
     elif category == 'movements':
-        total = _count("SELECT COUNT(*) as c FROM balance_history WHERE user_id=%s", (uid,))
-        rows = execute_query(
-            "SELECT * FROM balance_history WHERE user_id=%s ORDER BY created_at DESC LIMIT %s OFFSET %s",
-            (uid, per_page, offset), fetch_all=True) or []
         for r in rows:
             items.append({
                 'type': 'movement',
@@ -332,50 +1688,129 @@ def get_user_history_paginated(user_id, category='all', page=1, per_page=100):
                 'created_at': r.get('created_at'),
             })
 
-    else:  # all — combinar todo, ordenado por fecha
+    else:  # all — mezcla de las 4 tablas, ordenada por fecha
+        # Cada tabla devuelve como mucho per_page+1 filas ya ordenadas desde el
+        # cursor y se mezclan con heapq.merge: memoria O(pagina) aunque el
+        # usuario tenga 100k movimientos. El cursor lleva (created_at, tabla,
+        # id) para desempatar filas de distintas tablas con la misma fecha.
         def _safe_query(sql, params):
             try:
                 return execute_query(sql, params, fetch_all=True) or []
             except Exception as _qe:
                 logger.warning(f"[history] consulta falló (se omite): {_qe}")
                 return []
-        movements = _safe_query(
-            "SELECT 'movement' as _t, amount, action, description, balance_after, NULL as status, NULL as wallet_address, NULL as ton_tx_hash, NULL as currency, created_at FROM balance_history WHERE user_id=%s",
-            (uid,))
-        withdrawals = _safe_query(
-            "SELECT 'withdrawal' as _t, amount, NULL as action, NULL as description, NULL as balance_after, status, wallet_address, ton_tx_hash, currency, created_at FROM withdrawals WHERE user_id=%s",
-            (uid,))
-        deposits = _safe_query(
-            "SELECT 'deposit' as _t, ton_amount as amount, NULL as action, NULL as description, doge_credited as balance_after, status, NULL as wallet_address, NULL as ton_tx_hash, 'TON' as currency, created_at FROM ton_deposits WHERE user_id=%s",
-            (uid,))
-        referrals = _safe_query(
-            "SELECT 'referral' as _t, NULL as amount, NULL as action, referred_first_name as description, NULL as balance_after, NULL as status, referred_username as wallet_address, referred_id as ton_tx_hash, NULL as currency, created_at FROM referrals WHERE referrer_id=%s",
-            (uid,))
-
-        combined = []
-        for r in movements:
-            combined.append({'type':'movement','amount':float(r.get('amount',0) or 0),'currency':'DOGE',
-                'action':r.get('action',''),'detail':r.get('description','') or r.get('action',''),
-                'balance_after':float(r.get('balance_after',0) or 0),'created_at':r.get('created_at')})
-        for r in withdrawals:
-            combined.append({'type':'withdrawal','amount':float(r.get('amount',0) or 0),'currency':r.get('currency','DOGE'),
-                'status':r.get('status',''),'wallet':r.get('wallet_address',''),'tx_hash':r.get('ton_tx_hash','') or '',
-                'detail':f"Retiro {r.get('status','')}",'created_at':r.get('created_at')})
-        for r in deposits:
-            combined.append({'type':'deposit','amount':float(r.get('amount',0) or 0),'currency':'TON',
-                'status':r.get('status',''),'doge_credited':float(r.get('balance_after',0) or 0),
-                'detail':f"Depósito {r.get('status','')} · +{float(r.get('balance_after',0) or 0):.4f} DOGE",'created_at':r.get('created_at')})
-        for r in referrals:
-            combined.append({'type':'referral','referred_id':r.get('ton_tx_hash',''),
-                'referred_name':r.get('description','') or r.get('wallet_address','') or 'Player',
-                'detail':f"Referido: {r.get('description','') or r.get('wallet_address','') or r.get('ton_tx_hash','')}",'created_at':r.get('created_at')})
-
-        # Ordenar por fecha desc (created_at puede ser None)
-        combined.sort(key=lambda x: (x['created_at'] is not None, x['created_at']), reverse=True)
-        total = len(combined)
-        items = combined[offset:offset + per_page]
-
-    total_pages = max(1, (total + per_page - 1) // per_page)
+
+        fuentes = [
+            # (orden de desempate, tabla, columna de usuario, columnas)
+            (1, 'balance_history', 'user_id',
+             "'movement' as _t, amount, action, description, balance_after, NULL as status, NULL as wallet_address, NULL as ton_tx_hash, NULL as currency"),
+            (2, 'withdrawals', 'user_id',
+             "'withdrawal' as _t, amount, NULL as action, NULL as description, NULL as balance_after, status, wallet_address, ton_tx_hash, currency"),
+            (3, 'ton_deposits', 'user_id',
+             "'deposit' as _t, ton_amount as amount, NULL as action, NULL as description, doge_credited as balance_after, status, NULL as wallet_address, NULL as ton_tx_hash, 'TON' as currency"),
+            (4, 'referrals', 'referrer_id',
+             "'referral' as _t, NULL as amount, NULL as action, referred_first_name as description, NULL as balance_after, NULL as status, referred_username as wallet_address, referred_id as ton_tx_hash, NULL as currency"),
+        ]
+        dec = decode_cursor(cursor)
+        direction = dec[0] if dec else 'next'
+        if dec:
+            try:
+                c_at, (c_src, c_id) = dec[1], dec[2]
+            except (TypeError, ValueError):
+                dec, direction = None, 'next'
+        # Filas con created_at NULL: van al final (como la fecha mas antigua,
+        # desempatadas por tabla e id). Se leen aparte con created_at IS NULL
+        # (sigue siendo acceso por indice) y solo cuando la pagina llega a ellas.
+        en_nulos = bool(dec) and c_at is None
+        order = 'DESC' if direction == 'next' else 'ASC'
+        lt = '<' if direction == 'next' else '>'
+
+        def _con_fecha(src, tabla, col, cols):
+            where, args = f"{col}=%s AND created_at IS NOT NULL", [uid]
+            if dec and not en_nulos:
+                # (created_at, src, id) estrictamente despues del cursor; src es
+                # constante en cada tabla y la condicion queda en un rango simple
+                antes = src < c_src if direction == 'next' else src > c_src
+                if src == c_src:
+                    where += f" AND (created_at {lt} %s OR (created_at = %s AND id {lt} %s))"
+                    args += [c_at, c_at, c_id]
+                else:
+                    where += f" AND created_at {lt}{'=' if antes else ''} %s"
+                    args.append(c_at)
+            return _safe_query(
+                f"SELECT {cols}, id, created_at, {src} as _src FROM {tabla} WHERE {where} "
+                f"ORDER BY created_at {order}, id {order} LIMIT %s",
+                tuple(args) + (per_page + 1,))
+
+        def _sin_fecha(src, tabla, col, cols):
+            where, args = f"{col}=%s AND created_at IS NULL", [uid]
+            if en_nulos:
+                if src == c_src:
+                    where += f" AND id {lt} %s"
+                    args.append(c_id)
+                elif (src > c_src) if direction == 'next' else (src < c_src):
+                    return []
+            return _safe_query(
+                f"SELECT {cols}, id, created_at, {src} as _src FROM {tabla} WHERE {where} "
+                f"ORDER BY id {order} LIMIT %s",
+                tuple(args) + (per_page + 1,))
+
+        listas = []
+        if direction == 'next':
+            con = [[] if en_nulos else _con_fecha(*f) for f in fuentes]
+            # Si alguna tabla llena la pagina con fechas, ningun NULL entra en ella
+            if en_nulos or all(len(r) <= per_page for r in con):
+                listas = [c + _sin_fecha(*f) for c, f in zip(con, fuentes)]
+            else:
+                listas = con
+        else:
+            # Hacia lo reciente los NULL solo quedan por delante si el cursor esta en ellos
+            listas = [(_sin_fecha(*f) if en_nulos else []) + _con_fecha(*f) for f in fuentes]
+
+        clave = lambda r: (r['created_at'] or datetime.min, r['_src'], r['id'])
+        merged = list(itertools.islice(
+            heapq.merge(*listas, key=clave, reverse=(direction == 'next')), per_page + 1))
+        more = len(merged) > per_page
+        merged = merged[:per_page]
+        if direction == 'prev':
+            merged.reverse()
+        if merged:
+            first, last = merged[0], merged[-1]
+            if direction == 'prev' or more:
+                next_cursor = encode_cursor(last['created_at'], [last['_src'], last['id']], 'next')
+            if dec and (direction == 'next' or more):
+                prev_cursor = encode_cursor(first['created_at'], [first['_src'], first['id']], 'prev')
+
+        for r in merged:
+            t = r['_t']
+            if t == 'movement':
+                items.append({'type':'movement','amount':float(r.get('amount',0) or 0),'currency':'DOGE',
+                    'action':r.get('action',''),'detail':r.get('description','') or r.get('action',''),
+                    'balance_after':float(r.get('balance_after',0) or 0),'created_at':r.get('created_at')})
+            elif t == 'withdrawal':
+                items.append({'type':'withdrawal','amount':float(r.get('amount',0) or 0),'currency':r.get('currency','DOGE'),
+                    'status':r.get('status',''),'wallet':r.get('wallet_address',''),'tx_hash':r.get('ton_tx_hash','') or '',
+                    'detail':f"Retiro {r.get('status','')}",'created_at':r.get('created_at')})
+            elif t == 'deposit':
+                items.append({'type':'deposit','amount':float(r.get('amount',0) or 0),'currency':'TON',
+                    'status':r.get('status',''),'doge_credited':float(r.get('balance_after',0) or 0),
+                    'detail':f"Depósito {r.get('status','')} · +{float(r.get('balance_after',0) or 0):.4f} DOGE",'created_at':r.get('created_at')})
+            else:
+                items.append({'type':'referral','referred_id':r.get('ton_tx_hash',''),
+                    'referred_name':r.get('description','') or r.get('wallet_address','') or 'Player',
+                    'detail':f"Referido: {r.get('description','') or r.get('wallet_address','') or r.get('ton_tx_hash','')}",'created_at':r.get('created_at')})
+
+        # Total: un COUNT por tabla (indice user_id), solo en la primera pagina
+        total = None
+        if not cursor:
+            total = 0
+            for _src, tabla, col, _cols in fuentes:
+                try:
+                    total += _count(f"SELECT COUNT(*) as c FROM {tabla} WHERE {col}=%s", (uid,))
+                except Exception as _ce:
+                    logger.warning(f"[history] count {tabla}: {_ce}")
+
+    total_pages = max(1, (total + per_page - 1) // per_page) if total is not None else None
     # Serializar fechas y añadir campos de compatibilidad (para admin_users.html)
     for it in items:
         ca = it.get('created_at')
@@ -386,7 +1821,8 @@ def get_user_history_paginated(user_id, category='all', page=1, per_page=100):
         it.setdefault('amount', 0)
         it.setdefault('balance_after', it.get('balance_after', 0))
 
-    return {'items': items, 'total': total, 'page': page, 'per_page': per_page, 'total_pages': total_pages}
+    return {'items': items, 'total': total, 'page': page, 'per_page': per_page, 'total_pages': total_pages,
+            'next_cursor': next_cursor, 'prev_cursor': prev_cursor}
 
 # ============================================
 # DAILY CHECK-IN OPERATIONS
@@ -555,6 +1991,7 @@ def claim_daily_checkin(user_id):
             total_checkins = total_checkins + 1
         WHERE user_id = %s
     """, (new_streak, today, now, longest, str(user_id)))
+    invalidate_user(user_id)
 
     # Acreditar la recompensa
     if total_reward > 0:
@@ -600,6 +2037,7 @@ def add_referral(referrer_id, referred_id, referred_username=None, referred_firs
                 "UPDATE users SET referral_count = referral_count + 1 WHERE user_id = %s",
                 (str(referrer_id),)
             )
+            invalidate_user(referrer_id)
         return True
     except Exception as e:
         logger.error(f"Error al agregar referencia: {e}")
@@ -623,6 +2061,7 @@ def validate_referral(referrer_id, referred_id):
             referral_earnings = referral_earnings + %s
         WHERE user_id = %s
     """, (bonus, str(referrer_id)))
+    invalidate_user(referrer_id)
 
     # Pay bonus
     update_balance(referrer_id, bonus, 'referral_bonus',
@@ -696,6 +2135,7 @@ def pay_invite_purchase_reward(referrer_id, referred_user_id, plan_price):
         "UPDATE users SET referral_earnings = referral_earnings + %s WHERE user_id = %s",
         (reward, str(referrer_id))
     )
+    invalidate_user(referrer_id)
 
     try:
         increment_stat('total_tasks_completed')
@@ -737,8 +2177,73 @@ def pay_referral_commission(user_id, amount, source):
         "UPDATE users SET referral_earnings = referral_earnings + %s WHERE user_id = %s",
         (commission, str(referrer_id))
     )
+    invalidate_user(referrer_id)
     logger.info(f"Referral commission: {commission:.8f} TON → referrer={referrer_id} from {source} of user={user_id}")
 
+def pay_referral_commissions_bulk(earnings):
+    """Version en lote de pay_referral_commission().
+
+    earnings: [(user_id, amount, source), ...]
+    Una consulta resuelve los referidores validados de todos los usuarios,
+    get_config se lee una vez, los abonos van por update_balances_bulk() y
+    referral_earnings se actualiza con un solo UPDATE ... CASE.
+    Devuelve {referrer_id: comision_total}.
+    """
+    earnings = [(str(u), float(a), src) for u, a, src in earnings or [] if a and float(a) > 0]
+    if not earnings:
+        return {}
+    commission_pct = float(get_config('referral_commission_pct', '0')) / 100.0
+    if commission_pct <= 0:
+        return {}
+
+    referidor = {}
+    uids = list({u for u, _a, _s in earnings})
+    for i in range(0, len(uids), BULK_CHUNK):
+        bloque = uids[i:i + BULK_CHUNK]
+        marcas = ','.join(['%s'] * len(bloque))
+        rows = execute_query(f"""
+            SELECT u.user_id, u.referred_by
+            FROM users u
+            JOIN referrals r ON r.referrer_id = u.referred_by
+                            AND r.referred_id = u.user_id
+                            AND r.validated = 1
+            WHERE u.user_id IN ({marcas})
+        """, tuple(bloque), fetch_all=True) or []
+        for r in rows:
+            referidor[str(r['user_id'])] = str(r['referred_by'])
+
+    creditos = []
+    for uid, amount, source in earnings:
+        ref_id = referidor.get(uid)
+        if not ref_id:
+            continue
+        commission = round(amount * commission_pct, 8)
+        if commission <= 0:
+            continue
+        creditos.append((ref_id, commission, 'referral_commission',
+                         f"5% commission from {source} of user {uid}"))
+    if not creditos:
+        return {}
+
+    with unit_of_work():
+        pagado = update_balances_bulk(creditos)
+        if pagado:
+            refs = list(pagado)
+            for i in range(0, len(refs), BULK_CHUNK):
+                bloque = refs[i:i + BULK_CHUNK]
+                casos = ' '.join(['WHEN %s THEN %s'] * len(bloque))
+                marcas = ','.join(['%s'] * len(bloque))
+                execute_query(
+                    f"UPDATE users SET referral_earnings = referral_earnings + CASE user_id {casos} END "
+                    f"WHERE user_id IN ({marcas})",
+                    tuple(x for r in bloque for x in (r, pagado[r])) + tuple(bloque)
+                )
+                for r in bloque:
+                    invalidate_user(r)
+    logger.info(f"Referral commissions (bulk): {len(pagado)} referrers, "
+                f"{sum(pagado.values()):.8f} TON total")
+    return pagado
+
 def get_referrals(user_id, limit=50):
     """Get user's referrals — detects fraud in real-time via shared IP check"""
     query = """
@@ -925,11 +2430,12 @@ def get_user_tasks_status(user_id):
 # WITHDRAWAL OPERATIONS
 # ============================================
 
+@retry_transaction
 def create_withdrawal(user_id, amount, wallet_address):
     """Create a withdrawal request"""
     import secrets
 
-    user = get_user(user_id)
+    user = get_user(user_id, fresh=True)
     if not user:
         return None
 
@@ -946,16 +2452,18 @@ def create_withdrawal(user_id, amount, wallet_address):
     net_amount = amount - fee
     withdrawal_id = f"WD{secrets.token_hex(8).upper()}"
 
-    # Deduct from balance
-    update_balance(user_id, -amount, 'withdrawal', f"Withdrawal request: {withdrawal_id}")
+    # Debito + registro en la misma transaccion (un deadlock repite las dos)
+    with unit_of_work():
+        if not update_balance(user_id, -amount, 'withdrawal', f"Withdrawal request: {withdrawal_id}"):
+            return {'error': 'Insufficient balance'}
 
-    # Create withdrawal record
-    execute_query("""
-        INSERT INTO withdrawals (withdrawal_id, user_id, amount, fee, net_amount, wallet_address)
-        VALUES (%s, %s, %s, %s, %s, %s)
-    """, (withdrawal_id, str(user_id), amount, fee, net_amount, wallet_address))
-
-    increment_stat('total_withdrawals')
+        execute_query("""
+            INSERT INTO withdrawals (withdrawal_id, user_id, amount, fee, net_amount, wallet_address)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, (withdrawal_id, str(user_id), amount, fee, net_amount, wallet_address))
+        # Dentro de la transaccion: un deadlock aqui fuera haria que
+        # retry_transaction repitiera el debito y el retiro ya confirmados
+        increment_stat('total_withdrawals')
 
     return {
         'withdrawal_id': withdrawal_id,
@@ -964,11 +2472,12 @@ def create_withdrawal(user_id, amount, wallet_address):
         'net_amount': net_amount
     }
 
+@retry_transaction
 def create_ton_withdrawal(user_id, doge_amount, ton_wallet):
     """Create a TON withdrawal request - deducts DOGE, admin sends TON manually"""
     import secrets
 
-    user = get_user(user_id)
+    user = get_user(user_id, fresh=True)
     if not user:
         return {'error': 'User not found'}
 
@@ -988,16 +2497,18 @@ def create_ton_withdrawal(user_id, doge_amount, ton_wallet):
 
     withdrawal_id = f"TW{secrets.token_hex(8).upper()}"
 
-    update_balance(user_id, -doge_amount, 'withdrawal_ton', f"Retiro TON: {withdrawal_id}")
-    save_user_ton_wallet(user_id, ton_wallet)
+    with unit_of_work():
+        if not update_balance(user_id, -doge_amount, 'withdrawal_ton', f"Retiro TON: {withdrawal_id}"):
+            return {'error': 'api_insuf_balance'}
+        save_user_ton_wallet(user_id, ton_wallet)
 
-    execute_query("""
-        INSERT INTO withdrawals
-          (withdrawal_id, user_id, amount, fee, net_amount, wallet_address,
-           withdrawal_type, ton_wallet_address, ton_amount)
-        VALUES (%s, %s, %s, %s, %s, %s, 'ton', %s, %s)
-    """, (withdrawal_id, str(user_id), doge_amount, fee_doge, net_doge,
-          ton_wallet, ton_wallet, ton_amount))
+        execute_query("""
+            INSERT INTO withdrawals
+              (withdrawal_id, user_id, amount, fee, net_amount, wallet_address,
+               withdrawal_type, ton_wallet_address, ton_amount)
+            VALUES (%s, %s, %s, %s, %s, %s, 'ton', %s, %s)
+        """, (withdrawal_id, str(user_id), doge_amount, fee_doge, net_doge,
+              ton_wallet, ton_wallet, ton_amount))
 
     return {
         'withdrawal_id': withdrawal_id,
@@ -1140,8 +2651,73 @@ def redeem_promo_code(user_id, code):
 # CONFIG OPERATIONS
 # ============================================
 
+# Cache de config por worker. get_config() se llama decenas de veces por
+# peticion (ip_gate, _public_state de Crystal Rush, depositos TON...): en vez
+# de un SELECT por llamada se guarda una foto de TODA la tabla config y, como
+# mucho cada CONFIG_CACHE_SECONDS, se revalida contra un unico contador
+# (config_version) que set_config()/set_configs() incrementan. Asi un cambio
+# desde el panel llega a todos los workers en ~1 segundo.
+CONFIG_CACHE_SECONDS = max(0.0, _env_num('CONFIG_CACHE_SECONDS', 1.0, float))
+
+_config_cache = {'values': None, 'version': None, 'checked': 0.0}
+_config_lock = threading.Lock()
+
+
+def _config_version():
+    """Version actual de la config, o None si la tabla aun no existe."""
+    try:
+        row = execute_query("SELECT version FROM config_version WHERE id = 1", fetch_one=True)
+    except Exception:
+        return None
+    return int(row['version']) if row else 0
+
+
+def _config_snapshot():
+    """Foto de la tabla config revalidada contra config_version.
+    Devuelve None si no se puede cachear (sin tabla de version)."""
+    snap = _config_cache
+    if snap['values'] is not None and time.monotonic() - snap['checked'] < CONFIG_CACHE_SECONDS:
+        return snap['values']
+    with _config_lock:
+        if snap['values'] is not None and time.monotonic() - snap['checked'] < CONFIG_CACHE_SECONDS:
+            return snap['values']
+        # La version se lee ANTES que los valores: si alguien escribe en medio,
+        # guardamos la version vieja y la siguiente revalidacion recarga.
+        version = _config_version()
+        if version is None:
+            return None
+        if snap['values'] is None or version != snap['version']:
+            rows = execute_query("SELECT config_key, config_value FROM config", fetch_all=True) or []
+            snap['values'] = {r['config_key']: r['config_value'] for r in rows}
+            snap['version'] = version
+        snap['checked'] = time.monotonic()
+        return snap['values']
+
+
+def invalidate_config_cache():
+    """Fuerza a este worker a recargar la config en la proxima lectura."""
+    with _config_lock:
+        _config_cache['values'] = None
+        _config_cache['checked'] = 0.0
+
+
+def bump_config_version():
+    """Avisa a todos los workers de que la config cambio."""
+    try:
+        execute_query(
+            "INSERT INTO config_version (id, version) VALUES (1, 1) "
+            "ON DUPLICATE KEY UPDATE version = version + 1"
+        )
+    except Exception as e:
+        logger.warning(f"[config] no se pudo incrementar config_version: {e}")
+    invalidate_config_cache()
+
+
 def get_config(key, default=None):
     """Get config value"""
+    values = _config_snapshot()
+    if values is not None:
+        return values.get(key, default)
     query = "SELECT config_value FROM config WHERE config_key = %s"
     result = execute_query(query, (key,), fetch_one=True)
     return result['config_value'] if result else default
@@ -1152,6 +2728,33 @@ def set_config(key, value):
         INSERT INTO config (config_key, config_value) VALUES (%s, %s)
         ON DUPLICATE KEY UPDATE config_value = VALUES(config_value)
     """, (key, str(value)))
+    bump_config_version()
+
+
+def set_configs(values):
+    """Guarda varias claves en un solo INSERT y un solo aviso de version."""
+    items = [(str(k), str(v)) for k, v in (values or {}).items()]
+    if not items:
+        return
+    marcas = ', '.join(['(%s, %s)'] * len(items))
+    execute_query(
+        f"INSERT INTO config (config_key, config_value) VALUES {marcas} "
+        "ON DUPLICATE KEY UPDATE config_value = VALUES(config_value)",
+        tuple(x for kv in items for x in kv)
+    )
+    bump_config_version()
+
+
+def config_defaults_seeded(inserted):
+    """Tras sembrar defaults con INSERT IGNORE al arrancar: solo avisa a los
+    workers si entro alguna fila. Con la BD recien creada config_version aun
+    no existe (la crea la migracion) y nadie tiene la config cacheada."""
+    if not inserted:
+        return
+    if not _ton_table_exists('config_version'):
+        invalidate_config_cache()
+        return
+    bump_config_version()
 
 def get_all_config():
     """Get all config values"""
@@ -1162,26 +2765,114 @@ def get_all_config():
 # STATS OPERATIONS
 # ============================================
 
+# Contadores repartidos (sharded). increment_stat() sobre UNA fila de `stats`
+# serializaba todos los claims, liquidaciones, check-ins y tareas en el mismo
+# row lock de InnoDB. Con STATS_SHARDS > 1 cada incremento va a una de N filas
+# de `stats_shards` elegida al azar; get_stat/get_all_stats suman la fila base
+# de `stats` mas sus shards, y compact_stat_shards() (barrido periodico en
+# app.py) pasa los shards a la fila base. STATS_SHARDS=1 = modo clasico.
+STATS_SHARDS = max(1, _env_num('STATS_SHARDS', 16))
+
+
 def get_stat(key, default=0):
     """Get stat value"""
+    if STATS_SHARDS > 1:
+        try:
+            result = execute_query("""
+                SELECT (SELECT stat_value FROM stats WHERE stat_key = %s) AS base,
+                       (SELECT SUM(stat_value) FROM stats_shards WHERE stat_key = %s) AS shards
+            """, (key, key), fetch_one=True)
+            if not result or (result['base'] is None and result['shards'] is None):
+                return default
+            return int(result['base'] or 0) + int(result['shards'] or 0)
+        except Exception as e:
+            logger.warning(f"[stats] lectura con shards fallo, uso stats: {e}")
     query = "SELECT stat_value FROM stats WHERE stat_key = %s"
     result = execute_query(query, (key,), fetch_one=True)
     return result['stat_value'] if result else default
 
 def set_stat(key, value):
     """Set stat value"""
-    execute_query("""
-        INSERT INTO stats (stat_key, stat_value) VALUES (%s, %s)
-        ON DUPLICATE KEY UPDATE stat_value = VALUES(stat_value)
-    """, (key, int(value)))
+    with unit_of_work():
+        execute_query("""
+            INSERT INTO stats (stat_key, stat_value) VALUES (%s, %s)
+            ON DUPLICATE KEY UPDATE stat_value = VALUES(stat_value)
+        """, (key, int(value)))
+        if STATS_SHARDS > 1:
+            try:
+                execute_query("UPDATE stats_shards SET stat_value = 0 WHERE stat_key = %s", (key,))
+            except Exception as e:
+                logger.warning(f"[stats] no se pudieron limpiar shards de {key}: {e}")
 
 def increment_stat(key, amount=1):
     """Increment a stat"""
+    if STATS_SHARDS > 1:
+        try:
+            execute_query("""
+                INSERT INTO stats_shards (stat_key, shard, stat_value) VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE stat_value = stat_value + VALUES(stat_value)
+            """, (key, random.randrange(STATS_SHARDS), amount))
+            return
+        except Exception as e:
+            # Dentro de una transaccion el error ya la dejo abortada (y un
+            # lock debe llegar a retry_transaction): el fallback no sirve.
+            if lock_error_kind(e) is not None or _in_transaction():
+                raise
+            logger.warning(f"[stats] shard fallo, uso stats: {e}")
     execute_query("""
         INSERT INTO stats (stat_key, stat_value) VALUES (%s, %s)
         ON DUPLICATE KEY UPDATE stat_value = stat_value + VALUES(stat_value)
     """, (key, amount))
 
+
+def compact_stat_shards():
+    """Pasa lo acumulado en stats_shards a la fila base de `stats`.
+
+    Bloquea solo los shards con valor (FOR UPDATE) y les resta exactamente
+    lo que se paso, asi los incrementos que lleguen durante la compactacion
+    no se pierden. Devuelve {stat_key: cantidad_compactada}.
+    """
+    movido = {}
+    with unit_of_work() as (conn, cur):
+        cur.execute(
+            "SELECT stat_key, shard, stat_value FROM stats_shards "
+            "WHERE stat_value <> 0 FOR UPDATE"
+        )
+        filas = cur.fetchall() or []
+        if not filas:
+            return movido
+        for r in filas:
+            movido[r['stat_key']] = movido.get(r['stat_key'], 0) + int(r['stat_value'])
+        for k, total in movido.items():
+            cur.execute("""
+                INSERT INTO stats (stat_key, stat_value) VALUES (%s, %s)
+                ON DUPLICATE KEY UPDATE stat_value = stat_value + VALUES(stat_value)
+            """, (k, total))
+        cur.executemany(
+            "UPDATE stats_shards SET stat_value = stat_value - %s "
+            "WHERE stat_key = %s AND shard = %s",
+            [(int(r['stat_value']), r['stat_key'], r['shard']) for r in filas]
+        )
+    return movido
+
+
+# Rangos sobre processed_at (no DATE()/YEARWEEK() de la columna) para que
+# usen idx_status_processed. Semana ISO: empieza el lunes, como YEARWEEK(..., 1).
+SPENDING_SUM_SQL = """SELECT COALESCE(SUM(net_amount), 0) AS total, COUNT(*) AS cnt
+                    FROM withdrawals
+                    WHERE status = 'completed' {where}"""
+SPENDING_RANGES = {
+    'today':      "AND processed_at >= CURDATE() AND processed_at < CURDATE() + INTERVAL 1 DAY",
+    'yesterday':  "AND processed_at >= CURDATE() - INTERVAL 1 DAY AND processed_at < CURDATE()",
+    'this_week':  "AND processed_at >= CURDATE() - INTERVAL WEEKDAY(CURDATE()) DAY "
+                  "AND processed_at < CURDATE() + INTERVAL 1 DAY",
+    'this_month': "AND processed_at >= CURDATE() - INTERVAL (DAYOFMONTH(CURDATE()) - 1) DAY "
+                  "AND processed_at < CURDATE() + INTERVAL 1 DAY",
+    'all_time':   "",
+}
+
+
+@read_only_tolerant
 def get_spending_stats():
     """
     Estadísticas de gastos en TON (retiros completados).
@@ -1190,12 +2881,7 @@ def get_spending_stats():
     """
     def _sum(where_sql, params=()):
         try:
-            row = execute_query(
-                f"""SELECT COALESCE(SUM(net_amount), 0) AS total, COUNT(*) AS cnt
-                    FROM withdrawals
-                    WHERE status = 'completed' {where_sql}""",
-                params, fetch_one=True
-            )
+            row = execute_query(SPENDING_SUM_SQL.format(where=where_sql), params, fetch_one=True)
             return {
                 'total': float(row['total']) if row and row.get('total') is not None else 0.0,
                 'count': int(row['cnt']) if row and row.get('cnt') is not None else 0
@@ -1204,29 +2890,24 @@ def get_spending_stats():
             logger.warning(f"[spending] query falló: {e}")
             return {'total': 0.0, 'count': 0}
 
-    return {
-        'today':      _sum("AND DATE(processed_at) = CURDATE()"),
-        'yesterday':  _sum("AND DATE(processed_at) = DATE_SUB(CURDATE(), INTERVAL 1 DAY)"),
-        'this_week':  _sum("AND YEARWEEK(processed_at, 1) = YEARWEEK(CURDATE(), 1)"),
-        'this_month': _sum("AND YEAR(processed_at) = YEAR(CURDATE()) AND MONTH(processed_at) = MONTH(CURDATE())"),
-        'all_time':   _sum(""),
-    }
+    return {k: _sum(where) for k, where in SPENDING_RANGES.items()}
 
 
-def get_spending_history(days=30):
-    """Gasto diario en TON de los últimos N días (para la lista del historial)."""
-    try:
-        rows = execute_query(
-            """SELECT DATE(processed_at) AS day,
+SPENDING_HISTORY_SQL = """SELECT DATE(processed_at) AS day,
                       COALESCE(SUM(net_amount), 0) AS total,
                       COUNT(*) AS cnt
                FROM withdrawals
                WHERE status = 'completed'
                  AND processed_at >= DATE_SUB(CURDATE(), INTERVAL %s DAY)
                GROUP BY DATE(processed_at)
-               ORDER BY day DESC""",
-            (int(days),), fetch_all=True
-        ) or []
+               ORDER BY day DESC"""
+
+
+@read_only_tolerant
+def get_spending_history(days=30):
+    """Gasto diario en TON de los últimos N días (para la lista del historial)."""
+    try:
+        rows = execute_query(SPENDING_HISTORY_SQL, (int(days),), fetch_all=True) or []
         return [{
             'day': str(r['day']),
             'total': float(r['total']) if r.get('total') is not None else 0.0,
@@ -1240,26 +2921,365 @@ def get_spending_history(days=30):
 def get_all_stats():
     """Get all stats"""
     results = execute_query("SELECT * FROM stats", fetch_all=True) or []
-    return {r['stat_key']: r['stat_value'] for r in results}
+    out = {r['stat_key']: r['stat_value'] for r in results}
+    if STATS_SHARDS > 1:
+        try:
+            shards = execute_query(
+                "SELECT stat_key, SUM(stat_value) AS s FROM stats_shards GROUP BY stat_key",
+                fetch_all=True
+            ) or []
+            for r in shards:
+                out[r['stat_key']] = int(out.get(r['stat_key']) or 0) + int(r['s'] or 0)
+        except Exception as e:
+            logger.warning(f"[stats] no se pudieron sumar shards: {e}")
+    return out
 
 # ============================================
 # IP TRACKING
 # ============================================
 
+# Registro de IPs con write-behind. record_user_ip() era la escritura mas
+# frecuente del sistema (un upsert en user_ips + un UPDATE de users en cada
+# peticion autenticada) y solo es contabilidad. Ahora acumula los
+# avistamientos (user, ip) en memoria y un hilo del worker los vuelca cada
+# IP_FLUSH_SECONDS con upserts multi-fila:
+#   • un par nuevo para este worker se escribe AL MOMENTO: ip_gate cuenta las
+#     cuentas de una IP desde user_ips, y una rafaga de altas desde la misma
+#     IP no puede esperar al volcado (cada worker tiene su propio buffer);
+#   • un par ya escrito se vuelve a escribir como mucho cada IP_RECORD_INTERVAL
+#     segundos, sumando todas las visitas acumuladas (times_seen sigue
+#     contando visitas; last_seen/last_active se retrasan como mucho eso).
+# Lo pendiente se pierde si el proceso muere de golpe (se intenta un ultimo
+# volcado con atexit). IP_RECORD_INTERVAL=0 vuelca todo en cada ciclo.
+IP_RECORD_INTERVAL = max(0.0, _env_num('DB_IP_RECORD_INTERVAL', 60, float))
+IP_FLUSH_SECONDS = max(0.5, _env_num('DB_IP_FLUSH_SECONDS', 5, float))
+IP_RECORD_MAX_PENDING = max(100, _env_num('DB_IP_RECORD_MAX_PENDING', 20000))
+
+_ip_pending = {}     # (uid, ip) -> [visitas, primera, ultima]  (datetime)
+_ip_written = {}     # (uid, ip) -> time.monotonic() del ultimo volcado
+_ip_lock = threading.Lock()
+_ip_wakeup = threading.Event()
+_ip_flusher = {'pid': None}
+_ip_stats = {'sightings': 0, 'flushes': 0, 'rows_written': 0, 'errors': 0}
+
+
 def record_user_ip(user_id, ip_address):
-    """Record user IP address"""
+    """Record user IP address (write-behind: ver IP_RECORD_INTERVAL)."""
     if not ip_address:
         return
+    uid = str(user_id)
+    now = datetime.now().replace(microsecond=0)
+    with _ip_lock:
+        par = _ip_pending.get((uid, ip_address))
+        nuevo = par is None and (uid, ip_address) not in _ip_written
+        if par is None:
+            _ip_pending[(uid, ip_address)] = [1, now, now]
+        else:
+            par[0] += 1
+            par[2] = now
+        _ip_stats['sightings'] += 1
+        lleno = len(_ip_pending) >= IP_RECORD_MAX_PENDING
+    # La fila cacheada refleja ya la actividad aunque la BD vaya unos segundos detras
+    _patch_user(uid, {'last_ip': ip_address, 'last_active': now})
+    _ensure_ip_flusher()
+    if nuevo:
+        # Primer avistamiento del par: visible para ip_gate ya (si falla,
+        # flush_ip_activity lo devuelve a la cola del volcado normal)
+        flush_ip_activity(user_id=uid)
+    elif lleno:
+        _ip_wakeup.set()
+
+
+def flush_ip_activity(force=False, user_id=None):
+    """Vuelca a la BD los avistamientos que toca escribir (todos con force=True;
+    solo los de un usuario con user_id, p.ej. antes de revisar un retiro).
+    Devuelve cuantos pares (user, ip) se escribieron."""
+    ahora = time.monotonic()
+    solo = None if user_id is None else str(user_id)
+    with _ip_lock:
+        listos = {}
+        for k, v in list(_ip_pending.items()):
+            if solo is not None:
+                if k[0] == solo:
+                    listos[k] = _ip_pending.pop(k)
+                continue
+            ultimo = _ip_written.get(k)
+            if force or ultimo is None or ahora - ultimo >= IP_RECORD_INTERVAL:
+                listos[k] = _ip_pending.pop(k)
+        # Olvidar pares que ya no necesitan throttle (acota la memoria)
+        for k in [k for k, t in _ip_written.items() if ahora - t >= IP_RECORD_INTERVAL
+                  and k not in _ip_pending]:
+            del _ip_written[k]
+    if not listos:
+        return 0
 
-    execute_query("""
-        INSERT INTO user_ips (user_id, ip_address, times_seen)
-        VALUES (%s, %s, 1)
-        ON DUPLICATE KEY UPDATE
-            times_seen = times_seen + 1,
-            last_seen = NOW()
-    """, (str(user_id), ip_address))
+    # Orden fijo: dos workers volcando a la vez toman los locks en el mismo orden
+    filas = sorted((uid, ip, v[0], v[1], v[2]) for (uid, ip), v in listos.items())
+    ultima = {}
+    for uid, ip, _, _, visto in filas:
+        if uid not in ultima or visto > ultima[uid][1]:
+            ultima[uid] = (ip, visto)
+    try:
+        with unit_of_work() as (conn, cur):
+            for i in range(0, len(filas), BULK_CHUNK):
+                trozo = filas[i:i + BULK_CHUNK]
+                cur.execute(
+                    "INSERT INTO user_ips (user_id, ip_address, times_seen, first_seen, last_seen) VALUES "
+                    + ', '.join(['(%s, %s, %s, %s, %s)'] * len(trozo))
+                    + " ON DUPLICATE KEY UPDATE times_seen = times_seen + VALUES(times_seen), "
+                      "last_seen = GREATEST(last_seen, VALUES(last_seen))",
+                    tuple(x for f in trozo for x in f)
+                )
+            uids = sorted(ultima)
+            for i in range(0, len(uids), BULK_CHUNK):
+                bloque = uids[i:i + BULK_CHUNK]
+                casos = ' '.join(['WHEN %s THEN %s'] * len(bloque))
+                marcas = ','.join(['%s'] * len(bloque))
+                cur.execute(
+                    f"UPDATE users SET last_ip = CASE user_id {casos} END, "
+                    f"last_active = CASE user_id {casos} END WHERE user_id IN ({marcas})",
+                    tuple(x for u in bloque for x in (u, ultima[u][0]))
+                    + tuple(x for u in bloque for x in (u, ultima[u][1]))
+                    + tuple(bloque)
+                )
+    except Exception as e:
+        # Devolver las visitas a la cola para el siguiente intento
+        with _ip_lock:
+            _ip_stats['errors'] += 1
+            for k, v in listos.items():
+                par = _ip_pending.get(k)
+                if par is None:
+                    _ip_pending[k] = v
+                else:
+                    par[0] += v[0]
+                    par[1] = min(par[1], v[1])
+                    par[2] = max(par[2], v[2])
+        logger.warning(f"[ip-record] volcado fallido ({len(listos)} pares): {e}")
+        return 0
+
+    ahora = time.monotonic()
+    with _ip_lock:
+        for k in listos:
+            _ip_written[k] = ahora
+        _ip_stats['flushes'] += 1
+        _ip_stats['rows_written'] += len(listos)
+    return len(listos)
+
+
+def _ip_flush_loop():
+    while True:
+        _ip_wakeup.wait(IP_FLUSH_SECONDS)
+        _ip_wakeup.clear()
+        try:
+            flush_ip_activity()
+        except Exception as e:
+            logger.warning(f"[ip-record] error en el hilo de volcado: {e}")
+
+
+def _ensure_ip_flusher():
+    """Arranca el hilo de volcado una vez por proceso (tras el fork de gunicorn)."""
+    pid = os.getpid()
+    if _ip_flusher['pid'] == pid:
+        return
+    with _ip_lock:
+        if _ip_flusher['pid'] == pid:
+            return
+        _ip_flusher['pid'] = pid
+    threading.Thread(target=_ip_flush_loop, name='ip-record-flush', daemon=True).start()
+
+
+def get_ip_record_stats():
+    with _ip_lock:
+        out = dict(_ip_stats)
+        out.update({'pending': len(_ip_pending), 'tracked': len(_ip_written)})
+    out.update({'interval': IP_RECORD_INTERVAL, 'flush_seconds': IP_FLUSH_SECONDS})
+    return out
+
+
+@atexit.register
+def _flush_ip_activity_at_exit():
+    if _ip_pending:
+        try:
+            flush_ip_activity(force=True)
+        except Exception:
+            pass
+
+
+# ── Rate limiting compartido (GCRA) ───────────────────────────
+# Un limite por clave = UNA fila con su "theoretical arrival time" (tat):
+# cada peticion permitida lo adelanta window/max_calls segundos y se
+# rechaza si quedaria mas de una ventana por delante de ahora. Cuesta un
+# UPDATE atomico por peticion (row lock de una sentencia, sin transaccion)
+# y el limite es global entre todos los workers y nodos.
+# RATE_LIMIT_BACKEND=local lo deja en memoria de cada worker (O(1), LRU
+# acotado); si la base de datos falla tambien se cae a ese modo.
+RATE_LIMIT_BACKEND = (os.environ.get('RATE_LIMIT_BACKEND', 'db') or 'db').strip().lower()
+RATE_LIMIT_LOCAL_MAX = max(1000, _env_num('RATE_LIMIT_LOCAL_MAX', 20000))
+RATE_LIMIT_PURGE_SECONDS = max(10.0, _env_num('RATE_LIMIT_PURGE_SECONDS', 300, float))
+
+_rl_local = collections.OrderedDict()   # clave -> tat
+_rl_lock = threading.Lock()
+_rl_stats = {'allowed': 0, 'limited': 0, 'db_errors': 0, 'purged': 0, 'next_purge': 0.0}
+
+
+def _gcra(tat, ahora, max_calls, window_seconds):
+    """(permitido, nuevo_tat, espera) para una rafaga de max_calls por ventana."""
+    intervalo = window_seconds / max_calls
+    tolerancia = window_seconds - intervalo
+    tat = max(tat or 0.0, ahora)
+    if tat - ahora > tolerancia:
+        return False, tat, tat - tolerancia - ahora
+    return True, tat + intervalo, 0.0
+
+
+def _rl_hit_local(clave, max_calls, window_seconds, ahora):
+    with _rl_lock:
+        ok, tat, espera = _gcra(_rl_local.get(clave), ahora, max_calls, window_seconds)
+        if ok:
+            _rl_local[clave] = tat
+            _rl_local.move_to_end(clave)
+            while len(_rl_local) > RATE_LIMIT_LOCAL_MAX:
+                _rl_local.popitem(last=False)
+    return ok, espera
+
+
+def _rl_hit_db(clave, max_calls, window_seconds, ahora):
+    intervalo = window_seconds / max_calls
+    tolerancia = window_seconds - intervalo
+    actualizar = ("UPDATE rate_limits SET tat = GREATEST(tat, %s) + %s "
+                  "WHERE rl_key = %s AND GREATEST(tat, %s) - %s <= %s")
+    args = (ahora, intervalo, clave, ahora, ahora, tolerancia)
+    # Camino normal: la fila existe y hay hueco -> una sola sentencia.
+    # tat siempre cambia (+intervalo), asi que rowcount es fiable.
+    if execute_update_rowcount(actualizar, args):
+        return True, 0.0
+    # Primera peticion de la clave (o fila purgada)
+    insertar = ("INSERT IGNORE INTO rate_limits (rl_key, tat) VALUES (%s, %s)",
+                (clave, ahora + intervalo))
+    if execute_update_rowcount(*insertar):
+        return True, 0.0
+    # La fila existe: lo normal es que este por encima del limite (3 round
+    # trips en total). Solo si se purgo justo entre medias se reintenta.
+    fila = execute_query("SELECT tat FROM rate_limits WHERE rl_key = %s", (clave,), fetch_one=True)
+    if fila is None:
+        return bool(execute_update_rowcount(*insertar)), 0.0
+    ok, _, espera = _gcra(float(fila['tat']), ahora, max_calls, window_seconds)
+    if ok:
+        # Otro worker creo la fila entre el UPDATE y el INSERT y queda hueco
+        ok = bool(execute_update_rowcount(actualizar, args))
+    return ok, espera
+
+
+def _rl_purge(ahora):
+    """Borra filas caducadas (tat < ahora equivale a no tener fila)."""
+    with _rl_lock:
+        if ahora < _rl_stats['next_purge']:
+            return
+        _rl_stats['next_purge'] = ahora + RATE_LIMIT_PURGE_SECONDS
+    try:
+        n = execute_update_rowcount("DELETE FROM rate_limits WHERE tat < %s LIMIT 5000", (ahora,))
+        with _rl_lock:
+            _rl_stats['purged'] += n or 0
+    except Exception as e:
+        logger.warning(f"[rate-limit] purga fallida: {e}")
+
+
+def rate_limit_hit(clave, max_calls, window_seconds):
+    """Cuenta una peticion de `clave`. Devuelve (permitido, segundos_de_espera).
+
+    Ventana GCRA: admite rafagas de max_calls y recupera una plaza cada
+    window_seconds/max_calls. Con el backend 'db' el limite es el mismo
+    para todos los workers; si la base de datos no responde se aplica el
+    limite local del worker en vez de dejar pasar todo.
+    """
+    ahora = time.time()
+    clave = str(clave)[:191]
+    if RATE_LIMIT_BACKEND == 'db':
+        try:
+            ok, espera = _rl_hit_db(clave, max_calls, window_seconds, ahora)
+            _rl_purge(ahora)
+        except Exception as e:
+            with _rl_lock:
+                _rl_stats['db_errors'] += 1
+                avisar = _rl_stats['db_errors'] % 100 == 1
+            if avisar:
+                logger.warning(f"[rate-limit] backend db no disponible, limite local: {e}")
+            ok, espera = _rl_hit_local(clave, max_calls, window_seconds, ahora)
+    else:
+        ok, espera = _rl_hit_local(clave, max_calls, window_seconds, ahora)
+    with _rl_lock:
+        _rl_stats['allowed' if ok else 'limited'] += 1
+    return ok, espera
+
+
+def get_rate_limit_stats():
+    with _rl_lock:
+        out = {k: v for k, v in _rl_stats.items() if k != 'next_purge'}
+        out['local_keys'] = len(_rl_local)
+    out['backend'] = RATE_LIMIT_BACKEND
+    return out
+
+
+# ── Cache compartida de pertenencia a canales de Telegram ─────
+# getChatMember es una llamada HTTP lenta; el resultado se comparte entre
+# workers (y entre la web y el bot) en channel_membership. La politica de
+# TTL y la revalidacion viven en app.py; aqui solo lectura/escritura.
+CHANNEL_CACHE_PURGE_SECONDS = 3600
+_ch_purge = {'next': 0.0}
+
+
+def get_channel_memberships(user_id, channels):
+    """{canal: (checked_at, is_member)} de lo guardado para este usuario."""
+    if not channels:
+        return {}
+    marcas = ','.join(['%s'] * len(channels))
+    rows = execute_query(
+        f"SELECT channel, is_member, checked_at FROM channel_membership "
+        f"WHERE user_id = %s AND channel IN ({marcas})",
+        (str(user_id),) + tuple(channels), fetch_all=True
+    ) or []
+    return {r['channel']: (float(r['checked_at']), bool(r['is_member'])) for r in rows}
+
+
+def save_channel_membership(user_id, channel, is_member, checked_at, max_age=86400):
+    execute_query(
+        "INSERT INTO channel_membership (user_id, channel, is_member, checked_at) "
+        "VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE "
+        "is_member = VALUES(is_member), checked_at = VALUES(checked_at)",
+        (str(user_id), channel, 1 if is_member else 0, checked_at)
+    )
+    if checked_at >= _ch_purge['next']:
+        _ch_purge['next'] = checked_at + CHANNEL_CACHE_PURGE_SECONDS
+        execute_update_rowcount(
+            "DELETE FROM channel_membership WHERE checked_at < %s LIMIT 5000",
+            (checked_at - max_age,)
+        )
+
+
+def clear_channel_memberships(user_id=None, channel=None):
+    if user_id is None and channel is None:
+        return execute_update_rowcount("DELETE FROM channel_membership")
+    if channel is None:
+        return execute_update_rowcount("DELETE FROM channel_membership WHERE user_id = %s",
+                                       (str(user_id),))
+    if user_id is None:
+        return execute_update_rowcount("DELETE FROM channel_membership WHERE channel = %s",
+                                       (channel,))
+    return execute_update_rowcount(
+        "DELETE FROM channel_membership WHERE user_id = %s AND channel = %s",
+        (str(user_id), channel)
+    )
+
+
+# Cuentas distintas que usaron una IP en la ventana, mas antiguas primero
+IP_OCCUPANTS_SQL = ("SELECT user_id, MIN(first_seen) AS entro FROM user_ips "
+                    "WHERE ip_address = %s AND last_seen >= DATE_SUB(NOW(), INTERVAL %s HOUR) "
+                    "GROUP BY user_id ORDER BY entro ASC")
+# Partes del UNION ALL de load_request_context()
+REQUEST_CTX_BAN_SQL = ("SELECT 'ban' AS k, NULL AS user_id, NULL AS entro "
+                       "FROM (SELECT 1 AS x FROM ip_bans WHERE ip_address = %s LIMIT 1) b")
+REQUEST_CTX_IP_SQL = f"SELECT 'ip' AS k, user_id, entro FROM ({IP_OCCUPANTS_SQL} LIMIT %s) o"
 
-    update_user(user_id, last_ip=ip_address, last_active=datetime.now())
 
 def ip_gate(user_id, ip_address, max_accounts=None, window_hours=24):
     """
@@ -1275,7 +3295,24 @@ def ip_gate(user_id, ip_address, max_accounts=None, window_hours=24):
         return True
 
     uid = str(user_id)
+    max_accounts = _ip_gate_limit(uid, max_accounts)
+    if not max_accounts:
+        return True
+
+    try:
+        # Cuentas distintas que usaron esta IP en la ventana, más antiguas primero
+        rows = execute_query(IP_OCCUPANTS_SQL, (ip_address, int(window_hours)), fetch_all=True) or []
+
+        ocupantes = [str(r['user_id']) for r in rows if r.get('user_id')]
+        return _ip_gate_decide(uid, ip_address, ocupantes, max_accounts)
+    except Exception as e:
+        logger.warning(f"[ip_gate] error (deja pasar): {e}")
+        return True
 
+
+def _ip_gate_limit(uid, max_accounts=None):
+    """Cupo de cuentas por IP que aplica a uid, o 0 si no hay que comprobar
+    nada (sistema desactivado, sin limite o administrador)."""
     # Config: máximo de cuentas por IP (0 = sin límite)
     if max_accounts is None:
         try:
@@ -1283,50 +3320,84 @@ def ip_gate(user_id, ip_address, max_accounts=None, window_hours=24):
         except Exception:
             max_accounts = 2
     if max_accounts <= 0:
-        return True
+        return 0
 
     # Si el sistema está desactivado, dejar pasar
     if get_config('ip_limit_enabled', '0') != '1':
-        return True
+        return 0
 
     # Los administradores nunca se bloquean
     try:
         import os as _os
         _admins = set(a.strip() for a in _os.environ.get('ADMIN_IDS', '5515244003').split(',') if a.strip())
         if uid in _admins:
-            return True
+            return 0
     except Exception:
         pass
+    return max_accounts
 
-    try:
-        # Cuentas distintas que usaron esta IP en la ventana, más antiguas primero
-        rows = execute_query(
-            """SELECT user_id, MIN(first_seen) AS entro
-               FROM user_ips
-               WHERE ip_address = %s
-                 AND last_seen >= DATE_SUB(NOW(), INTERVAL %s HOUR)
-               GROUP BY user_id
-               ORDER BY entro ASC""",
-            (ip_address, int(window_hours)), fetch_all=True
-        ) or []
 
-        ocupantes = [str(r['user_id']) for r in rows if r.get('user_id')]
+def _ip_gate_decide(uid, ip_address, ocupantes, max_accounts):
+    """ocupantes: cuentas de la IP en la ventana, las mas antiguas primero."""
+    # Ya tiene cupo (está entre los primeros) → puede entrar
+    if uid in ocupantes[:max_accounts]:
+        return True
 
-        # Ya tiene cupo (está entre los primeros) → puede entrar
-        if uid in ocupantes[:max_accounts]:
-            return True
+    # Hay hueco libre → puede entrar
+    if len(ocupantes) < max_accounts:
+        return True
 
-        # Hay hueco libre → puede entrar
-        if len(ocupantes) < max_accounts:
-            return True
+    # Cupo lleno y no es de los primeros → bloquear
+    logger.info(f"[ip_gate] 🚫 {uid} BLOQUEADO en {ip_address} · "
+                f"ocupada por {ocupantes[:max_accounts]} · máx={max_accounts}")
+    return False
 
-        # Cupo lleno y no es de los primeros → bloquear
-        logger.info(f"[ip_gate] 🚫 {uid} BLOQUEADO en {ip_address} · "
-                    f"ocupada por {ocupantes[:max_accounts]} · máx={max_accounts}")
-        return False
+
+def load_request_context(user_id, ip_address, window_hours=24):
+    """Lo que require_user necesita saber de la IP, en UN round trip:
+    {'ip_banned': bool, 'ip_allowed': bool}.
+
+    Junta is_ip_banned() e ip_gate(): la config sale de la cache en memoria,
+    el baneo del indice de baneos en memoria y los primeros `cupo` ocupantes
+    de la IP de una consulta. Sin indice (falta config_version) el baneo va
+    en la misma consulta con un UNION ALL.
+    """
+    ctx = {'ip_banned': False, 'ip_allowed': True}
+    if not ip_address:
+        return ctx
+    uid = str(user_id)
+    max_accounts = _ip_gate_limit(uid) if user_id else 0
+
+    bans = _ip_ban_index()
+    if bans is not None:
+        ctx['ip_banned'] = bans.contains(ip_address)
+        partes, params = [], []
+    else:
+        partes = [REQUEST_CTX_BAN_SQL]
+        params = [ip_address]
+    if not partes and not max_accounts:
+        return ctx
+    if max_accounts:
+        partes.append(REQUEST_CTX_IP_SQL)
+        params += [ip_address, int(window_hours), max_accounts]
+    try:
+        rows = execute_query(" UNION ALL ".join(partes), tuple(params), fetch_all=True) or []
     except Exception as e:
-        logger.warning(f"[ip_gate] error (deja pasar): {e}")
-        return True
+        # Mismo comportamiento que antes: el baneo se comprueba, el cupo deja pasar
+        logger.warning(f"[request_ctx] error, consultas por separado: {e}")
+        ctx['ip_banned'] = is_ip_banned(ip_address)
+        return ctx
+
+    ocupantes = []
+    for r in rows:
+        if r['k'] == 'ban':
+            ctx['ip_banned'] = True
+        elif r.get('user_id'):
+            ocupantes.append((r['entro'], str(r['user_id'])))
+    if max_accounts:
+        ocupantes.sort(key=lambda o: o[0])
+        ctx['ip_allowed'] = _ip_gate_decide(uid, ip_address, [u for _, u in ocupantes], max_accounts)
+    return ctx
 
 
 def get_ip_occupants(ip_address, window_hours=24):
@@ -1399,10 +3470,127 @@ def clear_ip_records(ip_address=None, user_id=None, older_than_hours=None):
         return 0
 
 
+# Indice de baneos de IP por worker. is_ip_banned() consultaba ip_bans en
+# cada peticion y solo encontraba direcciones exactas. Ahora la tabla se
+# carga en memoria como rangos [inicio, fin] ordenados y fusionados (una
+# direccion es un rango de 1, un '1.2.3.0/24' o '2001:db8::/64' uno grande):
+# buscar es un bisect y 300k baneos IPv4 ocupan ~2.4 MB en dos array('I').
+# ban_ip()/unban_ip() incrementan la fila 2 de config_version y los workers
+# la revalidan como mucho cada IP_BAN_CHECK_SECONDS (igual que la config).
+IP_BAN_CHECK_SECONDS = max(0.0, _env_num('IP_BAN_CHECK_SECONDS', 2.0, float))
+_BAN_VERSION_ID = 2   # fila de config_version para ip_bans
+
+
+class _IpBanIndex:
+    """Rangos baneados por familia + las entradas que no son IP/CIDR validas."""
+
+    def __init__(self, entradas):
+        v4, v6, raw = [], [], set()
+        for e in entradas:
+            try:
+                net = ipaddress.ip_network(str(e).strip(), strict=False)
+            except ValueError:
+                raw.add(str(e).strip())
+                continue
+            # contains() desenvuelve ::ffff:a.b.c.d a IPv4: el baneo tambien
+            if (net.version == 6 and net.prefixlen >= 96
+                    and net.network_address.ipv4_mapped is not None):
+                net = ipaddress.ip_network(
+                    (net.network_address.ipv4_mapped, net.prefixlen - 96))
+            rango = (int(net.network_address), int(net.broadcast_address))
+            (v4 if net.version == 4 else v6).append(rango)
+        self.v4_start, self.v4_end = self._merge(v4, array.array('I'), array.array('I'))
+        self.v6_start, self.v6_end = self._merge(v6, [], [])
+        self.raw = frozenset(raw)
+        self.size = len(self.v4_start) + len(self.v6_start) + len(self.raw)
+
+    @staticmethod
+    def _merge(rangos, starts, ends):
+        for a, b in sorted(rangos):
+            if ends and a <= ends[-1] + 1:
+                if b > ends[-1]:
+                    ends[-1] = b
+            else:
+                starts.append(a)
+                ends.append(b)
+        return starts, ends
+
+    def contains(self, ip_address):
+        try:
+            ip = ipaddress.ip_address(str(ip_address).strip())
+        except ValueError:
+            return str(ip_address).strip() in self.raw
+        if ip.version == 6 and ip.ipv4_mapped is not None:
+            ip = ip.ipv4_mapped
+        starts, ends = (self.v4_start, self.v4_end) if ip.version == 4 else (self.v6_start, self.v6_end)
+        n = int(ip)
+        i = bisect.bisect_right(starts, n) - 1
+        return i >= 0 and n <= ends[i]
+
+
+_ip_ban_state = {'index': None, 'version': None, 'checked': 0.0}
+_ip_ban_lock = threading.Lock()
+
+
+def _ip_ban_index():
+    """Indice vigente, o None si no se puede cachear (sin config_version)."""
+    st = _ip_ban_state
+    if st['index'] is not None and time.monotonic() - st['checked'] < IP_BAN_CHECK_SECONDS:
+        return st['index']
+    with _ip_ban_lock:
+        if st['index'] is not None and time.monotonic() - st['checked'] < IP_BAN_CHECK_SECONDS:
+            return st['index']
+        try:
+            row = execute_query("SELECT version FROM config_version WHERE id = %s",
+                                (_BAN_VERSION_ID,), fetch_one=True)
+        except Exception:
+            return None
+        version = int(row['version']) if row else 0
+        if st['index'] is None or version != st['version']:
+            rows = execute_query("SELECT ip_address FROM ip_bans", fetch_all=True) or []
+            st['index'] = _IpBanIndex(r['ip_address'] for r in rows)
+            st['version'] = version
+            logger.info(f"[ip_bans] indice cargado: {st['index'].size} rangos (v{version})")
+        st['checked'] = time.monotonic()
+        return st['index']
+
+
+def _bump_ban_version():
+    try:
+        execute_query(
+            "INSERT INTO config_version (id, version) VALUES (%s, 1) "
+            "ON DUPLICATE KEY UPDATE version = version + 1", (_BAN_VERSION_ID,)
+        )
+    except Exception as e:
+        logger.warning(f"[ip_bans] no se pudo incrementar la version: {e}")
+    with _ip_ban_lock:
+        _ip_ban_state['checked'] = 0.0
+
+
+def _normalize_ban(ip_address):
+    """'1.2.3.9/24' -> '1.2.3.0/24'. Las direcciones sueltas se dejan igual."""
+    ip_address = str(ip_address).strip()
+    if '/' in ip_address:
+        try:
+            return str(ipaddress.ip_network(ip_address, strict=False))
+        except ValueError:
+            pass
+    return ip_address
+
+
+def ip_prefix_network(ip_address):
+    """Red que agrupa a una IP para baneos por rango: /24 en IPv4, /64 en IPv6."""
+    ip = ipaddress.ip_address(str(ip_address).strip())
+    return str(ipaddress.ip_network(f"{ip}/{24 if ip.version == 4 else 64}", strict=False))
+
+
 def is_ip_banned(ip_address):
-    """Check if IP is banned"""
+    """Check if IP is banned (direccion exacta o dentro de un rango CIDR)"""
     if not ip_address:
         return False
+    bans = _ip_ban_index()
+    if bans is not None:
+        return bans.contains(ip_address)
     result = execute_query(
         "SELECT id FROM ip_bans WHERE ip_address = %s",
         (ip_address,), fetch_one=True
@@ -1410,31 +3598,37 @@ def is_ip_banned(ip_address):
     return result is not None
 
 def ban_ip(ip_address, reason=None):
-    """Ban an IP address"""
+    """Ban an IP address o un rango CIDR ('100.64.12.0/24')"""
     execute_query("""
         INSERT INTO ip_bans (ip_address, reason) VALUES (%s, %s)
         ON DUPLICATE KEY UPDATE reason = VALUES(reason)
-    """, (ip_address, reason))
+    """, (_normalize_ban(ip_address), reason))
+    _bump_ban_version()
 
 def unban_ip(ip_address):
-    """Unban an IP address"""
-    execute_query("DELETE FROM ip_bans WHERE ip_address = %s", (ip_address,))
+    """Unban an IP address o un rango CIDR"""
+    execute_query("DELETE FROM ip_bans WHERE ip_address = %s", (_normalize_ban(ip_address),))
+    _bump_ban_version()
 
 # ============================================
 # LEADERBOARD OPERATIONS
 # ============================================
 
-def get_top_earners(limit=10):
-    """Get top earners by total DOGE earned"""
-    query = """
+TOP_EARNERS_SQL = """
         SELECT user_id, username, first_name, total_earned, doge_balance
         FROM users
         WHERE banned = 0
         ORDER BY total_earned DESC
         LIMIT %s
     """
-    return execute_query(query, (limit,), fetch_all=True) or []
 
+
+@read_only_tolerant
+def get_top_earners(limit=10):
+    """Get top earners by total DOGE earned"""
+    return execute_query(TOP_EARNERS_SQL, (limit,), fetch_all=True) or []
+
+@read_only_tolerant
 def get_top_referrers(limit=10):
     """Get top referrers"""
     query = """
@@ -1446,6 +3640,7 @@ def get_top_referrers(limit=10):
     """
     return execute_query(query, (limit,), fetch_all=True) or []
 
+@read_only_tolerant
 def get_top_streakers(limit=10):
     """Get users with longest check-in streaks"""
     query = """
@@ -1457,6 +3652,123 @@ def get_top_streakers(limit=10):
     """
     return execute_query(query, (limit,), fetch_all=True) or []
 
+
+# ── Clasificaciones materializadas ────────────────────────────
+# /explore hacia tres ORDER BY ... LIMIT sobre users y get_all_stats() en
+# cada visita. Ahora un job de fondo (un solo worker) las recalcula cada
+# LEADERBOARD_REFRESH_SECONDS y las guarda en la tabla leaderboards; cada
+# worker las relee como mucho cada LEADERBOARD_CACHE_SECONDS. El puesto
+# del usuario es exacto: COUNT(*) sobre idx_banned_earned, cacheado por
+# usuario mientras su total_earned no cambie.
+LEADERBOARD_SIZE = max(10, _env_num('LEADERBOARD_SIZE', 10))
+LEADERBOARD_REFRESH_SECONDS = max(10.0, _env_num('LEADERBOARD_REFRESH_SECONDS', 60, float))
+LEADERBOARD_CACHE_SECONDS = max(1.0, _env_num('LEADERBOARD_CACHE_SECONDS', 15, float))
+USER_RANK_CACHE_MAX = max(100, _env_num('USER_RANK_CACHE_MAX', 20000))
+
+_LEADERBOARDS = ('earners', 'referrers', 'streakers', 'stats')
+_lb_cache = {'data': None, 'checked': 0.0}
+_lb_lock = threading.Lock()
+_lb_refresh_lock = threading.Lock()   # un solo hilo recalcula a la vez
+_rank_cache = collections.OrderedDict()   # uid -> (expira, total_earned, puesto)
+
+
+def _lb_default(v):
+    if isinstance(v, Decimal):
+        return float(v)
+    if isinstance(v, (datetime, date)):
+        return v.isoformat()
+    return str(v)
+
+
+def refresh_leaderboards():
+    """Recalcula las clasificaciones y los stats y los guarda en leaderboards."""
+    datos = {
+        'earners': get_top_earners(LEADERBOARD_SIZE),
+        'referrers': get_top_referrers(LEADERBOARD_SIZE),
+        'streakers': get_top_streakers(LEADERBOARD_SIZE),
+        'stats': get_all_stats(),
+    }
+    ahora = time.time()
+    filas = [(board, json.dumps(datos[board], default=_lb_default), ahora) for board in _LEADERBOARDS]
+    execute_query(
+        "INSERT INTO leaderboards (board, payload, refreshed_at) VALUES "
+        + ', '.join(['(%s, %s, %s)'] * len(filas))
+        + " ON DUPLICATE KEY UPDATE payload = VALUES(payload), refreshed_at = VALUES(refreshed_at)",
+        tuple(x for f in filas for x in f)
+    )
+    datos = {board: json.loads(payload) for board, payload, _ in filas}
+    with _lb_lock:
+        _lb_cache['data'] = datos
+        _lb_cache['checked'] = time.monotonic()
+    return datos
+
+
+def get_leaderboards():
+    """{'earners', 'referrers', 'streakers', 'stats'} de la ultima foto.
+
+    Si la foto falta o lleva mas de tres refrescos sin actualizarse (el job
+    no esta corriendo) la recalcula este worker: un solo hilo, los demas
+    sirven la foto anterior (o esperan si aun no hay ninguna)."""
+    snap = _lb_cache
+    if snap['data'] is not None and time.monotonic() - snap['checked'] < LEADERBOARD_CACHE_SECONDS:
+        return snap['data']
+    with _lb_lock:
+        if snap['data'] is not None and time.monotonic() - snap['checked'] < LEADERBOARD_CACHE_SECONDS:
+            return snap['data']
+        try:
+            rows = execute_query("SELECT board, payload, refreshed_at FROM leaderboards",
+                                 fetch_all=True) or []
+        except Exception as e:
+            logger.warning(f"[leaderboard] no se pudo leer la foto: {e}")
+            rows = []
+        fotos = {r['board']: r for r in rows}
+        limite = time.time() - 3 * LEADERBOARD_REFRESH_SECONDS
+        if all(b in fotos and float(fotos[b]['refreshed_at']) >= limite for b in _LEADERBOARDS):
+            snap['data'] = {b: json.loads(fotos[b]['payload']) for b in _LEADERBOARDS}
+            snap['checked'] = time.monotonic()
+            return snap['data']
+    if not _lb_refresh_lock.acquire(blocking=snap['data'] is None):
+        return snap['data']
+    try:
+        # Quien esperaba sin foto la encuentra hecha por el hilo anterior
+        if snap['data'] is not None and time.monotonic() - snap['checked'] < LEADERBOARD_CACHE_SECONDS:
+            return snap['data']
+        return refresh_leaderboards()
+    except Exception as e:
+        logger.warning(f"[leaderboard] refresco fallido: {e}")
+        if snap['data'] is not None:
+            return snap['data']
+        return {'earners': get_top_earners(LEADERBOARD_SIZE),
+                'referrers': get_top_referrers(LEADERBOARD_SIZE),
+                'streakers': get_top_streakers(LEADERBOARD_SIZE),
+                'stats': get_all_stats()}
+    finally:
+        _lb_refresh_lock.release()
+
+
+@read_only_tolerant
+def get_user_rank(user_id, total_earned):
+    """Puesto exacto por total_earned entre usuarios no baneados (1 = primero;
+    los empates comparten puesto)."""
+    uid = str(user_id)
+    ahora = time.monotonic()
+    with _lb_lock:
+        hit = _rank_cache.get(uid)
+        if hit is not None and hit[0] > ahora and hit[1] == total_earned:
+            _rank_cache.move_to_end(uid)
+            return hit[2]
+    row = execute_query(
+        "SELECT COUNT(*) AS c FROM users WHERE banned = 0 AND total_earned > %s",
+        (total_earned or 0,), fetch_one=True
+    )
+    puesto = int(row['c'] if row else 0) + 1
+    with _lb_lock:
+        _rank_cache[uid] = (ahora + LEADERBOARD_REFRESH_SECONDS, total_earned, puesto)
+        _rank_cache.move_to_end(uid)
+        while len(_rank_cache) > USER_RANK_CACHE_MAX:
+            _rank_cache.popitem(last=False)
+    return puesto
+
 # ============================================
 # PROMO CODE MANAGEMENT (Extended)
 # ============================================
@@ -1617,6 +3929,7 @@ def reset_free_plan_ad_progress(user_id, plan_id):
     )
 
 
+@retry_transaction
 def purchase_mining_machine(user_id, plan_id):
     """Purchase a mining machine — free plans skip balance check, 30-day cooldown per plan"""
     import uuid
@@ -1627,7 +3940,7 @@ def purchase_mining_machine(user_id, plan_id):
     if not plan.get('active'):
         return {'success': False, 'err_code': 'api_plan_unavailable'}
 
-    user = get_user(user_id)
+    user = get_user(user_id, fresh=True)
     if not user:
         return {'success': False, 'err_code': 'api_user_not_found'}
 
@@ -1658,18 +3971,22 @@ def purchase_mining_machine(user_id, plan_id):
         balance = float(user.get('doge_balance', 0))
         if balance < price:
             return {'success': False, 'err_code': 'api_insufficient_funds', 'amount': f'{price:.2f}'}
-        update_balance(user_id, -price, 'mining_purchase', f'Plan {plan["name"]} activated')
 
-    # ── Create machine ──
+    # ── Cobro + maquina en una sola transaccion ──
     machine_id = f"machine_{uuid.uuid4().hex[:12]}"
     duration_days = plan.get('duration_days', 30)
     expires_at = datetime.now() + timedelta(days=duration_days)
 
-    execute_query("""
-        INSERT INTO user_mining_machines
-        (machine_id, user_id, plan_id, plan_name, hourly_rate, last_claim_at, expires_at)
-        VALUES (%s, %s, %s, %s, %s, NOW(), %s)
-    """, (machine_id, str(user_id), plan_id, plan['name'], plan['hourly_rate'], expires_at))
+    with unit_of_work():
+        if not is_free and not update_balance(user_id, -price, 'mining_purchase',
+                                              f'Plan {plan["name"]} activated'):
+            return {'success': False, 'err_code': 'api_insufficient_funds', 'amount': f'{price:.2f}'}
+
+        execute_query("""
+            INSERT INTO user_mining_machines
+            (machine_id, user_id, plan_id, plan_name, hourly_rate, last_claim_at, expires_at)
+            VALUES (%s, %s, %s, %s, %s, NOW(), %s)
+        """, (machine_id, str(user_id), plan_id, plan['name'], plan['hourly_rate'], expires_at))
 
     action = 'free' if is_free else f'paid_{price:.2f}'
     # Al activar exitosamente el plan gratis, reiniciar el contador de anuncios
@@ -1687,14 +4004,22 @@ def purchase_mining_machine(user_id, plan_id):
         'machine_id': machine_id
     }
 
-def get_user_machines(user_id):
-    """Get user's active mining machines"""
-    query = """
+# Barrido de depositos TON pendientes (_background_deposit_scanner en app.py)
+PENDING_DEPOSITS_SQL = ("SELECT deposit_id, user_id FROM ton_deposits "
+                        "WHERE status='pending' AND created_at >= NOW() - INTERVAL 1 DAY "
+                        "ORDER BY created_at DESC LIMIT 50")
+
+
+USER_MACHINES_SQL = """
         SELECT * FROM user_mining_machines
         WHERE user_id = %s AND expires_at > NOW()
         ORDER BY purchased_at DESC
     """
-    return execute_query(query, (str(user_id),), fetch_all=True) or []
+
+
+def get_user_machines(user_id):
+    """Get user's active mining machines"""
+    return execute_query(USER_MACHINES_SQL, (str(user_id),), fetch_all=True) or []
 
 def get_active_plans_for_users(user_ids):
     """
@@ -1772,6 +4097,13 @@ def get_pending_mining_rewards(user_id):
 MINING_CLAIM_COOLDOWN = int(os.environ.get('MINING_CLAIM_COOLDOWN', 600))
 
 
+CLAIM_COOLDOWN_SQL = """
+            SELECT GREATEST(0, %s - TIMESTAMPDIFF(SECOND, MAX(last_claim_at), NOW())) AS faltan
+            FROM user_mining_machines
+            WHERE user_id = %s AND settled = 0 AND expires_at > NOW()
+        """
+
+
 def get_claim_cooldown_remaining(user_id):
     """Segundos que faltan para que el usuario pueda volver a reclamar.
 
@@ -1779,11 +4111,8 @@ def get_claim_cooldown_remaining(user_id):
     la hora del proceso Python (evita desfases de zona horaria).
     """
     try:
-        row = execute_query("""
-            SELECT GREATEST(0, %s - TIMESTAMPDIFF(SECOND, MAX(last_claim_at), NOW())) AS faltan
-            FROM user_mining_machines
-            WHERE user_id = %s AND settled = 0 AND expires_at > NOW()
-        """, (MINING_CLAIM_COOLDOWN, str(user_id)), fetch_one=True)
+        row = execute_query(CLAIM_COOLDOWN_SQL, (MINING_CLAIM_COOLDOWN, str(user_id)),
+                            fetch_one=True)
         if not row or row.get('faltan') is None:
             return 0
         return int(row['faltan'])
@@ -1894,6 +4223,99 @@ def process_mining_rewards(user_id):
 # LIQUIDACION AUTOMATICA DE PLANES VENCIDOS
 # ============================================
 
+SETTLE_EXPIRED_SQL = """
+                SELECT id, machine_id, user_id, plan_id, plan_name, hourly_rate,
+                       last_claim_at, purchased_at, expires_at
+                FROM user_mining_machines
+                WHERE settled = 0 AND expires_at <= NOW() {filtro_user}
+                ORDER BY expires_at ASC
+                LIMIT %s
+                FOR UPDATE
+            """
+
+
+def _settle_batch(filtro, params):
+    """Liquida en UNA transaccion las maquinas vencidas que cumplan el filtro.
+    Lanza ante cualquier error (la transaccion se deshace entera)."""
+    liquidadas = []
+    with unit_of_work() as (conn, cur):
+        cur.execute(SETTLE_EXPIRED_SQL.format(filtro_user=filtro), tuple(params))
+        vencidas = cur.fetchall() or []
+        if not vencidas:
+            return []
+
+        pendientes = {}
+        for m in vencidas:
+            expires = m.get('expires_at')
+            desde = m.get('last_claim_at') or m.get('purchased_at')
+            pendiente = 0.0
+            if expires and desde:
+                horas = (expires - desde).total_seconds() / 3600
+                if horas > 0:
+                    pendiente = horas * float(m.get('hourly_rate', 0) or 0)
+            pendientes[m['id']] = max(0.0, pendiente)
+
+        # ── GUARD ATOMICO: las filas estan bloqueadas por el FOR UPDATE y
+        # el WHERE settled = 0 se repite por si acaso.
+        ids = [m['id'] for m in vencidas]
+        casos = ' '.join(['WHEN %s THEN %s'] * len(ids))
+        marcas = ','.join(['%s'] * len(ids))
+        cur.execute(f"""
+            UPDATE user_mining_machines
+            SET settled       = 1,
+                last_claim_at = expires_at,
+                total_mined   = total_mined + CASE id {casos} END
+            WHERE id IN ({marcas}) AND settled = 0
+        """, tuple(x for i in ids for x in (i, pendientes[i])) + tuple(ids))
+
+        # ── Al VENCER el plan, borrar el progreso de anuncios ──────────
+        # Los anuncios son DIARIOS: al expirar debe ver los 10 de nuevo.
+        #
+        # IMPORTANTE: solo se borra el progreso ANTERIOR al vencimiento
+        # (updated_at <= expires_at). Este barrido corre cada 5 minutos,
+        # asi que si el usuario ya vio anuncios DESPUES de que venciera,
+        # borrarlos sin mas le reiniciaria el contador delante de las
+        # narices. Con este filtro esos anuncios se respetan.
+        ads = [m for m in vencidas if m.get('expires_at') and m.get('plan_id') is not None]
+        if ads:
+            try:
+                cur.execute(
+                    "DELETE FROM free_plan_ad_progress WHERE "
+                    + ' OR '.join(['(user_id=%s AND plan_id=%s AND updated_at <= %s)'] * len(ads)),
+                    tuple(x for m in ads for x in (str(m['user_id']), m['plan_id'], m['expires_at']))
+                )
+            except Exception as _e_ads:
+                # Un deadlock deshace TODA la transaccion (tambien el
+                # settled = 1): seguir acreditaria saldos fuera de ella.
+                if lock_error_kind(_e_ads) is not None:
+                    raise
+                logger.warning(f"[MINING-SETTLE] no se pudo reiniciar anuncios: {_e_ads}")
+
+        creditos = []
+        for m in vencidas:
+            pendiente = pendientes[m['id']]
+            if pendiente <= 0:
+                continue
+            creditos.append((
+                m['user_id'], pendiente, 'mining_expiry_settlement',
+                f"Saldo restante acreditado al vencer el plan {m.get('plan_name') or ''}".strip()
+            ))
+            liquidadas.append({
+                'user_id':    m['user_id'],
+                'machine_id': m.get('machine_id'),
+                'plan_name':  m.get('plan_name') or 'Mining',
+                'amount':     pendiente,
+                'expires_at': m.get('expires_at'),
+            })
+
+        if creditos:
+            update_balances_bulk(creditos)
+            total = sum(c[1] for c in creditos)
+            increment_stat('total_doge_distributed', int(total * 100000000))
+            pay_referral_commissions_bulk([(c[0], c[1], 'mining') for c in creditos])
+    return liquidadas
+
+
 def settle_expired_machines(user_id=None, limit=300):
     """
     Acredita automaticamente el saldo minado que quedo SIN reclamar cuando
@@ -1905,8 +4327,15 @@ def settle_expired_machines(user_id=None, limit=300):
 
     - Cuenta solo hasta expires_at (nunca mina despues de vencer).
     - Guard atomico `settled = 0` para que dos workers de gunicorn o el
-      barrido en segundo plano no acrediten dos veces lo mismo.
+      barrido en segundo plano no acrediten dos veces lo mismo: las maquinas
+      se bloquean con SELECT ... FOR UPDATE dentro de una sola transaccion.
     - Si user_id es None liquida a TODOS los usuarios (barrido global).
+    - EN LOTE: un UPDATE para todas las maquinas, un DELETE del progreso de
+      anuncios, update_balances_bulk() para los saldos y
+      pay_referral_commissions_bulk() para las comisiones. Antes un barrido
+      de 300 maquinas eran mas de 3.000 consultas secuenciales.
+    - Si el lote falla por algo que no es un lock, se reintenta maquina a
+      maquina y las que fallen se registran y se saltan.
 
     Devuelve lista de dicts: [{'user_id','machine_id','plan_name','amount'}, ...]
     """
@@ -1915,90 +4344,42 @@ def settle_expired_machines(user_id=None, limit=300):
     if user_id is not None:
         filtro_user = "AND user_id = %s"
         params.append(str(user_id))
-    params.append(int(limit))
 
     try:
-        vencidas = execute_query(f"""
-            SELECT id, machine_id, user_id, plan_id, plan_name, hourly_rate,
-                   last_claim_at, purchased_at, expires_at
-            FROM user_mining_machines
-            WHERE settled = 0 AND expires_at <= NOW() {filtro_user}
-            ORDER BY expires_at ASC
-            LIMIT %s
-        """, tuple(params), fetch_all=True) or []
+        liquidadas = _settle_batch(filtro_user, params + [int(limit)])
     except Exception as e:
-        logger.warning(f"[MINING-SETTLE] error consultando vencidas: {e}")
-        return []
-
-    liquidadas = []
-
-    for m in vencidas:
+        if lock_error_kind(e) is not None:
+            logger.warning(f"[MINING-SETTLE] error liquidando lote: {e}")
+            return []
+        # Una fila mala (datos corruptos, plan borrado...) no puede bloquear
+        # el lote para siempre: se liquida maquina a maquina y se salta.
+        logger.warning(f"[MINING-SETTLE] lote fallido ({e}), liquido una a una")
+        liquidadas = []
         try:
-            expires = m.get('expires_at')
-            desde = m.get('last_claim_at') or m.get('purchased_at')
-
-            pendiente = 0.0
-            if expires and desde:
-                horas = (expires - desde).total_seconds() / 3600
-                if horas > 0:
-                    pendiente = horas * float(m.get('hourly_rate', 0) or 0)
-
-            if pendiente < 0:
-                pendiente = 0.0
-
-            # ── GUARD ATOMICO: solo un proceso puede pasar de settled 0 -> 1.
-            # Si otro worker gano la carrera, rowcount = 0 y no acreditamos.
-            filas = execute_update_rowcount("""
-                UPDATE user_mining_machines
-                SET settled       = 1,
-                    last_claim_at = expires_at,
-                    total_mined   = total_mined + %s
-                WHERE id = %s AND settled = 0
-            """, (pendiente, m['id']))
-
-            if not filas:
-                continue  # otro proceso ya lo liquido
-
-            # ── Al VENCER el plan, borrar el progreso de anuncios ──────────
-            # Los anuncios son DIARIOS: al expirar debe ver los 10 de nuevo.
-            #
-            # IMPORTANTE: solo se borra el progreso ANTERIOR al vencimiento
-            # (updated_at <= expires_at). Este barrido corre cada 5 minutos,
-            # asi que si el usuario ya vio anuncios DESPUES de que venciera,
-            # borrarlos sin mas le reiniciaria el contador delante de las
-            # narices. Con este filtro esos anuncios se respetan.
+            filas = execute_query(
+                "SELECT id FROM user_mining_machines "
+                f"WHERE settled = 0 AND expires_at <= NOW() {filtro_user} "
+                "ORDER BY expires_at ASC LIMIT %s",
+                tuple(params + [int(limit)]), fetch_all=True
+            ) or []
+        except Exception as e2:
+            logger.warning(f"[MINING-SETTLE] no se pudieron listar las vencidas: {e2}")
+            return []
+        fallidas = []
+        for r in filas:
             try:
-                if expires and m.get('plan_id') is not None:
-                    execute_query(
-                        "DELETE FROM free_plan_ad_progress "
-                        "WHERE user_id=%s AND plan_id=%s AND updated_at <= %s",
-                        (str(m['user_id']), m.get('plan_id'), expires)
-                    )
-            except Exception as _e_ads:
-                logger.warning(f"[MINING-SETTLE] no se pudo reiniciar anuncios: {_e_ads}")
-
-            if pendiente > 0:
-                update_balance(
-                    m['user_id'], pendiente, 'mining_expiry_settlement',
-                    f"Saldo restante acreditado al vencer el plan {m.get('plan_name') or ''}".strip()
-                )
-                increment_stat('total_doge_distributed', int(pendiente * 100000000))
-                pay_referral_commission(m['user_id'], pendiente, 'mining')
-
-                liquidadas.append({
-                    'user_id':    m['user_id'],
-                    'machine_id': m.get('machine_id'),
-                    'plan_name':  m.get('plan_name') or 'Mining',
-                    'amount':     pendiente,
-                    'expires_at': expires,
-                })
-                logger.info(
-                    f"[MINING-SETTLE] user {m['user_id']} +{pendiente:.8f} "
-                    f"por vencimiento de '{m.get('plan_name')}' (machine {m.get('machine_id')})"
-                )
-        except Exception as e:
-            logger.warning(f"[MINING-SETTLE] error liquidando machine {m.get('id')}: {e}")
-
+                liquidadas.extend(_settle_batch("AND id = %s", [r['id'], 1]))
+            except Exception as e3:
+                fallidas.append(r['id'])
+                logger.warning(f"[MINING-SETTLE] machine {r['id']} no liquidada: {e3}")
+        if fallidas:
+            logger.error(f"[MINING-SETTLE] {len(fallidas)} maquinas saltadas: {fallidas}")
+
+    for l in liquidadas:
+        logger.info(
+            f"[MINING-SETTLE] user {l['user_id']} +{l['amount']:.8f} "
+            f"por vencimiento de '{l['plan_name']}' (machine {l['machine_id']})"
+        )
     return liquidadas
 
 
@@ -2166,11 +4547,13 @@ def init_ton_tables():
         ('ton_deposits_enabled', '1'),
         ('ton_auto_confirm', '0'),
     ]
+    inserted = 0
     for key, val in defaults:
-        execute_query(
+        inserted += execute_update_rowcount(
             "INSERT IGNORE INTO config (config_key, config_value) VALUES (%s, %s)",
             (key, val)
-        )
+        ) or 0
+    config_defaults_seeded(inserted)
 
 
 # Run auto-init at import time — errors are logged but won't crash the app
@@ -2515,11 +4898,13 @@ def init_all_tables():
         ('ton_bot_mnemonic',         os.environ.get('TON_BOT_MNEMONIC', '')),
         ('toncenter_api_key',        os.environ.get('TONCENTER_API_KEY', '')),
     ]
+    inserted = 0
     for key, val in config_defaults:
-        execute_query(
+        inserted += execute_update_rowcount(
             "INSERT IGNORE INTO config (config_key, config_value) VALUES (%s, %s)",
             (key, val)
-        )
+        ) or 0
+    config_defaults_seeded(inserted)
     log.info("✓ config defaults seeded")
 
     # ── Default stats ──────────────────────────────────────────
@@ -2571,7 +4956,8 @@ def init_all_tables():
 # You can also force it with INIT_DB=1.
 _should_init = (
     os.environ.get('RAILWAY_ENVIRONMENT') or
-    os.environ.get('INIT_DB', '0') == '1'
+    os.environ.get('INIT_DB', '0') == '1' or
+    DB_BACKEND == 'sqlite'   # el fichero puede estar recien creado
 )
 if _should_init:
     try:
@@ -2711,6 +5097,7 @@ def delete_user_completely(user_id):
             "UPDATE users SET referred_by = NULL WHERE referred_by = %s",
             (uid,)
         )
+        invalidate_user()
         summary['unlink_referred_by'] = 'ok'
     except Exception as e:
         summary['unlink_referred_by'] = f'skip ({e})'
@@ -2718,6 +5105,7 @@ def delete_user_completely(user_id):
     # Finalmente, borrar el usuario
     try:
         execute_query("DELETE FROM users WHERE user_id = %s", (uid,))
+        invalidate_user(uid)
         summary['users'] = 'ok'
     except Exception as e:
         summary['users'] = f'error ({e})'
@@ -2732,6 +5120,7 @@ def save_user_ton_wallet(user_id, ton_wallet):
         "UPDATE users SET ton_wallet = %s WHERE user_id = %s",
         (ton_wallet, str(user_id))
     )
+    invalidate_user(user_id)
 
 
 def get_wallet_owner(wallet_address):
@@ -2776,6 +5165,7 @@ def link_user_wallet(user_id, wallet_address):
         "UPDATE users SET ton_wallet = %s, wallet_locked = 1 WHERE user_id = %s",
         (wallet_address, uid)
     )
+    invalidate_user(uid)
     return {'success': True}
 
 
@@ -2811,6 +5201,7 @@ def admin_change_user_wallet(user_id, new_wallet):
         "UPDATE users SET ton_wallet = %s, wallet_locked = 1 WHERE user_id = %s",
         (new_wallet, uid)
     )
+    invalidate_user(uid)
     return {'success': True}
 
 
@@ -2834,9 +5225,11 @@ def admin_unlock_user_wallet(user_id):
         "UPDATE users SET wallet_locked = 0 WHERE user_id = %s",
         (uid,)
     )
+    invalidate_user(uid)
     return {'success': True}
 
 
+@read_only_tolerant
 def get_duplicate_wallets():
     """
     Devuelve direcciones de retiro asociadas a más de una cuenta (histórico).
@@ -2873,6 +5266,7 @@ def get_or_create_user_deposit_address(user_id):
             "UPDATE users SET ton_deposit_address = %s WHERE user_id = %s",
             (memo, str(user_id))
         )
+        invalidate_user(user_id)
     except Exception as e:
         # La columna puede no existir aún; el memo es estable de todos modos.
         logger.warning(f"get_or_create_user_deposit_address fallback: {e}")
@@ -2899,33 +5293,167 @@ def create_ton_deposit_pending(user_id, memo):
 # MIGRATION SYSTEM — runs each migration once
 # ============================================
 
+# ============================================
+# BACKFILL POR TRAMOS DE PK
+# ============================================
+# Un UPDATE/INSERT...SELECT sin limites sobre referrals, user_ips o
+# balance_history bloquea la tabla entera mientras dura. backfill() recorre la
+# tabla por rangos de id (cada tramo en su propia transaccion corta), duerme
+# entre tramos, guarda el ultimo id en backfill_progress para retomar donde
+# se quedo y registra filas/segundo.
+
+BACKFILL_CHUNK = max(1, _env_num('BACKFILL_CHUNK', 2000))
+BACKFILL_SLEEP = max(0.0, _env_num('BACKFILL_SLEEP', 0.05, float))
+
+
+def backfill(name, table, step, chunk=None, sleep=None, max_seconds=None,
+             id_col='id', report_every=10.0):
+    """Aplica `step` a `table` por tramos [lo, hi] de `id_col`, reanudable.
+
+    step: SQL con dos %s finales para lo/hi (p. ej. "UPDATE t SET x=1 WHERE
+          id BETWEEN %s AND %s AND ..."), o callable(lo, hi) -> filas afectadas.
+    sleep: pausa entre tramos; ademas se duerme lo mismo que tardo el tramo,
+           para no ocupar mas de ~la mitad del tiempo de la BD.
+    max_seconds: corta tras ese tiempo (se retoma en la siguiente llamada).
+
+    Devuelve {name, done, rows, chunks, last_id, seconds, rows_per_sec}.
+    Solo un proceso ejecuta el mismo backfill a la vez (GET_LOCK).
+    """
+    chunk = chunk or BACKFILL_CHUNK
+    sleep = BACKFILL_SLEEP if sleep is None else sleep
+    res = {'name': name, 'done': False, 'rows': 0, 'chunks': 0,
+           'last_id': 0, 'seconds': 0.0, 'rows_per_sec': 0.0}
+
+    # GET_LOCK vive en la conexion: fijar una al hilo si no hay scope
+    own_scope = not getattr(_local, 'scoped', False)
+    if own_scope:
+        begin_request_scope()
+    lock_name = f"{DB_CONFIG.get('database')}:backfill:{name}"
+    try:
+        got = execute_query("SELECT GET_LOCK(%s, 0) AS got", (lock_name,), fetch_one=True)
+        if not got or got.get('got') != 1:
+            logger.info(f"[backfill] {name}: otro proceso lo esta ejecutando")
+            return res
+        try:
+            execute_query(
+                "INSERT IGNORE INTO backfill_progress (name, table_name) VALUES (%s, %s)",
+                (name, table))
+            prog = execute_query("SELECT * FROM backfill_progress WHERE name=%s",
+                                 (name,), fetch_one=True) or {}
+            if prog.get('finished_at'):
+                res.update(done=True, last_id=int(prog.get('last_id') or 0),
+                           rows=int(prog.get('rows_done') or 0))
+                return res
+            last_id = int(prog.get('last_id') or 0)
+            rows_total = int(prog.get('rows_done') or 0)
+            # El techo se fija al empezar: las filas nuevas ya nacen con el
+            # valor correcto (lo escribe el codigo nuevo), no hace falta perseguirlas.
+            top = execute_query(f"SELECT MAX({id_col}) AS m FROM {table}", fetch_one=True)
+            max_id = int(top['m']) if top and top.get('m') is not None else 0
+
+            t0 = time.monotonic()
+            next_report = t0 + report_every
+            rows_run = 0
+            while last_id < max_id:
+                lo, hi = last_id + 1, min(last_id + chunk, max_id)
+                c0 = time.monotonic()
+                if callable(step):
+                    n = step(lo, hi) or 0
+                else:
+                    n = execute_update_rowcount(step, (lo, hi))
+                n = max(0, n)
+                last_id = hi
+                rows_run += n
+                rows_total += n
+                res['chunks'] += 1
+                execute_query(
+                    "UPDATE backfill_progress SET last_id=%s, rows_done=%s WHERE name=%s",
+                    (last_id, rows_total, name))
+
+                now = time.monotonic()
+                if now >= next_report:
+                    rate = rows_run / (now - t0) if now > t0 else 0.0
+                    logger.info(f"[backfill] {name}: id {last_id}/{max_id} · {rows_total} filas · {rate:.0f} filas/s")
+                    next_report = now + report_every
+                if max_seconds and now - t0 >= max_seconds:
+                    break
+                if last_id < max_id:
+                    time.sleep(sleep + (now - c0))
+
+            res['done'] = last_id >= max_id
+            if res['done']:
+                execute_query("UPDATE backfill_progress SET finished_at=NOW() WHERE name=%s", (name,))
+            res['seconds'] = round(time.monotonic() - t0, 3)
+            res['rows'] = rows_total
+            res['last_id'] = last_id
+            res['rows_per_sec'] = round(rows_run / res['seconds'], 1) if res['seconds'] else 0.0
+            logger.info(
+                f"[backfill] {name}: {'terminado' if res['done'] else 'pausado'} en id {last_id}/{max_id} · "
+                f"{rows_run} filas en {res['seconds']}s ({res['rows_per_sec']} filas/s)"
+            )
+            return res
+        finally:
+            execute_query("SELECT RELEASE_LOCK(%s) AS released", (lock_name,), fetch_one=True)
+    finally:
+        if own_scope:
+            end_request_scope()
+
+
+def get_backfill_progress():
+    """Estado de todos los backfills (para diagnostico)."""
+    return execute_query("SELECT * FROM backfill_progress ORDER BY started_at DESC", fetch_all=True) or []
+
+
+MIGRATION_LOCK_TIMEOUT = max(1, _env_num('MIGRATION_LOCK_TIMEOUT', 120))
+
+
 def _run_migrations():
     """
     Execute pending schema migrations.
     Each migration is recorded in the `schema_migrations` table so it
     only ever runs once, no matter how many times the app restarts.
+
+    Se ejecuta al importar en CADA worker de gunicorn, asi que:
+      - las migraciones se declaran con safe_run()/safe_call() y solo se
+        recogen; los nombres aplicados se leen de una vez, y si no falta
+        ninguna el arranque cuesta un unico SELECT;
+      - si falta alguna, se toma GET_LOCK: solo un proceso migra, el resto
+        espera al lock, relee lo aplicado y ya no tiene nada que hacer.
     """
     log = logging.getLogger(__name__)
 
-    # 1. Ensure the migrations tracking table exists
+    def load_applied():
+        rows = execute_query("SELECT migration_name FROM schema_migrations", fetch_all=True) or []
+        return {r['migration_name'] for r in rows}
+
+    # 1. Nombres ya aplicados (una consulta). Si la tabla no existe, crearla.
     try:
-        execute_query("""
-            CREATE TABLE IF NOT EXISTS schema_migrations (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                migration_name VARCHAR(200) NOT NULL UNIQUE,
-                applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-    except Exception as e:
-        log.error(f"[migrations] Could not create schema_migrations table: {e}")
-        return
+        done = load_applied()
+    except Exception:
+        try:
+            execute_query("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    id INT AUTO_INCREMENT PRIMARY KEY,
+                    migration_name VARCHAR(200) NOT NULL UNIQUE,
+                    applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            done = load_applied()
+        except Exception as e:
+            log.error(f"[migrations] Could not create schema_migrations table: {e}")
+            return
 
-    def applied(name):
-        row = execute_query(
-            "SELECT id FROM schema_migrations WHERE migration_name = %s",
-            (name,), fetch_one=True
-        )
-        return row is not None
+    pending = []
+
+    def safe_run(name, *sqls):
+        """Register a named migration (list of SQL statements); skipped if already applied."""
+        if name not in done:
+            pending.append((name, sqls, None))
+
+    def safe_call(name, fn):
+        """Register a named data migration implemented in Python."""
+        if name not in done:
+            pending.append((name, (), fn))
 
     def mark_done(name):
         try:
@@ -2936,10 +5464,7 @@ def _run_migrations():
         except Exception:
             pass
 
-    def safe_run(name, *sqls):
-        """Run a list of SQL statements as a named migration, skip if already applied."""
-        if applied(name):
-            return
+    def apply(name, sqls, fn):
         for sql in sqls:
             try:
                 execute_query(sql)
@@ -2948,6 +5473,10 @@ def _run_migrations():
                 err = str(e)
                 if '42521' not in err and '42000' not in err and 'Duplicate' not in err and "Can't DROP" not in err:
                     log.warning(f"[migrations] {name}: {e}")
+        if fn is not None and fn() is False:
+            # Backfill a medias: no se marca, se retoma en el siguiente arranque
+            log.info(f"[migrations] … {name} (pendiente, continuara)")
+            return
         mark_done(name)
         log.info(f"[migrations] ✓ {name}")
 
@@ -3091,9 +5620,191 @@ def _run_migrations():
         "DELETE FROM config WHERE config_key IN ('admin_password', 'admin_username')"
     )
 
+    # Contador de version de la config: get_config() cachea la tabla entera
+    # y solo la recarga cuando este numero cambia.
+    safe_run("create_config_version",
+        """CREATE TABLE IF NOT EXISTS config_version (
+            id INT NOT NULL PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0
+        )""",
+        "INSERT IGNORE INTO config_version (id, version) VALUES (1, 0)"
+    )
+
+    # Contadores repartidos en N filas por clave (ver increment_stat).
+    safe_run("create_stats_shards",
+        """CREATE TABLE IF NOT EXISTS stats_shards (
+            stat_key VARCHAR(100) NOT NULL,
+            shard SMALLINT NOT NULL,
+            stat_value BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (stat_key, shard)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci"""
+    )
+
+    # Indices para la paginacion keyset (created_at, id): InnoDB añade el PK
+    # al final de cada indice secundario, asi que (col, created_at) basta.
+    safe_run("add_keyset_pagination_indexes",
+        "ALTER TABLE users ADD INDEX idx_created_at (created_at)",
+        "ALTER TABLE balance_history ADD INDEX idx_user_created (user_id, created_at)",
+        "ALTER TABLE withdrawals ADD INDEX idx_user_created (user_id, created_at)",
+        "ALTER TABLE ton_deposits ADD INDEX idx_user_created (user_id, created_at)",
+        "ALTER TABLE referrals ADD INDEX idx_referrer_created (referrer_id, created_at)",
+    )
+
+    # Indices compuestos para los predicados calientes (ver HOT_QUERIES y
+    # check_indexes.py, que hace EXPLAIN de cada uno y falla si hay full scan).
+    safe_run("add_hot_path_indexes_v1",
+        # get_user_machines / get_claim_cooldown_remaining
+        "ALTER TABLE user_mining_machines ADD INDEX idx_user_settled_expires (user_id, settled, expires_at)",
+        # escaner de depositos pendientes
+        "ALTER TABLE ton_deposits ADD INDEX idx_status_created (status, created_at)",
+        # get_spending_stats / get_spending_history (cubre SUM(net_amount))
+        "ALTER TABLE withdrawals ADD INDEX idx_status_processed (status, processed_at, net_amount)",
+        # ip_gate (cubre el GROUP BY user_id / MIN(first_seen))
+        "ALTER TABLE user_ips ADD INDEX idx_ip_last_seen (ip_address, last_seen, user_id, first_seen)",
+        # get_top_earners y el filtro 'top' de /admin/users
+        "ALTER TABLE users ADD INDEX idx_banned_earned (banned, total_earned)",
+        "ALTER TABLE users ADD INDEX idx_total_earned (total_earned)",
+    )
+
+    # Job multicuenta incremental: ultimo recuento de cuentas por IP y el
+    # indice por last_seen para encontrar las IPs con actividad reciente.
+    safe_run("create_multiaccount_ip_state",
+        """CREATE TABLE IF NOT EXISTS multiaccount_ip_state (
+            ip_address VARCHAR(50) NOT NULL PRIMARY KEY,
+            accounts INT NOT NULL DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci""",
+        "ALTER TABLE user_ips ADD INDEX idx_last_seen (last_seen)"
+    )
+
+    # rate_limit_hit(): una fila por clave con su tat (GCRA). InnoDB y no
+    # MEMORY: bloqueo por fila, no por tabla, con todos los workers a la vez.
+    safe_run("create_rate_limits",
+        """CREATE TABLE IF NOT EXISTS rate_limits (
+            rl_key VARCHAR(191) NOT NULL PRIMARY KEY,
+            tat DOUBLE NOT NULL,
+            INDEX idx_tat (tat)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci"""
+    )
+
+    # Cache compartida de getChatMember (web + bot, todos los workers)
+    safe_run("create_channel_membership",
+        """CREATE TABLE IF NOT EXISTS channel_membership (
+            user_id VARCHAR(50) NOT NULL,
+            channel VARCHAR(100) NOT NULL,
+            is_member TINYINT(1) NOT NULL DEFAULT 0,
+            checked_at DOUBLE NOT NULL,
+            PRIMARY KEY (user_id, channel),
+            INDEX idx_checked_at (checked_at)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci"""
+    )
+
+    # Foto de las clasificaciones de /explore (refresh_leaderboards)
+    safe_run("create_leaderboards",
+        """CREATE TABLE IF NOT EXISTS leaderboards (
+            board VARCHAR(20) NOT NULL PRIMARY KEY,
+            payload MEDIUMTEXT NOT NULL,
+            refreshed_at DOUBLE NOT NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci"""
+    )
+
+    # Progreso de backfill() (rellenos por tramos de PK, reanudables).
+    safe_run("create_backfill_progress",
+        """CREATE TABLE IF NOT EXISTS backfill_progress (
+            name VARCHAR(100) NOT NULL PRIMARY KEY,
+            table_name VARCHAR(64) NOT NULL,
+            last_id BIGINT NOT NULL DEFAULT 0,
+            rows_done BIGINT NOT NULL DEFAULT 0,
+            started_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            finished_at DATETIME DEFAULT NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci"""
+    )
+
+    # Pasos de datos que antes se ejecutaban en cada arranque de cada worker
+    safe_call("ensure_device_hash_column_v1", _ensure_device_hash_column)
+    safe_call("remove_invite_purchase_task_v1", _remove_invite_purchase_task)
+
+    if not pending:
+        return
+
+    # 2. Hay pendientes: un solo proceso migra. GET_LOCK vive en la conexion,
+    # asi que se fija una conexion al hilo mientras dure (scope de peticion).
+    own_scope = not getattr(_local, 'scoped', False)
+    if own_scope:
+        begin_request_scope()
+    lock_name = f"{DB_CONFIG.get('database')}:schema_migrations"
+    try:
+        row = execute_query("SELECT GET_LOCK(%s, %s) AS got", (lock_name, MIGRATION_LOCK_TIMEOUT),
+                            fetch_one=True)
+        if not row or row.get('got') != 1:
+            log.warning(f"[migrations] otro proceso sigue migrando tras {MIGRATION_LOCK_TIMEOUT}s; se omite")
+            return
+        try:
+            # Mientras esperabamos el lock otro proceso pudo aplicarlas
+            done = load_applied()
+            for name, sqls, fn in pending:
+                if name not in done:
+                    apply(name, sqls, fn)
+        finally:
+            execute_query("SELECT RELEASE_LOCK(%s) AS released", (lock_name,), fetch_one=True)
+    finally:
+        if own_scope:
+            end_request_scope()
+
     log.info("[migrations] ✅ All migrations checked.")
 
 
+# ── Consultas calientes: deben usar indice (check_indexes.py) ───
+# (nombre, sql, parametros de ejemplo). Las sentencias son las MISMAS
+# constantes que ejecuta el codigo (no copias), para que el EXPLAIN no se
+# quede comprobando SQL que produccion ya no lanza. Al añadir una consulta
+# de la ruta caliente: constante + entrada aqui + su indice en _run_migrations().
+HOT_QUERIES = [
+    ("get_user_machines", USER_MACHINES_SQL, ('0',)),
+    ("get_claim_cooldown_remaining", CLAIM_COOLDOWN_SQL, (0, '0')),
+    ("deposit_scanner", PENDING_DEPOSITS_SQL, ()),
+    ("get_spending_stats", SPENDING_SUM_SQL.format(where=SPENDING_RANGES['today']), ()),
+    ("get_spending_history", SPENDING_HISTORY_SQL, (30,)),
+    ("ip_gate", IP_OCCUPANTS_SQL, ('0.0.0.0', 24)),
+    ("load_request_context", REQUEST_CTX_IP_SQL, ('0.0.0.0', 24, 2)),
+    ("load_request_context_sin_indice",
+     REQUEST_CTX_BAN_SQL + " UNION ALL " + REQUEST_CTX_IP_SQL, ('0.0.0.0', '0.0.0.0', 24, 2)),
+    ("get_top_earners", TOP_EARNERS_SQL, (10,)),
+    ("settle_expired_machines", SETTLE_EXPIRED_SQL.format(filtro_user=''), (500,)),
+    ("history_movements_keyset",
+     *keyset_sql("SELECT * FROM balance_history", "user_id=%s", ('0',), limit=101)),
+]
+
+
+def explain_hot_queries(small_table_rows=1000):
+    """EXPLAIN de cada consulta de HOT_QUERIES. Devuelve una lista de
+    {name, ok, full_scans, plan}; ok=False si alguna tabla se lee con
+    type=ALL (full table scan). Excepcion: en tablas de menos de
+    `small_table_rows` filas el optimizador prefiere ALL aunque haya indice
+    (pasa en local / staging); eso solo cuenta si no hay ningun indice posible."""
+    resultados = []
+    for name, sql, params in HOT_QUERIES:
+        try:
+            plan = execute_query("EXPLAIN " + sql, params, fetch_all=True) or []
+        except Exception as e:
+            resultados.append({'name': name, 'ok': False, 'error': str(e), 'full_scans': [], 'plan': []})
+            continue
+        full = [
+            r.get('table') for r in plan
+            if str(r.get('type', '')).upper() == 'ALL'
+            and (not r.get('possible_keys') or int(r.get('rows') or 0) >= small_table_rows)
+        ]
+        resultados.append({
+            'name': name,
+            'ok': not full,
+            'full_scans': full,
+            'plan': [{k: r.get(k) for k in ('table', 'type', 'possible_keys', 'key', 'rows', 'Extra')}
+                     for r in plan],
+        })
+    return resultados
+
+
 # ── ANTI-FRAUD stubs — kept for import compatibility ──────────
 def _ensure_fraud_columns():
     pass  # Handled by _run_migrations()
@@ -3101,17 +5812,6 @@ def _ensure_fraud_columns():
 def _migrate_task_completions():
     pass  # Handled by _run_migrations()
 
-# ── Auto-run migrations after all functions are defined ───────
-_should_init_migrations = (
-    os.environ.get('RAILWAY_ENVIRONMENT') or
-    os.environ.get('INIT_DB', '0') == '1' or
-    True  # Always safe to run — each migration executes only once
-)
-try:
-    _run_migrations()
-except Exception as _e:
-    logging.getLogger(__name__).error(f"[migrations] FAILED: {_e}")
-
 # ── Garantía extra: crear device_hash si por alguna razón no existe ──
 def _ensure_device_hash_column():
     """Crea la columna device_hash directamente si falta (a prueba de fallos)."""
@@ -3127,57 +5827,40 @@ def _ensure_device_hash_column():
             if 'Duplicate' not in err and '42S21' not in err:
                 logging.getLogger(__name__).warning(f"[migrations] device_hash: {_ce}")
 
-try:
-    _ensure_device_hash_column()
-except Exception as _e:
-    logging.getLogger(__name__).error(f"[device_hash col] {_e}")
-
-
-
 
 def _migrate_existing_fraud_referrals():
     """
     Mark existing referrals as is_fraud=1 if referrer and referred share an IP.
-    Safe to run on every startup — only updates unflagged rows.
-    Uses a two-step approach compatible with MySQL's UPDATE limitations.
+    One-time backfill. NO va en _run_migrations(): alli se ejecutaria con el
+    GET_LOCK de migraciones tomado y el resto de workers esperando en su
+    import. Lo lanza _background_backfills (app.py) y se retoma por
+    backfill_progress. Recorre referrals por tramos de id con backfill():
+    cada tramo es un UPDATE corto y nunca se bloquea la tabla entera.
+    Devuelve False si se corto por tiempo (se retoma en la siguiente llamada).
     """
     try:
-        # Step 1: find all referral IDs where referrer and referred share any IP
-        fraud_ids = execute_query("""
-            SELECT r.id
-            FROM referrals r
-            WHERE r.is_fraud = 0
-              AND r.validated = 1
-              AND EXISTS (
-                  SELECT 1
-                  FROM user_ips ui1
-                  INNER JOIN user_ips ui2
-                    ON ui1.ip_address = ui2.ip_address
-                  WHERE ui1.user_id = r.referrer_id
-                    AND ui2.user_id = r.referred_id
-              )
-        """, fetch_all=True)
-
-        if not fraud_ids:
-            logger.info("[ANTI-FRAUD] Migration: no fraud referrals found.")
-            return
-
-        ids = [str(row['id']) for row in fraud_ids]
-
-        # Step 2: update each one individually to avoid MySQL subquery restriction
-        updated = 0
-        for rid in ids:
-            execute_query(
-                "UPDATE referrals SET is_fraud = 1 WHERE id = %s",
-                (rid,)
-            )
-            updated += 1
-
-        logger.warning(f"[ANTI-FRAUD] Migration: marked {updated} existing referrals as fraud.")
+        res = backfill(
+            "flag_existing_fraud_referrals_v1", "referrals",
+            """UPDATE referrals r SET r.is_fraud = 1
+               WHERE r.id BETWEEN %s AND %s
+                 AND r.is_fraud = 0
+                 AND r.validated = 1
+                 AND EXISTS (
+                     SELECT 1
+                     FROM user_ips ui1
+                     INNER JOIN user_ips ui2
+                       ON ui1.ip_address = ui2.ip_address
+                     WHERE ui1.user_id = r.referrer_id
+                       AND ui2.user_id = r.referred_id
+                 )""",
+            max_seconds=60,
+        )
+        if res['rows']:
+            logger.warning(f"[ANTI-FRAUD] Migration: marked {res['rows']} existing referrals as fraud.")
+        return res['done']
     except Exception as e:
         logger.warning(f"[ANTI-FRAUD] Migration error: {e}")
-
-_migrate_existing_fraud_referrals()
+        return False
 
 # La tarea especial 'invite_purchase' (Invite & Earn 10%) fue eliminada.
 # Ya no se crea automáticamente. Se elimina de la BD si existe (ver _remove_invite_purchase_task).
@@ -3189,10 +5872,17 @@ def _remove_invite_purchase_task():
     except Exception as _e:
         logger.warning(f"remove invite_purchase task error: {_e}")
 
+# ── Auto-run migrations after all functions are defined ───────
+_should_init_migrations = (
+    os.environ.get('RAILWAY_ENVIRONMENT') or
+    os.environ.get('INIT_DB', '0') == '1' or
+    True  # Always safe to run — each migration executes only once
+)
 try:
-    _remove_invite_purchase_task()
+    _run_migrations()
 except Exception as _e:
-    logger.warning(f"_remove_invite_purchase_task error: {_e}")
+    logging.getLogger(__name__).error(f"[migrations] FAILED: {_e}")
+
 
 def get_shared_ip_accounts(user_id, min_times_seen=2):
     """
@@ -3212,6 +5902,7 @@ def get_shared_ip_accounts(user_id, min_times_seen=2):
     return [r['user_id'] for r in rows] if rows else []
 
 
+@read_only_tolerant
 def get_shared_ip_groups(min_accounts=2, limit=200):
     """
     Devuelve grupos de cuentas que comparten la misma IP (multicuentas).
@@ -3256,6 +5947,7 @@ def get_shared_ip_groups(min_accounts=2, limit=200):
     return groups
 
 
+@read_only_tolerant
 def search_multiaccounts(query, limit=100):
     """
     Buscador de multicuentas. Acepta:
@@ -3382,6 +6074,7 @@ def flag_user_fraud(user_id, reason):
             fraud_flagged_at   = NOW()
         WHERE user_id = %s
     """, (reason[:255], str(user_id)))
+    invalidate_user(user_id)
 
 
 def unflag_user_fraud(user_id, exempt=True):
@@ -3398,6 +6091,7 @@ def unflag_user_fraud(user_id, exempt=True):
             fraud_exempt       = %s
         WHERE user_id = %s
     """, (1 if exempt else 0, str(user_id),))
+    invalidate_user(user_id)
 
 
 def set_fraud_exempt(user_id, exempt):
@@ -3406,6 +6100,7 @@ def set_fraud_exempt(user_id, exempt):
         "UPDATE users SET fraud_exempt = %s WHERE user_id = %s",
         (1 if exempt else 0, str(user_id))
     )
+    invalidate_user(user_id)
 
 
 def is_fraud_exempt(user_id):
@@ -3478,6 +6173,163 @@ def check_and_flag_multi_account(user_id, min_times_seen=2):
     return flagged
 
 
+# ── Escaneo multicuenta incremental ───────────────────────────
+# check_and_flag_multi_account() hacia un self-join de user_ips y varias
+# lecturas de users en CADA peticion. Ahora lo dispara un job de fondo solo
+# cuando cambia el numero de cuentas de alguna IP: lee las IPs con actividad
+# desde la ultima pasada (indice por last_seen), compara su recuento de
+# cuentas (times_seen >= 2) con el guardado en multiaccount_ip_state y
+# re-evalua unicamente a los usuarios de las IPs cuyo recuento cambio.
+# En la peticion queda users.withdrawal_blocked (ya viene en la fila) y
+# en el retiro se fuerza una re-evaluacion completa.
+MULTIACCOUNT_SCAN_SECONDS = max(5.0, _env_num('MULTIACCOUNT_SCAN_SECONDS', 30, float))
+MULTIACCOUNT_SCAN_BATCH = max(10, _env_num('MULTIACCOUNT_SCAN_BATCH', 500))
+
+_ma_state = {
+    'watermark': None, 'runs': 0, 'ips_checked': 0, 'ips_changed': 0,
+    'users_rechecked': 0, 'flagged': 0, 'fraud_referrals': 0, 'last_run': None,
+}
+
+
+def _ma_overlap():
+    """user_ips.last_seen llega con hasta IP_RECORD_INTERVAL de retraso (write-behind):
+    cada pasada vuelve a mirar ese margen para no saltarse aristas."""
+    return timedelta(seconds=IP_RECORD_INTERVAL + IP_FLUSH_SECONDS + MULTIACCOUNT_SCAN_SECONDS)
+
+
+def scan_multiaccount_changes(min_times_seen=2, max_batches=20):
+    """Una pasada del job multicuenta. Devuelve las cuentas bloqueadas."""
+    flagged = []
+    marca = _ma_state['watermark'] or (datetime.now() - timedelta(hours=1))
+    inicio = marca - _ma_overlap()
+    for _ in range(max_batches):
+        rows = execute_query(
+            "SELECT ip_address, MAX(last_seen) AS visto FROM user_ips "
+            "WHERE last_seen >= %s GROUP BY ip_address ORDER BY visto LIMIT %s",
+            (inicio, MULTIACCOUNT_SCAN_BATCH), fetch_all=True
+        ) or []
+        if not rows:
+            break
+        flagged += _ma_process_ips([r['ip_address'] for r in rows], min_times_seen)
+        visto = max(r['visto'] for r in rows)
+        if isinstance(visto, str):   # agregados en el backend SQLite
+            visto = datetime.fromisoformat(visto)
+        marca = max(marca, visto)
+        if len(rows) < MULTIACCOUNT_SCAN_BATCH:
+            break
+        # Lote lleno: la siguiente pagina empieza en el ultimo visto (si todo el
+        # lote cae en el mismo segundo, se salta ese segundo para no atascarse)
+        inicio = visto if visto > inicio else inicio + timedelta(seconds=1)
+    _ma_state['watermark'] = marca
+    _ma_state['runs'] += 1
+    _ma_state['flagged'] += len(flagged)
+    _ma_state['last_run'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    return flagged
+
+
+def _ma_process_ips(ips, min_times_seen):
+    marcas = ','.join(['%s'] * len(ips))
+    ahora = {r['ip_address']: int(r['n']) for r in execute_query(
+        f"SELECT ip_address, COUNT(*) AS n FROM user_ips "
+        f"WHERE ip_address IN ({marcas}) AND times_seen >= %s GROUP BY ip_address",
+        tuple(ips) + (min_times_seen,), fetch_all=True) or []}
+    antes = {r['ip_address']: int(r['accounts']) for r in execute_query(
+        f"SELECT ip_address, accounts FROM multiaccount_ip_state WHERE ip_address IN ({marcas})",
+        tuple(ips), fetch_all=True) or []}
+    _ma_state['ips_checked'] += len(ips)
+    try:
+        _ma_flag_fraud_referrals(ips)
+    except Exception as e:
+        logger.warning(f"[ANTI-FRAUD] barrido de referidos: {e}")
+
+    cambiadas = [ip for ip in ips if ahora.get(ip, 0) != antes.get(ip, 0)
+                 and max(ahora.get(ip, 0), antes.get(ip, 0)) >= 2]
+    if not cambiadas:
+        return []
+    _ma_state['ips_changed'] += len(cambiadas)
+    execute_query(
+        "INSERT INTO multiaccount_ip_state (ip_address, accounts) VALUES "
+        + ', '.join(['(%s, %s)'] * len(cambiadas))
+        + " ON DUPLICATE KEY UPDATE accounts = VALUES(accounts)",
+        tuple(x for ip in cambiadas for x in (ip, ahora.get(ip, 0)))
+    )
+    marcas = ','.join(['%s'] * len(cambiadas))
+    usuarios = [str(r['user_id']) for r in execute_query(
+        f"SELECT DISTINCT user_id FROM user_ips WHERE ip_address IN ({marcas}) AND times_seen >= %s",
+        tuple(cambiadas) + (min_times_seen,), fetch_all=True) or []]
+
+    flagged, hechos = [], set()
+    for uid in usuarios:
+        if uid in hechos:
+            continue   # ya bloqueado como parte del grupo de otro
+        try:
+            nuevos = check_and_flag_multi_account(uid, min_times_seen=min_times_seen)
+        except Exception as e:
+            logger.warning(f"[ANTI-FRAUD] scan {uid}: {e}")
+            continue
+        _ma_state['users_rechecked'] += 1
+        hechos.update(nuevos)
+        flagged += nuevos
+    return flagged
+
+
+def _ma_flag_fraud_referrals(ips):
+    """Marca is_fraud en los referidos validados cuyo invitador e invitado
+    comparten IP, mirando solo los usuarios de `ips` (actividad reciente).
+    Al validar un referido solo cuenta el solapamiento que ya existia;
+    este barrido recoge el que aparece despues (mismo criterio que
+    _migrate_existing_fraud_referrals, sin minimo de times_seen)."""
+    marcas = ','.join(['%s'] * len(ips))
+    por_ip = collections.defaultdict(set)
+    for r in execute_query(
+            f"SELECT ip_address, user_id FROM user_ips WHERE ip_address IN ({marcas})",
+            tuple(ips), fetch_all=True) or []:
+        por_ip[r['ip_address']].add(str(r['user_id']))
+    usuarios = sorted({u for grupo in por_ip.values() if len(grupo) >= 2 for u in grupo})
+    marcados = 0
+    for i in range(0, len(usuarios), BULK_CHUNK):
+        bloque = usuarios[i:i + BULK_CHUNK]
+        marcas = ','.join(['%s'] * len(bloque))
+        marcados += execute_update_rowcount(f"""
+            UPDATE referrals r SET r.is_fraud = 1
+            WHERE r.referrer_id IN ({marcas})
+              AND r.is_fraud = 0
+              AND r.validated = 1
+              AND EXISTS (
+                  SELECT 1
+                  FROM user_ips ui1
+                  INNER JOIN user_ips ui2
+                    ON ui1.ip_address = ui2.ip_address
+                  WHERE ui1.user_id = r.referrer_id
+                    AND ui2.user_id = r.referred_id
+              )""", tuple(bloque)) or 0
+    if marcados:
+        _ma_state['fraud_referrals'] += marcados
+        logger.warning(f"[ANTI-FRAUD] {marcados} referidos marcados como fraude (IP compartida posterior).")
+    return marcados
+
+
+def recheck_multi_account(user_id, ip_address=None):
+    """Re-evaluacion forzada (retiros). require_user registra la IP DESPUES
+    de la respuesta, asi que la visita de esta peticion se anota aqui
+    (ip_address) y se vuelca con las pendientes del usuario antes de
+    comprobar. El llamador debe cancelar su registro diferido."""
+    try:
+        if ip_address:
+            record_user_ip(user_id, ip_address)
+        flush_ip_activity(user_id=user_id)
+    except Exception as e:
+        logger.warning(f"[ANTI-FRAUD] flush IPs {user_id}: {e}")
+    return check_and_flag_multi_account(user_id)
+
+
+def get_multiaccount_scan_stats():
+    out = dict(_ma_state)
+    if out['watermark'] is not None:
+        out['watermark'] = out['watermark'].strftime('%Y-%m-%d %H:%M:%S')
+    return out
+
+
 def are_accounts_related(user_id_a, user_id_b, min_times_seen=1):
     """
     Return True if user_id_a and user_id_b share at least one IP.
@@ -0,0 +1,382 @@
+"""
+database_async.py — Capa MySQL asincrona (asyncio) en paralelo a database.py
+
+La API sincrona de database.py no cambia. Este modulo ofrece la misma forma
+para codigo asyncio (un worker ASGI / uvicorn, tareas de sondeo de depositos,
+llamadas a Telegram o Toncenter) sin ocupar un hilo mientras espera a MySQL:
+
+  • execute_query_async / execute_update_rowcount_async  ≈ execute_query / execute_update_rowcount
+  • unit_of_work_async()                                 ≈ unit_of_work() / crystal_rush._tx()
+  • get_user_async, update_balance_async, increment_stat_async,
+    get_user_machines_async, get_claim_cooldown_remaining_async,
+    claim_mining_rewards_async                           ≈ sus versiones sync
+  • run_sync(fn, ...)                                    para el resto (en un hilo)
+
+Driver: aiomysql (opcional, requirements-async.txt). Si no esta instalado el modulo se importa igual
+y falla al primer uso con un error claro. Pool propio POR event loop,
+configurado con las mismas variables DB_POOL_* que el pool sincrono.
+
+Uso:
+    from database_async import get_user_async, claim_mining_rewards_async
+    user = await get_user_async(uid)
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import json
+import logging
+import random
+import time
+from datetime import datetime
+
+try:
+    import aiomysql
+    from pymysql.constants import CLIENT
+except ImportError:  # dependencia opcional
+    aiomysql = None
+    CLIENT = None
+
+from database import (
+    DB_CONFIG, POOL_CONFIG, STATS_SHARDS, MINING_CLAIM_COOLDOWN,
+    _record_query, _fmt_espera, get_config, invalidate_user,
+)
+
+logger = logging.getLogger(__name__)
+
+_pools = {}          # event loop -> aiomysql.Pool
+_pool_locks = {}     # event loop -> asyncio.Lock
+
+# Conexion y profundidad de transaccion de la tarea actual (equivalente
+# asyncio del threading.local de database.py: cada Task tiene su contexto).
+_tx_conn = contextvars.ContextVar('db_async_tx_conn', default=None)
+_tx_depth = contextvars.ContextVar('db_async_tx_depth', default=0)
+
+
+def _require_driver():
+    if aiomysql is None:
+        raise RuntimeError(
+            "database_async necesita aiomysql, que es opcional: "
+            "pip install -r requirements-async.txt")
+
+
+async def get_async_pool():
+    """Pool aiomysql del event loop actual (se crea en el primer uso)."""
+    _require_driver()
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is not None:
+        return pool
+    lock = _pool_locks.setdefault(loop, asyncio.Lock())
+    async with lock:
+        pool = _pools.get(loop)
+        if pool is None:
+            pool = await aiomysql.create_pool(
+                host=DB_CONFIG['host'],
+                port=int(DB_CONFIG['port']),
+                user=DB_CONFIG['user'],
+                password=DB_CONFIG['password'],
+                db=DB_CONFIG['database'],
+                charset=DB_CONFIG.get('charset', 'utf8mb4'),
+                autocommit=True,
+                minsize=1,
+                maxsize=POOL_CONFIG['size'] + POOL_CONFIG['max_overflow'],
+                pool_recycle=POOL_CONFIG['recycle'] or -1,
+                client_flag=CLIENT.MULTI_STATEMENTS,
+            )
+            _pools[loop] = pool
+            logger.info(f"Async database pool created (maxsize={pool.maxsize})")
+    return pool
+
+
+async def close_async_pool():
+    """Cierra el pool del loop actual (llamar al apagar el worker ASGI)."""
+    pool = _pools.pop(asyncio.get_running_loop(), None)
+    if pool is not None:
+        pool.close()
+        await pool.wait_closed()
+
+
+@contextlib.asynccontextmanager
+async def _acquire():
+    """Conexion de la transaccion en curso o una nueva del pool."""
+    conn = _tx_conn.get()
+    if conn is not None:
+        yield conn
+        return
+    pool = await get_async_pool()
+    async with pool.acquire() as conn:
+        yield conn
+
+
+def _in_transaction():
+    return _tx_depth.get() > 0
+
+
+async def execute_query_async(query, params=None, fetch_one=False, fetch_all=False):
+    """Igual que database.execute_query, en asyncio."""
+    async with _acquire() as conn:
+        t0 = time.perf_counter()
+        try:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute(query, params or ())
+                if fetch_one:
+                    row = await cur.fetchone()
+                    _record_query(query, t0, 1 if row else 0)
+                    return row
+                if fetch_all:
+                    rows = list(await cur.fetchall())
+                    _record_query(query, t0, len(rows))
+                    return rows
+                _record_query(query, t0, cur.rowcount)
+                return cur.lastrowid
+        except Exception as e:
+            _record_query(query, t0, error=True)
+            logger.error(f"Query error (async): {e}\nQuery: {query}\nParams: {params}")
+            raise
+
+
+async def execute_update_rowcount_async(query, params=None):
+    """Igual que database.execute_update_rowcount, en asyncio."""
+    async with _acquire() as conn:
+        t0 = time.perf_counter()
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute(query, params or ())
+                _record_query(query, t0, cur.rowcount)
+                return cur.rowcount
+        except Exception as e:
+            _record_query(query, t0, error=True)
+            logger.error(f"Query error (async): {e}\nQuery: {query}\nParams: {params}")
+            raise
+
+
+@contextlib.asynccontextmanager
+async def unit_of_work_async():
+    """Transaccion explicita compartida por los helpers async de la tarea.
+
+        async with unit_of_work_async() as (conn, cur):
+            await update_balance_async(...)
+
+    Misma semantica que database.unit_of_work(): commit al salir, rollback
+    ante excepcion, y las anidadas se unen a la exterior.
+    """
+    if _in_transaction():
+        conn = _tx_conn.get()
+        depth = _tx_depth.set(_tx_depth.get() + 1)
+        try:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                yield conn, cur
+        finally:
+            _tx_depth.reset(depth)
+        return
+
+    pool = await get_async_pool()
+    async with pool.acquire() as conn:
+        await conn.begin()
+        tok_conn = _tx_conn.set(conn)
+        tok_depth = _tx_depth.set(1)
+        try:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                yield conn, cur
+            await conn.commit()
+        except BaseException:
+            try:
+                await conn.rollback()
+            except Exception:
+                pass
+            raise
+        finally:
+            _tx_conn.reset(tok_conn)
+            _tx_depth.reset(tok_depth)
+
+
+async def run_sync(fn, *args, **kwargs):
+    """Ejecuta un helper sincrono de database.py en un hilo sin bloquear el loop.
+    Para lo que no tiene version async (liquidacion de planes, Crystal Rush)."""
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
+
+# ============================================
+# HELPERS CALIENTES
+# ============================================
+
+async def get_user_async(user_id):
+    """Get user by Telegram ID"""
+    user = await execute_query_async("SELECT * FROM users WHERE user_id = %s",
+                                     (str(user_id),), fetch_one=True)
+    if user and user.get('completed_tasks') and isinstance(user['completed_tasks'], str):
+        try:
+            user['completed_tasks'] = json.loads(user['completed_tasks'])
+        except ValueError:
+            user['completed_tasks'] = []
+    return user
+
+
+async def update_balance_async(user_id, amount, action, description=None):
+    """database.update_balance en asyncio: UPDATE con @bal + fila de historial
+    en un solo paquete multi-statement, dentro de una transaccion."""
+    amount = float(amount)
+    uid = str(user_id)
+    if amount < 0:
+        upd_sql = ("UPDATE users SET doge_balance = (@bal := doge_balance + %s) "
+                   "WHERE user_id = %s AND doge_balance >= %s")
+        upd_params = (amount, uid, -amount)
+    else:
+        upd_sql = ("UPDATE users SET doge_balance = (@bal := doge_balance + %s), "
+                   "total_earned = total_earned + %s WHERE user_id = %s")
+        upd_params = (amount, amount, uid)
+    ins_sql = ("INSERT INTO balance_history "
+               "(user_id, action, amount, balance_before, balance_after, description) "
+               "SELECT %s, %s, %s, @bal - %s, @bal, %s FROM DUAL WHERE @bal IS NOT NULL")
+    ins_params = (uid, action, amount, amount, description)
+    sql = ";\n".join(["SET @bal := NULL", upd_sql, ins_sql, "SELECT @bal"])
+
+    saldo = None
+    async with unit_of_work_async() as (conn, _cur):
+        t0 = time.perf_counter()
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute(sql, upd_params + ins_params)
+                while True:
+                    if cur.description:
+                        row = await cur.fetchone()
+                        saldo = row[0] if row else None
+                    if not await cur.nextset():
+                        break
+            _record_query(sql, t0, 1 if saldo is not None else 0)
+        except Exception as e:
+            _record_query(sql, t0, error=True)
+            logger.error(f"[ledger] update_balance_async user={uid} amount={amount} action={action}: {e}")
+            raise
+    if saldo is not None:
+        invalidate_user(uid)   # cache de filas de users del lado sincrono
+    return saldo is not None
+
+
+async def increment_stat_async(key, amount=1):
+    """Increment a stat"""
+    if STATS_SHARDS > 1:
+        try:
+            await execute_query_async("""
+                INSERT INTO stats_shards (stat_key, shard, stat_value) VALUES (%s, %s, %s)
+                ON DUPLICATE KEY UPDATE stat_value = stat_value + VALUES(stat_value)
+            """, (key, random.randrange(STATS_SHARDS), amount))
+            return
+        except Exception as e:
+            logger.warning(f"[stats] shard fallo, uso stats: {e}")
+    await execute_query_async("""
+        INSERT INTO stats (stat_key, stat_value) VALUES (%s, %s)
+        ON DUPLICATE KEY UPDATE stat_value = stat_value + VALUES(stat_value)
+    """, (key, amount))
+
+
+async def pay_referral_commission_async(user_id, amount, source):
+    """database.pay_referral_commission en asyncio."""
+    if not amount or float(amount) <= 0:
+        return
+    row = await execute_query_async(
+        """SELECT u.referred_by, r.validated
+           FROM users u
+           JOIN referrals r ON r.referrer_id = u.referred_by AND r.referred_id = u.user_id
+           WHERE u.user_id = %s LIMIT 1""",
+        (str(user_id),), fetch_one=True)
+    if not row or not row.get('validated'):
+        return
+    referrer_id = row['referred_by']
+    # get_config sirve de la cache en memoria; solo revalida contra la BD cada
+    # CONFIG_CACHE_SECONDS, asi que se ejecuta en un hilo para no bloquear el loop.
+    pct = float(await run_sync(get_config, 'referral_commission_pct', '0')) / 100.0
+    commission = round(float(amount) * pct, 8)
+    if commission <= 0:
+        return
+    async with unit_of_work_async():
+        await update_balance_async(referrer_id, commission, 'referral_commission',
+                                   f"5% commission from {source} of user {user_id}")
+        await execute_query_async(
+            "UPDATE users SET referral_earnings = referral_earnings + %s WHERE user_id = %s",
+            (commission, str(referrer_id)))
+    invalidate_user(referrer_id)
+    logger.info(f"Referral commission: {commission:.8f} TON → referrer={referrer_id} from {source} of user={user_id}")
+
+
+async def get_user_machines_async(user_id):
+    """Get user's active mining machines"""
+    return await execute_query_async("""
+        SELECT * FROM user_mining_machines
+        WHERE user_id = %s AND expires_at > NOW()
+        ORDER BY purchased_at DESC
+    """, (str(user_id),), fetch_all=True) or []
+
+
+async def get_claim_cooldown_remaining_async(user_id):
+    """Segundos que faltan para que el usuario pueda volver a reclamar."""
+    try:
+        row = await execute_query_async("""
+            SELECT GREATEST(0, %s - TIMESTAMPDIFF(SECOND, MAX(last_claim_at), NOW())) AS faltan
+            FROM user_mining_machines
+            WHERE user_id = %s AND settled = 0 AND expires_at > NOW()
+        """, (MINING_CLAIM_COOLDOWN, str(user_id)), fetch_one=True)
+        if not row or row.get('faltan') is None:
+            return 0
+        return int(row['faltan'])
+    except Exception as e:
+        logger.warning(f"[MINING-CLAIM] error calculando cooldown: {e}")
+        return 0
+
+
+async def claim_mining_rewards_async(user_id):
+    """database.claim_mining_rewards en asyncio, con los mismos dos candados
+    en SQL (cooldown y `last_claim_at <=> valor leido`)."""
+    machines = await get_user_machines_async(user_id)
+    if not machines:
+        return {'success': False, 'err_code': 'api_no_machines'}
+
+    faltan = await get_claim_cooldown_remaining_async(user_id)
+    if faltan > 0:
+        return {'success': False, 'err_code': 'api_claim_cooldown',
+                'wait': _fmt_espera(faltan), 'seconds': faltan}
+
+    total_claimed = 0
+    now = datetime.now().replace(microsecond=0)
+    for machine in machines:
+        raw_last = machine.get('last_claim_at')
+        last_claim = raw_last or machine.get('purchased_at')
+        if not last_claim:
+            continue
+        expires = machine.get('expires_at')
+        hasta = min(now, expires) if expires else now
+        hours_elapsed = max(0.0, (hasta - last_claim).total_seconds() / 3600)
+        pending = hours_elapsed * float(machine.get('hourly_rate', 0))
+        if pending <= 0:
+            continue
+        filas = await execute_update_rowcount_async("""
+            UPDATE user_mining_machines
+            SET last_claim_at = %s, total_mined = total_mined + %s
+            WHERE id = %s
+              AND settled = 0
+              AND last_claim_at <=> %s
+              AND (last_claim_at IS NULL
+                   OR last_claim_at <= NOW() - INTERVAL %s SECOND)
+        """, (hasta, pending, machine['id'], raw_last, MINING_CLAIM_COOLDOWN))
+        if filas:
+            total_claimed += pending
+        else:
+            logger.info(f"[MINING-CLAIM] bloqueado en machine {machine['id']} "
+                        f"(user {user_id}): cooldown o carrera")
+
+    if total_claimed > 0:
+        await update_balance_async(user_id, total_claimed, 'mining_reward', 'Mining rewards claimed')
+        await increment_stat_async('total_doge_distributed', int(total_claimed * 100000000))
+        await pay_referral_commission_async(user_id, total_claimed, 'mining')
+        return {'success': True, 'err_code': 'api_claimed_rewards',
+                'claimed': f'{total_claimed:.8f}', 'amount': total_claimed}
+    return {'success': False, 'err_code': 'api_no_rewards'}
+
+
+async def settle_expired_machines_async(user_id=None, limit=300):
+    """Liquidacion de planes vencidos. Es una transaccion larga con
+    operaciones en lote compartidas con la version sync: se ejecuta la
+    misma funcion en un hilo en vez de duplicarla."""
+    from database import settle_expired_machines
+    return await run_sync(settle_expired_machines, user_id, limit)
@@ -0,0 +1,444 @@
+"""
+db_sqlite.py — Backend SQLite embebido para database.py (benchmarks / CI)
+
+Con DB_BACKEND=sqlite (y SQLITE_PATH, por defecto ./dogepixel.sqlite3)
+database.py usa conexiones de este modulo en vez de mysql-connector. Sirve
+para medir claim_mining_rewards, api_tap, etc. en un portatil o en CI sin
+un MySQL de staging. NO es para produccion.
+
+Dos piezas:
+  • translate(sql): reescribe el dialecto MySQL que usa el proyecto a SQLite
+    (%s, ON DUPLICATE KEY UPDATE, INSERT IGNORE, <=>, INTERVAL, FOR UPDATE,
+    DDL con AUTO_INCREMENT/ENGINE/INDEX en linea...). Resultado cacheado.
+  • SQLiteConnection / SQLiteCursor: la parte de la interfaz de
+    mysql-connector que usa el proyecto (cursor(dictionary=True),
+    start_transaction, in_transaction, ping, rowcount, lastrowid...).
+
+Lo que SQLite no tiene (NOW, CURDATE, GREATEST, TIMESTAMPDIFF, DATE_SUB,
+GET_LOCK...) se registra como funciones Python en cada conexion. Las fechas
+se guardan como texto 'YYYY-MM-DD HH:MM:SS' en hora local, igual que NOW().
+Los DECIMAL pasan a REAL: vale para medir rendimiento, no para cuadrar saldos.
+"""
+
+import re
+import random
+import sqlite3
+import threading
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+
+_TS_FMT = '%Y-%m-%d %H:%M:%S'
+
+
+# ============================================
+# CONVERSION DE TIPOS
+# ============================================
+
+def _adapt_datetime(d):
+    return d.strftime(_TS_FMT) if not d.microsecond else d.isoformat(' ')
+
+
+def _parse_ts(v):
+    if v is None or isinstance(v, datetime):
+        return v
+    if isinstance(v, bytes):
+        v = v.decode()
+    v = str(v)
+    if len(v) == 10:
+        return datetime.strptime(v, '%Y-%m-%d')
+    return datetime.fromisoformat(v.replace('T', ' '))
+
+
+def _convert_ts(b):
+    try:
+        return _parse_ts(b)
+    except ValueError:
+        return b.decode()
+
+
+def _convert_date(b):
+    try:
+        return date.fromisoformat(b.decode()[:10])
+    except ValueError:
+        return b.decode()
+
+
+sqlite3.register_adapter(datetime, _adapt_datetime)
+sqlite3.register_adapter(date, lambda d: d.isoformat())
+sqlite3.register_adapter(Decimal, float)
+for _t in ('DATETIME', 'TIMESTAMP'):
+    sqlite3.register_converter(_t, _convert_ts)
+sqlite3.register_converter('DATE', _convert_date)
+
+
+# ============================================
+# FUNCIONES MYSQL
+# ============================================
+
+_UNIT_SECONDS = {'SECOND': 1, 'MINUTE': 60, 'HOUR': 3600, 'DAY': 86400, 'WEEK': 604800}
+
+
+def _date_add(d, n, unit):
+    if d is None or n is None:
+        return None
+    solo_fecha = isinstance(d, str) and len(d) == 10
+    dt = _parse_ts(d)
+    unit = unit.upper()
+    if unit == 'MONTH':
+        m = dt.month - 1 + int(n)
+        y, m = dt.year + m // 12, m % 12 + 1
+        dt = dt.replace(year=y, month=m, day=min(dt.day, 28))
+    else:
+        dt = dt + timedelta(seconds=float(n) * _UNIT_SECONDS[unit])
+    return dt.strftime('%Y-%m-%d') if solo_fecha and unit in ('DAY', 'WEEK', 'MONTH') else dt.strftime(_TS_FMT)
+
+
+def _timestampdiff(unit, a, b):
+    if a is None or b is None:
+        return None
+    secs = (_parse_ts(b) - _parse_ts(a)).total_seconds()
+    return int(secs // _UNIT_SECONDS[unit.upper()])
+
+
+def _greatest(*args):
+    return None if any(a is None for a in args) else max(args)
+
+
+def _least(*args):
+    return None if any(a is None for a in args) else min(args)
+
+
+def _yearweek(d, mode=0):
+    if d is None:
+        return None
+    y, w, _ = _parse_ts(d).isocalendar()
+    return y * 100 + w
+
+
+_FUNCIONES = [
+    ('NOW', 0, lambda: datetime.now().strftime(_TS_FMT)),
+    ('CURDATE', 0, lambda: date.today().isoformat()),
+    ('UTC_TIMESTAMP', 0, lambda: datetime.utcnow().strftime(_TS_FMT)),
+    ('UNIX_TIMESTAMP', 0, lambda: int(datetime.now().timestamp())),
+    ('UNIX_TIMESTAMP', 1, lambda d: None if d is None else int(_parse_ts(d).timestamp())),
+    ('DATE_ADD', 3, _date_add),
+    ('DATE_SUB', 3, lambda d, n, u: _date_add(d, -float(n), u) if n is not None else None),
+    ('TIMESTAMPDIFF', 3, _timestampdiff),
+    ('GREATEST', -1, _greatest),
+    ('LEAST', -1, _least),
+    ('WEEKDAY', 1, lambda d: None if d is None else _parse_ts(d).weekday()),
+    ('DAYOFMONTH', 1, lambda d: None if d is None else _parse_ts(d).day),
+    ('YEAR', 1, lambda d: None if d is None else _parse_ts(d).year),
+    ('MONTH', 1, lambda d: None if d is None else _parse_ts(d).month),
+    ('YEARWEEK', 1, _yearweek),
+    ('YEARWEEK', 2, _yearweek),
+    ('CONCAT', -1, lambda *a: None if any(x is None for x in a) else ''.join(str(x) for x in a)),
+    ('RAND', 0, random.random),
+    ('IF', 3, lambda c, a, b: a if c else b),
+    # Un solo proceso escribe el fichero: los locks con nombre siempre se conceden
+    ('GET_LOCK', 2, lambda name, t: 1),
+    ('RELEASE_LOCK', 1, lambda name: 1),
+]
+
+
+# ============================================
+# TRADUCCION DE DIALECTO
+# ============================================
+
+_N = r"(\?|-?\d+(?:\.\d+)?|\w+\((?:[^()]|\([^()]*\))*\)|\((?:[^()]|\([^()]*\))*\))"
+_UNIT = r"(SECOND|MINUTE|HOUR|DAY|WEEK|MONTH)"
+
+_RX_INTERVAL_FN = re.compile(r"\bDATE_(ADD|SUB)\(\s*((?:[^(),]|\((?:[^()]|\([^()]*\))*\))+?)\s*,\s*INTERVAL\s+"
+                             + _N + r"\s+" + _UNIT + r"\s*\)", re.I)
+_RX_INTERVAL_OP = re.compile(r"((?:NOW|CURDATE|UTC_TIMESTAMP)\(\)|[A-Za-z_][\w.]*)\s*([+-])\s*INTERVAL\s+"
+                             + _N + r"\s+" + _UNIT + r"\b", re.I)
+_RX_TSDIFF = re.compile(r"\bTIMESTAMPDIFF\(\s*(\w+)\s*,", re.I)
+_RX_VALUES_FN = re.compile(r"\bVALUES\((\w+)\)", re.I)
+_RX_ODKU = re.compile(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b", re.I)
+
+_SIMPLES = [
+    # Comprobaciones de esquema de init_ton_tables / migraciones
+    (re.compile(r"\bFROM\s+information_schema\.COLUMNS\s+WHERE\s+TABLE_SCHEMA\s*=\s*DATABASE\(\)\s+"
+                r"AND\s+TABLE_NAME\s*=\s*\?\s+AND\s+COLUMN_NAME\s*=\s*\?", re.I),
+     "FROM pragma_table_info(?) WHERE name = ?"),
+    (re.compile(r"\bFROM\s+information_schema\.TABLES\s+WHERE\s+TABLE_SCHEMA\s*=\s*DATABASE\(\)\s+"
+                r"AND\s+TABLE_NAME\s*=\s*\?", re.I),
+     "FROM sqlite_master WHERE type = 'table' AND name = ?"),
+    (re.compile(r"\bINSERT\s+IGNORE\b", re.I), "INSERT OR IGNORE"),
+    (re.compile(r"\bREPLACE\s+INTO\b", re.I), "INSERT OR REPLACE INTO"),
+    (re.compile(r"\s*<=>\s*"), " IS "),
+    (re.compile(r"\bFOR\s+UPDATE\b|\bLOCK\s+IN\s+SHARE\s+MODE\b", re.I), ""),
+    (re.compile(r"\bFROM\s+DUAL\b", re.I), ""),
+    (re.compile(r"^\s*START\s+TRANSACTION\s*$", re.I), "BEGIN IMMEDIATE"),
+]
+
+_RX_CREATE = re.compile(r"^\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?`?(\w+)`?", re.I)
+_RX_INLINE_INDEX = re.compile(r"^\s*(UNIQUE\s+)?(?:INDEX|KEY)\s+`?(\w+)`?\s*\(([^)]*)\)\s*,?\s*$", re.I)
+_RX_UNIQUE_KEY = re.compile(r"^(\s*)UNIQUE\s+(?:KEY|INDEX)\s+`?\w+`?\s*(\([^)]*\))", re.I)
+_RX_ALTER_ADD_INDEX = re.compile(
+    r"^\s*ALTER\s+TABLE\s+`?(\w+)`?\s+ADD\s+(UNIQUE\s+)?(?:INDEX|KEY)\s+`?(\w+)`?\s*\(([^)]*)\)\s*$", re.I)
+_RX_ALTER_DROP_INDEX = re.compile(r"^\s*ALTER\s+TABLE\s+`?(\w+)`?\s+DROP\s+(?:INDEX|KEY)\s+`?(\w+)`?\s*$", re.I)
+_RX_ALTER_ADD_COLUMN = re.compile(r"^\s*ALTER\s+TABLE\s+`?(\w+)`?\s+ADD\s+COLUMN\s+(?:IF\s+NOT\s+EXISTS\s+)?", re.I)
+
+_DDL_TIPOS = [
+    (re.compile(r"\b(?:BIG|SMALL|TINY|MEDIUM)?INT(?:\(\d+\))?\s+(?:UNSIGNED\s+)?(?:NOT\s+NULL\s+)?AUTO_INCREMENT\s+PRIMARY\s+KEY\b", re.I),
+     "INTEGER PRIMARY KEY AUTOINCREMENT"),
+    (re.compile(r"\bAUTO_INCREMENT\b", re.I), ""),
+    (re.compile(r"\bON\s+UPDATE\s+CURRENT_TIMESTAMP\b", re.I), ""),
+    (re.compile(r"\bDEFAULT\s+CURRENT_TIMESTAMP\b", re.I), "DEFAULT (datetime('now','localtime'))"),
+    (re.compile(r"\bENUM\s*\([^)]*\)", re.I), "TEXT"),
+    (re.compile(r"\bUNSIGNED\b", re.I), ""),
+    (re.compile(r"\bCOMMENT\s+'(?:[^'\\]|\\.|'')*'", re.I), ""),
+    (re.compile(r"\b(?:CHARACTER\s+SET|CHARSET|COLLATE)\s+\w+", re.I), ""),
+    (re.compile(r"\bAFTER\s+`?\w+`?\s*$", re.I), ""),
+    (re.compile(r"\)\s*(?:ENGINE|DEFAULT\s+CHARSET|CHARSET|COLLATE)\b[^)]*$", re.I), ")"),
+]
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _index_name(table, name):
+    # En SQLite los nombres de indice son globales (idx_user_id se repite)
+    return f"{table}__{name}"
+
+
+def _translate_create(sql, table):
+    cuerpo, extras = [], []
+    for line in sql.splitlines():
+        m = _RX_INLINE_INDEX.match(line)
+        if m and not m.group(1):
+            extras.append(f"CREATE INDEX IF NOT EXISTS {_index_name(table, m.group(2))} "
+                          f"ON {table} ({m.group(3)})")
+            continue
+        line = _RX_UNIQUE_KEY.sub(r"\1UNIQUE \2", line)
+        cuerpo.append(line)
+    sql = "\n".join(cuerpo)
+    for rx, repl in _DDL_TIPOS:
+        sql = rx.sub(repl, sql)
+    sql = re.sub(r",\s*\)\s*$", "\n)", sql.rstrip())
+    return [sql] + extras
+
+
+_RX_UPDATE_ALIAS = re.compile(r"^\s*UPDATE\s+(\w+)\s+(?:AS\s+)?(?!SET\b)(\w+)\s+SET\b", re.I)
+
+
+def _translate_update_alias(sql):
+    # UPDATE t a SET a.col = ...  ->  UPDATE t AS a SET col = ...
+    m = _RX_UPDATE_ALIAS.match(sql)
+    if not m:
+        return sql
+    alias = m.group(2)
+    cola = sql[m.end():]
+    w = re.search(r"\bWHERE\b", cola, re.I)
+    sets, resto = (cola[:w.start()], cola[w.start():]) if w else (cola, '')
+    sets = re.sub(rf"\b{alias}\.(\w+)\s*=", r"\1 =", sets)
+    return f"UPDATE {m.group(1)} AS {alias} SET" + sets + resto
+
+
+def _translate_dml(sql):
+    sql = _translate_update_alias(sql)
+    sql = _RX_INTERVAL_FN.sub(
+        lambda m: f"DATE_{m.group(1).upper()}({m.group(2)}, {m.group(3)}, '{m.group(4).upper()}')", sql)
+    sql = _RX_INTERVAL_OP.sub(
+        lambda m: f"DATE_ADD({m.group(1)}, {'-' if m.group(2) == '-' else ''}({m.group(3)}), "
+                  f"'{m.group(4).upper()}')", sql)
+    sql = _RX_TSDIFF.sub(lambda m: f"TIMESTAMPDIFF('{m.group(1).upper()}',", sql)
+    m = _RX_ODKU.search(sql)
+    if m:
+        cabeza, cola = sql[:m.start()], sql[m.end():]
+        if re.search(r"\bSELECT\b", cabeza, re.I) and not re.search(r"\bWHERE\b", cabeza, re.I):
+            cabeza += " WHERE true"   # INSERT ... SELECT ... ON CONFLICT necesita WHERE
+        sql = cabeza + " ON CONFLICT DO UPDATE SET " + _RX_VALUES_FN.sub(r"excluded.\1", cola)
+    for rx, repl in _SIMPLES:
+        sql = rx.sub(repl, sql)
+    return sql
+
+
+def split_statements(sql):
+    """Parte un script en sentencias por ';' fuera de comillas y comentarios."""
+    out, actual, quote, i = [], [], None, 0
+    while i < len(sql):
+        c = sql[i]
+        if quote:
+            actual.append(c)
+            if c == '\\' and i + 1 < len(sql):
+                actual.append(sql[i + 1])
+                i += 1
+            elif c == quote:
+                quote = None
+        elif c in ("'", '"', '`'):
+            quote = c
+            actual.append(c)
+        elif c == '-' and sql.startswith('--', i):
+            fin = sql.find('\n', i)
+            i = len(sql) if fin < 0 else fin
+            continue
+        elif c == ';':
+            out.append(''.join(actual))
+            actual = []
+        else:
+            actual.append(c)
+        i += 1
+    out.append(''.join(actual))
+    return [x.strip() for x in out if x.strip()]
+
+
+def translate(sql):
+    """Lista de sentencias SQLite equivalentes a `sql` (MySQL, paramstyle %s)."""
+    hit = _cache.get(sql)
+    if hit is not None:
+        return hit
+    src = sql.replace('%s', '?').replace('%%', '%').strip().rstrip(';')
+    m = _RX_CREATE.match(src)
+    if m:
+        out = _translate_create(src, m.group(1))
+    elif _RX_ALTER_ADD_INDEX.match(src):
+        t, uniq, name, cols = _RX_ALTER_ADD_INDEX.match(src).groups()
+        out = [f"CREATE {'UNIQUE ' if uniq else ''}INDEX IF NOT EXISTS {_index_name(t, name)} ON {t} ({cols})"]
+    elif _RX_ALTER_DROP_INDEX.match(src):
+        t, name = _RX_ALTER_DROP_INDEX.match(src).groups()
+        out = [f"DROP INDEX IF EXISTS {_index_name(t, name)}"]
+    elif _RX_ALTER_ADD_COLUMN.match(src):
+        t = _RX_ALTER_ADD_COLUMN.match(src).group(1)
+        col = _RX_ALTER_ADD_COLUMN.sub('', src)
+        for rx, repl in _DDL_TIPOS:
+            col = rx.sub(repl, col)
+        out = [f"ALTER TABLE {t} ADD COLUMN {col.strip()}"]
+    else:
+        out = [_translate_dml(src)]
+    with _cache_lock:
+        if len(_cache) > 5000:
+            _cache.clear()
+        _cache[sql] = out
+    return out
+
+
+# ============================================
+# CONEXION / CURSOR (interfaz de mysql-connector)
+# ============================================
+
+class SQLiteCursor:
+    def __init__(self, conn, dictionary=False):
+        self._conn = conn
+        self._cur = conn._db.cursor()
+        self._dict = dictionary
+        self.rowcount = -1
+        self.lastrowid = None
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    @property
+    def with_rows(self):
+        return self._cur.description is not None
+
+    def _row(self, r):
+        if r is None or not self._dict:
+            return r
+        return {d[0]: v for d, v in zip(self._cur.description, r)}
+
+    def execute(self, query, params=(), multi=False):
+        if multi:
+            return self._execute_multi(query, params)
+        stmts = translate(query)
+        self._cur.execute(stmts[0], tuple(params or ()))
+        self.rowcount = self._cur.rowcount
+        self.lastrowid = self._cur.lastrowid
+        for extra in stmts[1:]:
+            self._conn._db.execute(extra)
+
+    def _execute_multi(self, query, params):
+        """Como multi=True de mysql-connector: parte el script en sentencias,
+        reparte los parametros por orden y devuelve un cursor por sentencia.
+        Se ejecuta entero antes de devolver (los errores salen aqui, como
+        sqlite3.Error, y no a mitad de la iteracion)."""
+        params = tuple(params or ())
+        resultados = []
+        usados = 0
+        for sentencia in split_statements(query):
+            n = sentencia.count('%s')
+            if usados + n > len(params):
+                raise sqlite3.ProgrammingError(
+                    f"faltan parametros para la sentencia {len(resultados) + 1} del script")
+            cur = SQLiteCursor(self._conn, dictionary=self._dict)
+            cur.execute(sentencia, params[usados:usados + n])
+            usados += n
+            resultados.append(cur)
+        if usados != len(params):
+            raise sqlite3.ProgrammingError(
+                f"el script usa {usados} parametros y se pasaron {len(params)}")
+        if resultados:
+            self.rowcount = resultados[-1].rowcount
+            self.lastrowid = resultados[-1].lastrowid
+        return iter(resultados)
+
+    def executemany(self, query, seq_params):
+        self._cur.executemany(translate(query)[0], [tuple(p) for p in seq_params])
+        self.rowcount = self._cur.rowcount
+
+    def fetchone(self):
+        return self._row(self._cur.fetchone())
+
+    def fetchall(self):
+        return [self._row(r) for r in self._cur.fetchall()]
+
+    def fetchmany(self, size=1):
+        return [self._row(r) for r in self._cur.fetchmany(size)]
+
+    def __iter__(self):
+        return (self._row(r) for r in self._cur)
+
+    def close(self):
+        self._cur.close()
+
+
+class SQLiteConnection:
+    def __init__(self, database, **_ignored):
+        self._db = sqlite3.connect(
+            database, timeout=30, isolation_level=None,
+            detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False,
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for name, n, fn in _FUNCIONES:
+            self._db.create_function(name, n, fn)
+
+    @property
+    def in_transaction(self):
+        return self._db.in_transaction
+
+    def cursor(self, dictionary=False, **_ignored):
+        return SQLiteCursor(self, dictionary)
+
+    def start_transaction(self):
+        # IMMEDIATE toma el lock de escritura al empezar: hace las veces de
+        # los SELECT ... FOR UPDATE (SQLite serializa a todos los escritores)
+        self._db.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        if self._db.in_transaction:
+            self._db.execute("COMMIT")
+
+    def rollback(self):
+        if self._db.in_transaction:
+            self._db.execute("ROLLBACK")
+
+    def ping(self, reconnect=False, **_ignored):
+        self._db.execute("SELECT 1")
+
+    def is_connected(self):
+        try:
+            self._db.execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def close(self):
+        self._db.close()
+
+
+def connect(database='dogepixel.sqlite3', **kwargs):
+    """Equivalente a mysql.connector.connect(**DB_CONFIG) para ConnectionPool."""
+    return SQLiteConnection(database, **kwargs)
@@ -66,7 +66,9 @@ CREATE TABLE users (
     INDEX idx_user_id (user_id),
     INDEX idx_username (username),
     INDEX idx_referred_by (referred_by),
-    INDEX idx_banned (banned)
+    INDEX idx_banned (banned),
+    INDEX idx_banned_earned (banned, total_earned),
+    INDEX idx_total_earned (total_earned)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 -- ============================================
@@ -175,7 +177,8 @@ CREATE TABLE withdrawals (
     processed_at DATETIME DEFAULT NULL,
     
     INDEX idx_user_id (user_id),
-    INDEX idx_status (status)
+    INDEX idx_status (status),
+    INDEX idx_status_processed (status, processed_at, net_amount)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 -- ============================================
@@ -262,7 +265,8 @@ CREATE TABLE user_ips (
     times_seen INT DEFAULT 1,
     
     UNIQUE KEY unique_user_ip (user_id, ip_address),
-    INDEX idx_ip_address (ip_address)
+    INDEX idx_ip_address (ip_address),
+    INDEX idx_ip_last_seen (ip_address, last_seen, user_id, first_seen)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 -- ============================================